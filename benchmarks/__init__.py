@@ -0,0 +1,10 @@
+"""
+Benchmarks for the ID-003 protocol hot paths
+
+Run them all and compare against the committed baseline with
+
+    python -m benchmarks
+
+See `python -m benchmarks --help` for options. Each module can also be run
+on its own as a script.
+"""
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Run the benchmarks, write the results as JSON and compare them against a
+baseline. Exits with status 1 if anything regressed past the threshold.
+"""
+
+import os
+import sys
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+import json
+import time
+import logging
+import argparse
+import platform
+
+import crc
+import frames
+import poll
+import fleet
+import alloc
+
+
+BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+SUITES = {
+    'crc': lambda quick: crc.run(0.2 if quick else 0.5),
+    'frames': lambda quick: frames.run(0.2 if quick else 0.5),
+    'poll': lambda quick: poll.run(100 if quick else 500),
+    'fleet': lambda quick: fleet.run((16,) if quick else (16, 64, 256), 1.0 if quick else 3.0),
+    'alloc': lambda quick: alloc.run(200 if quick else 1000),
+}
+
+
+def lower_is_better(name):
+    """Latencies, CPU time and memory should go down, rates should go up"""
+    return name.endswith(('_us', '_bytes', '_blocks')) or '.cpu_' in name
+
+
+def informational(name):
+    """Too noisy to fail a run over"""
+    return name.endswith('.max_us') or name == 'crc.legacy_get_crc'
+
+
+def compare(results, baseline, threshold):
+    """Print a comparison table, returns the names of regressed benchmarks"""
+
+    regressed = []
+    print("{:<36}{:>14}{:>14}{:>9}".format("benchmark", "baseline", "current", "change"))
+    for name, value in sorted(results.items()):
+        if name not in baseline:
+            print("{:<36}{:>14}{:>14,.1f}".format(name, '-', value))
+            continue
+        base = baseline[name]
+        change = (value - base) / base if base else 0.0
+        worse = change > threshold if lower_is_better(name) else change < -threshold
+        worse = worse and not informational(name)
+        if worse:
+            regressed.append(name)
+        print("{:<36}{:>14,.1f}{:>14,.1f}{:>+8.0%}{}".format(
+            name, base, value, change, '  REGRESSED' if worse else ''))
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__)
+    parser.add_argument('suites', nargs='*', metavar='suite',
+                        help="suites to run: %s (default: all)" % ', '.join(sorted(SUITES)))
+    parser.add_argument('-o', '--output', help="write results to this JSON file")
+    parser.add_argument('-b', '--baseline', default=BASELINE,
+                        help="baseline to compare against (default: %(default)s)")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="write the results to the baseline file instead of comparing")
+    parser.add_argument('-t', '--threshold', type=float, default=0.25,
+                        help="relative change that counts as a regression (default: %(default)s)")
+    parser.add_argument('-q', '--quick', action='store_true', help="shorter, noisier runs")
+    args = parser.parse_args(argv)
+    unknown = [suite for suite in args.suites if suite not in SUITES]
+    if unknown:
+        parser.error("unknown suite(s): %s (choose from %s)"
+                     % (', '.join(unknown), ', '.join(sorted(SUITES))))
+
+    logging.disable(logging.CRITICAL)
+
+    results = {}
+    for suite in args.suites or sorted(SUITES):
+        print("Running %s..." % suite, file=sys.stderr)
+        results.update(SUITES[suite](args.quick))
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print("Saved baseline to %s" % args.baseline)
+        return 0
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    regressed = compare(results, baseline, args.threshold)
+    if regressed:
+        print("\n%d benchmark(s) regressed more than %.0f%%" % (len(regressed), args.threshold * 100))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
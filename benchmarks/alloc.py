@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Poll allocation benchmark
+
+Counts the memory `BillVal.req_status()` allocates with `tracemalloc`, over a
+pseudo-terminal to a `sim003` virtual acceptor. The acceptor runs in a
+forked child process so that only the polling side is traced. POSIX only.
+
+`peak_bytes` is the most memory allocated at any one time during a single
+poll, over what was already allocated before it; `retained_blocks` is how
+many allocations are still alive after all of them, i.e. what polling leaks
+or accumulates.
+"""
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import time
+import signal
+import logging
+import tracemalloc
+
+import id003
+import sim003
+
+
+def measure(bv, n):
+    """Poll `n` times under tracemalloc. Returns the worst single-poll peak
+    in bytes and the blocks still allocated afterwards.
+    """
+
+    req_status = bv.req_status
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        peak = 0
+        for _ in range(n):
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            req_status()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    # only count what the poll path itself is holding on to
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__),
+               tracemalloc.Filter(False, __file__)]
+    diff = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+    retained = sum(max(stat.count_diff, 0) for stat in diff)
+    return peak, retained
+
+
+def run(n=1000):
+    acceptor = sim003.VirtualAcceptor(power_up=id003.IDLE)
+    pid = os.fork()
+    if pid == 0:
+        # child: answer status requests until killed
+        try:
+            acceptor.start()
+            while True:
+                time.sleep(60)
+        finally:
+            os._exit(0)
+
+    try:
+        bv = id003.BillVal(acceptor.port)
+        bv.bv_on = True
+        for _ in range(50):
+            bv.req_status()  # warm up caches, histograms and the like
+        peak, retained = measure(bv, n)
+        bv.com.close()
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        acceptor.close()
+
+    return {
+        'alloc.req_status.peak_bytes': peak,
+        'alloc.req_status.retained_blocks': retained,
+    }
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    for name, value in run().items():
+        print("{:<40}{:>10,}".format(name, value))
+
+
+if __name__ == '__main__':
+    main()
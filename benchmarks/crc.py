@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+CRC throughput benchmark
+
+Compares the precomputed CRC engine in `id003` against the original
+`get_crc()`, which rebuilt its table and went through a '%04x' string on
+every call. Results are in frames per second.
+"""
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import time
+
+import id003
+
+
+def legacy_get_crc(message):
+    """`id003.get_crc()` as it was before the table was hoisted"""
+
+    TABLE = list(id003.CRC_TABLE)  # rebuilt on every call, like the original
+    crc = 0x0000
+    for byte in message:
+        crc = (crc >> 8) ^ TABLE[(crc ^ byte) & 0xff]
+    crc = '%04x' % crc
+    crc = [int(crc[-2:], 16), int(crc[:-2], 16)]
+    return bytes(crc)
+
+
+# a typical mix: mostly status requests and idle responses, the odd escrow
+SAMPLE = (
+    [id003.encode_frame(id003.STATUS_REQ), id003.encode_frame(id003.IDLE)] * 45
+    + [id003.encode_frame(id003.ESCROW, bytes([id003.DENOM_4]))] * 5
+    + [id003.encode_frame(id003.GET_VERSION, b'i(USA)100-SS ID003-05V271-36 15NOV11 0F08')] * 5
+)
+
+
+def distinct_frames(n):
+    """`n` frames from SAMPLE with a 3-byte counter added to their data, so
+    no two are the same and nothing is gained by remembering frames already
+    checked
+    """
+
+    frames = []
+    for i in range(n):
+        frame = SAMPLE[i % len(SAMPLE)]
+        frames.append(id003.encode_frame(frame[2], frame[3:-2] + i.to_bytes(3, 'big')))
+    return frames
+
+
+def rate(func, frames, min_time=0.5):
+    """Call `func` over `frames` until `min_time` passes, return frames/s"""
+
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func(frames)
+        count += len(frames)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return count / elapsed
+
+
+def run(min_time=0.5):
+    """Run all CRC benchmarks, returns a dict of name -> frames/s"""
+
+    bodies = [f[:-2] for f in SAMPLE]
+    distinct = distinct_frames(len(SAMPLE) * 100)
+    assert len(set(distinct)) == len(distinct)
+    capture = b''.join(distinct)
+    n_capture = len(distinct)
+
+    for body in bodies:
+        assert legacy_get_crc(body) == id003.get_crc(body)
+    assert all(id003.verify_many(capture))
+
+    def legacy(frames):
+        for body in frames:
+            legacy_get_crc(body)
+
+    def current(frames):
+        get_crc = id003.get_crc
+        for body in frames:
+            get_crc(body)
+
+    def incremental(frames):
+        CRC = id003.CRC
+        for frame in frames:
+            CRC().update(frame).is_valid()
+
+    def bulk(frames):
+        id003.verify_many(capture)
+
+    results = {
+        'crc.legacy_get_crc': rate(legacy, bodies, min_time),
+        'crc.get_crc': rate(current, bodies, min_time),
+        'crc.incremental': rate(incremental, SAMPLE, min_time),
+    }
+    # `bulk` ignores its argument and always checks the whole capture
+    results['crc.verify_many'] = rate(bulk, range(n_capture), min_time)
+    return results
+
+
+def main():
+    results = run()
+    base = results['crc.legacy_get_crc']
+    for name, value in results.items():
+        print("{:<24}{:>14,.0f} frames/s  ({:.1f}x)".format(name, value, value / base))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+BillValFleet CPU benchmark
+
+Polls 16, 64 and 256 `sim003` virtual acceptors from one `BillValFleet`
+and reports the fleet thread's CPU time per device. The acceptors are served
+from a separate thread, so only the controller side is measured. POSIX only.
+"""
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import logging
+import threading
+import time
+
+import id003
+import sim003
+
+
+def run_fleet(n, duration=3.0, interval=0.2):
+    """Poll `n` virtual acceptors for `duration` seconds. Returns a dict with
+    the fleet's CPU use per device and the achieved poll rate
+    """
+
+    server = sim003.AcceptorServer()
+    bvs = []
+    for _ in range(n):
+        acceptor = server.add(sim003.VirtualAcceptor(power_up=id003.IDLE))
+        bv = id003.BillVal(acceptor.port)
+        bv.bv_on = True
+        bv.bv_status = (id003.IDLE, b'')  # no handler output
+        bvs.append(bv)
+    server.start()
+
+    # fixed rate, so the numbers stay comparable with the adaptive interval off
+    fleet = id003.BillValFleet(bvs, interval=interval, fast=interval, slow=interval)
+    stopper = threading.Timer(duration, fleet.stop)
+    stopper.start()
+
+    cpu_start = time.thread_time()
+    fleet.run()
+    cpu = time.thread_time() - cpu_start
+
+    fleet.close()
+    server.stop()
+    polls = sum(acceptor.commands[id003.STATUS_REQ] for acceptor in server.acceptors)
+    for acceptor in server.acceptors:
+        acceptor.close()
+
+    return {
+        'devices': n,
+        'cpu_ms_per_device_s': cpu / duration / n * 1000,
+        'polls_per_device_s': polls / duration / n,
+    }
+
+
+def run(sizes=(16, 64, 256), duration=3.0):
+    results = {}
+    for n in sizes:
+        r = run_fleet(n, duration)
+        results['fleet.%d.cpu_ms_per_device_s' % n] = r['cpu_ms_per_device_s']
+        results['fleet.%d.polls_per_device_s' % n] = r['polls_per_device_s']
+    return results
+
+
+def main():
+    logging.disable(logging.INFO)
+    for n in (16, 64, 256):
+        r = run_fleet(n)
+        print("{devices:>4} devices: {cpu_ms_per_device_s:6.3f} ms CPU per device per second, "
+              "{polls_per_device_s:.2f} polls/s each".format(**r))
+
+
+if __name__ == '__main__':
+    main()
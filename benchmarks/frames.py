@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Frame encode and decode benchmark
+
+Encodes with `BillVal.send_command()` and decodes with `FrameDecoder` and
+`BillVal.read_response()`, all in memory. Results are in frames per second.
+"""
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import time
+
+import id003
+import sim003
+
+from loopback import memory_bill_val
+
+
+def rate(func, n, min_time=0.5):
+    """Call `func(n)` until `min_time` passes, return calls of n per second"""
+
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func(n)
+        count += n
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return count / elapsed
+
+
+class NullPort:
+    def write(self, data):
+        return len(data)
+
+
+def run(min_time=0.5):
+    """Run all frame benchmarks, returns a dict of name -> frames/s"""
+
+    acceptor = sim003.VirtualAcceptor(power_up=id003.IDLE)
+    bv = memory_bill_val(acceptor)
+    port = bv.com
+
+    frames = [id003.encode_frame(id003.IDLE), id003.encode_frame(id003.ESCROW, bytes([id003.DENOM_4])),
+              id003.encode_frame(id003.REJECTING, bytes([id003.INSERTION_ERR]))] * 100
+    stream = b''.join(frames)
+
+    def encode(n):
+        send_command = bv.send_command
+        for _ in range(n):
+            send_command(id003.STATUS_REQ)
+
+    def decode_stream(n):
+        decoder = id003.FrameDecoder()
+        # fed in 64-byte chunks, roughly what a USB serial adapter delivers
+        for i in range(0, len(stream), 64):
+            decoder.feed(stream[i:i + 64])
+            for frame in decoder:
+                pass
+
+    def read_response(n):
+        port.rx += stream
+        read = bv.read_response
+        for _ in range(n):
+            read()
+
+    bv.com = NullPort()
+    results = {'frames.encode': rate(encode, 1000, min_time)}
+    results['frames.decode_stream'] = rate(decode_stream, len(frames), min_time)
+    bv.com = port
+    results['frames.read_response'] = rate(read_response, len(frames), min_time)
+
+    acceptor.close()
+    return results
+
+
+def main():
+    for name, value in run().items():
+        print("{:<24}{:>14,.0f} frames/s".format(name, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+In-memory stand-in for a serial port, answered by a `sim003.VirtualAcceptor`
+
+Swapping it in for `BillVal.com` measures the protocol code without the
+kernel's pty and tty layers in the way.
+"""
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import id003
+
+
+class MemoryPort:
+    """Enough of `serial.Serial` for `BillVal`. Every write is handed straight
+    to the acceptor and its responses are readable immediately.
+
+    If `limit` is set, `Exhausted` is raised once that many status requests
+    have been written, to stop `BillVal.poll()`.
+    """
+
+    def __init__(self, acceptor, limit=None):
+        self.acceptor = acceptor
+        self.port = 'memory'
+        self.timeout = 0.05
+        self.rx = bytearray()
+        self.limit = limit
+
+    @property
+    def in_waiting(self):
+        return len(self.rx)
+
+    def write(self, data):
+        if self.limit is not None:
+            if self.acceptor.commands[id003.STATUS_REQ] >= self.limit:
+                raise Exhausted()
+        for frame in self.acceptor.receive(data):
+            self.rx += frame
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        return data
+
+    def close(self):
+        pass
+
+
+class Exhausted(Exception):
+    """MemoryPort reached its status request limit"""
+    pass
+
+
+def memory_bill_val(acceptor, limit=None):
+    """A `BillVal` talking to `acceptor` through a MemoryPort. The acceptor's
+    pty is only used to construct the BillVal.
+    """
+
+    bv = id003.BillVal(acceptor.port)
+    bv.com.close()
+    bv.com = MemoryPort(acceptor, limit)
+    bv.bv_on = True
+    return bv
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Poll round-trip benchmark
+
+Measures the latency distribution of `BillVal.req_status()` round-trips
+against a `sim003` virtual acceptor, both over a pseudo-terminal and in
+memory, and the rate at which `BillVal.poll()` can dispatch status change
+handlers.
+"""
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import time
+import logging
+
+import id003
+import sim003
+
+from loopback import memory_bill_val, Exhausted
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    samples = sorted(samples)
+    result = {}
+    for p in points:
+        result['p%d' % p] = samples[min(len(samples) - 1, len(samples) * p // 100)]
+    result['max'] = samples[-1]
+    return result
+
+
+def round_trips(bv, n):
+    """Time `n` status requests, returns latencies in microseconds"""
+
+    req_status = bv.req_status
+    clock = time.perf_counter
+    samples = []
+    for _ in range(n):
+        start = clock()
+        req_status()
+        samples.append((clock() - start) * 1e6)
+    return samples
+
+
+def run(n=500):
+    """Run all poll benchmarks, returns a dict of name -> value"""
+
+    results = {}
+
+    acceptor = sim003.VirtualAcceptor(power_up=id003.IDLE).start()
+    bv = id003.BillVal(acceptor.port)
+    bv.bv_on = True
+    round_trips(bv, 20)  # warm up
+    for k, v in percentiles(round_trips(bv, n)).items():
+        results['poll.rtt_pty.%s_us' % k] = v
+    bv.com.close()
+    acceptor.close()
+
+    acceptor = sim003.VirtualAcceptor(power_up=id003.IDLE)
+    bv = memory_bill_val(acceptor)
+    for k, v in percentiles(round_trips(bv, n * 10)).items():
+        results['poll.rtt_memory.%s_us' % k] = v
+
+    # alternates STACKER_OPEN and IDLE, so every poll fires a handler
+    polls = n * 20
+    acceptor.scenario.extend([('error', id003.STACKER_OPEN, 1)] * polls)
+    bv.com.limit = acceptor.commands[id003.STATUS_REQ] + polls
+    start = time.perf_counter()
+    try:
+        bv.poll(interval=0.0)
+    except Exhausted:
+        pass
+    results['poll.dispatch_per_s'] = polls / (time.perf_counter() - start)
+    acceptor.close()
+
+    return results
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    for name, value in run().items():
+        print("{:<32}{:>14,.1f}".format(name, value))
+
+
+if __name__ == '__main__':
+    main()
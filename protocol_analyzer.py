@@ -8,6 +8,7 @@ sys.ps1 = ''
 sys.ps2 = ''
 
 import id003
+import capture
 import termutils as t
 
 import time
@@ -18,14 +19,27 @@ import threading
 import serial.tools.list_ports
 from serial.serialutil import SerialException
 
+import collections
 from collections import OrderedDict
 
-X_SIZE, Y_SIZE = t.get_size()
+# menus and settings pages are drawn through this, see termutils.Screen
+screen = t.Screen()
 
 CONFIG_FILE = 'bv.ini'
 CONFIG = configparser.ConfigParser()
 CONFIG.read(CONFIG_FILE)
 
+log_listener = None  # from id003.configure_logging(), see __main__
+
+# one row per bill validator on the dashboard
+DASH_COLUMNS = "{:<16.16} {:<15.15} {:<23.23} {:>7} {:>16} {:>5} {:>4} {:>4}  {}"
+DASH_HEADER = DASH_COLUMNS.format("Port", "Status", "Last event", "Polls/s", "RTT p50/90/99 ms",
+                                  "T/O", "CRC", "Err", "Escrow")
+
+# statuses a bill goes through between escrow and being stacked or returned
+DASH_ESCROW_STATES = (id003.ESCROW, id003.HOLDING, id003.STACKING, id003.VEND_VALID,
+                      id003.STACKED, id003.RETURNING)
+
 
 def get_denoms():
     denom = 0
@@ -59,13 +73,45 @@ def get_optional():
     return [opt, 0]
 
 
+class PromptLock:
+    """Holds `lock` while a console prompt asks its question, and gets the
+    keyboard loop off the terminal meanwhile: its key reader is woken up
+    and suspended, with the terminal in line mode for input(), until the
+    prompt is done
+    """
+    
+    def __init__(self, lock):
+        self.lock = lock
+        
+    def __enter__(self):
+        self.lock.acquire()
+        if os.name == 'posix':
+            t.key_reader().interrupt()
+        return self
+        
+    def __exit__(self, *exc):
+        if os.name == 'posix':
+            t.key_reader().resume()
+        self.lock.release()
+
+
 def kb_loop(bv, stdout_lock, bv_lock):
     global CONFIG
 
     print("Press Q at any time to quit, or H for help")
     while True:
-        with stdout_lock:
-            opt = t.get_key(0.1)
+        if os.name == 'posix':
+            # sleeps until a key is pressed, or a console prompt wakes it
+            # up to have the keyboard to itself (see PromptLock)
+            opt = t.key_reader().read()
+            if opt is None:
+                # wait for the prompt to finish
+                with stdout_lock:
+                    pass
+                continue
+        else:
+            with stdout_lock:
+                opt = t.get_key(0.1)
         if opt is not None:
             opt = opt.lower()
         if opt == b'q':
@@ -90,11 +136,11 @@ def kb_loop(bv, stdout_lock, bv_lock):
         elif opt == b'r':
             with bv_lock:
                 logging.debug("Sending reset command")
-                status = None
-                while status != id003.ACK:
-                    bv.send_command(id003.RESET)
-                    status, data = bv.read_response()
-                    time.sleep(0.2)
+                try:
+                    bv.transact(id003.RESET)
+                except id003.CommandTimeout as e:
+                    logging.error("Reset failed: %s" % e)
+                    continue
                 logging.debug("Received ACK")
                 
                 if bv.req_status()[0] == id003.INITIALIZE:
@@ -103,13 +149,41 @@ def kb_loop(bv, stdout_lock, bv_lock):
                     dir = get_directions()
                     opt = get_optional()
                     logging.info("Initializing bill validator")
-                    bv.initialize(denom, sec, dir, opt)
+                    bv.initialize(denom, sec, dir, opt, only_changed=True)
                     
                 bv.bv_status = None
         elif opt == b'p':
             print("Not implemented yet")
 
 
+class LockedScheduler(id003.PollScheduler):
+    """`PollScheduler` that holds `lock` from the start of each poll until
+    the next one is scheduled, so the keyboard loop can take it to talk to
+    the bill validator in between
+    """
+    
+    def __init__(self, lock, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = lock
+        self.held = False
+        
+    def start(self):
+        # still held if the last poll was cut short to reconnect
+        if not self.held:
+            self.lock.acquire()
+            self.held = True
+        return super().start()
+        
+    def schedule(self, status):
+        self.release()
+        return super().schedule(status)
+        
+    def release(self):
+        if self.held:
+            self.held = False
+            self.lock.release()
+
+
 def poll_loop(bv, stdout_lock, bv_lock, interval=0.2):
     denom = get_denoms()
     sec = get_security()
@@ -117,7 +191,7 @@ def poll_loop(bv, stdout_lock, bv_lock, interval=0.2):
     opt = get_optional()
     
     print("Please connect bill validator.")
-    bv.power_on(denom, sec, dir, opt)
+    bv.power_on(denom, sec, dir, opt, only_changed=True)
     
     if bv.init_status == id003.POW_UP:
         logging.info("BV powered up normally.")
@@ -126,53 +200,320 @@ def poll_loop(bv, stdout_lock, bv_lock, interval=0.2):
     elif bv.init_status == id003.POW_UP_BIS:
         logging.info("BV powered up with bill in stacker.")
 
-    while True:
-        poll_start = time.time()
-        if not bv.bv_on:
-            return
-        with bv_lock:
-            status, data = bv.req_status()
-            if (status, data) != bv.bv_status and status in bv.bv_events:
-                if stdout_lock.acquire(timeout=0.5):
-                    bv.bv_events[status](data)
+    # handlers print, so they wait for the console like everything else, and
+    # are skipped rather than holding up polling while a prompt is open
+    def console(handler):
+        def handle(data):
+            if stdout_lock.acquire(timeout=0.5):
+                try:
+                    return handler(data)
+                finally:
                     stdout_lock.release()
-        bv.bv_status = (status, data)
-        wait = interval - (time.time() - poll_start)
-        if wait > 0.0:
-            time.sleep(wait)
+        return handle
+    bv.bv_events = {status: console(handler) for status, handler in bv.bv_events.items()}
+    
+    jitter = bv.metrics.poll_jitter(bv.port) if bv.metrics is not None else None
+    scheduler = LockedScheduler(bv_lock, interval, jitter=jitter)
+    try:
+        bv.poll(interval, scheduler)
+    finally:
+        scheduler.release()
+
+
+class DeviceWatch:
+    """One bill validator on the dashboard, as the render thread sees it.
+    The fleet thread publishes status changes to `events` and the render
+    thread takes them in with `update()` once a frame, so nothing here is
+    shared and drawing never holds up polling. Times are those of the frame
+    that saw a change, so good to 1/fps.
+    """
+    
+    def __init__(self, port, bv=None, state="powering up"):
+        self.port = port
+        self.bv = bv
+        self.events = bv.subscribe(policy=id003.COALESCE) if bv is not None else None
+        self.thread = None  # powering up or reconnecting, off the fleet thread
+        self.state = state  # shown instead of the status while not polling
+        # (time.monotonic() it started, status, data) of the current status,
+        # and of the last one before it that wasn't IDLE
+        self.current = None
+        self.last_event = None
+        self.escrow = None  # (time.monotonic(), bill) from ESCROW until the bill is through
+        self.errors = 0  # error statuses entered
+        
+        self.rate = None  # polls per second
+        self._scheduler = None  # bv.scheduler, whose polls are counted
+        self._polls = 0
+        self._polls_at = time.monotonic()
+        
+    def update(self, now):
+        """Take in the status changes published since the last frame"""
+        
+        events = self.events
+        if events is None:
+            return
+        for _ in range(events.depth):
+            event = events.get(0)
+            status = event.status
+            if self.current is not None and self.current[1] != id003.IDLE:
+                self.last_event = self.current
+            self.current = (now, status, event.data)
+            if status == id003.ESCROW:
+                self.escrow = (now, event.name or event.data[:1].hex())
+            elif status not in DASH_ESCROW_STATES:
+                self.escrow = None
+            if status in id003.ERROR_STATUSES:
+                self.errors += 1
+
+
+def dashboard_join(watch, ready, settings=None):
+    """Power up `watch`'s bill validator, or without `settings` reconnect
+    it, and put it on `ready` for the fleet thread to poll. Runs on a thread
+    of its own, as both block.
+    """
+    
+    bv = watch.bv
+    try:
+        if settings is not None:
+            bv.power_on(*settings, only_changed=True)
+        elif not bv.reconnect("dropped from the fleet"):
+            watch.state = "stopped"
+            return
+    except Exception:
+        logging.exception("Stopped polling %s", watch.port)
+        watch.state = "stopped"
+        return
+    if bv.bv_on:
+        ready.append(watch)
+
+
+def dashboard_fleet(fleet, watches, ready, stop):
+    """Poll every bill validator put on `ready` with `fleet`, all on this
+    thread, until `stop` is set. One whose port fails is reconnected by
+    `dashboard_join()` and comes back the same way.
+    """
+    
+    watch_for = {watch.bv: watch for watch in watches if watch.bv is not None}
+    while not stop.is_set():
+        while ready:
+            watch = ready.popleft()
+            fleet.add(watch.bv)
+            watch.state = None
+        fleet.step()
+        while fleet.lost:
+            watch = watch_for[fleet.lost.pop()]
+            watch.state = "reconnecting"
+            watch.thread = threading.Thread(target=dashboard_join, args=(watch, ready), daemon=True)
+            watch.thread.start()
+
+
+def event_text(bv, status, data):
+    event = bv.decode_event(status, data)
+    if isinstance(event, id003.Escrow) and event.name is not None:
+        return "Escrow %s" % event.name
+    return type(event).__name__
+
+
+def dashboard_row(watch, now):
+    """Format `watch`'s row of the dashboard and pick a color for it. The
+    bill validator's state is read one attribute or lookup at a time
+    without locking, so a value may be a poll behind the others.
+    """
+    
+    bv = watch.bv
+    state = watch.state
+    current = watch.current
+    if bv is None or state is not None or current is None:
+        color = 'RED' if state in ("can't open port", "stopped") else 'YELLOW'
+        return DASH_COLUMNS.format(watch.port, state or "powering up", '', '', '', '', '', '', ''), color
+    
+    status = event_text(bv, current[1], current[2])
+    
+    last = watch.last_event
+    if last is not None:
+        last = "%s, %.0f s ago" % (event_text(bv, last[1], last[2]), now - last[0])
+    
+    scheduler = bv.scheduler
+    if scheduler is not watch._scheduler:
+        # the fleet gives it a new one each time it's added
+        watch._scheduler, watch._polls_at = scheduler, now
+        watch._polls = scheduler.polls if scheduler is not None else 0
+    elif scheduler is not None and now - watch._polls_at >= 1.0:
+        polls = scheduler.polls
+        watch.rate = (polls - watch._polls) / (now - watch._polls_at)
+        watch._polls, watch._polls_at = polls, now
+    rate = '%.1f' % watch.rate if watch.rate is not None else ''
+    
+    rtt = timeouts = crc = ''
+    metrics = bv.metrics
+    if metrics is not None:
+        # histogram bucket bounds, so p99 is "no more than"
+        hist = metrics.latency.get((bv.port, id003.STATUS_REQ))
+        if hist is not None and hist.count:
+            rtt = '/'.join('%g' % (hist.quantile(q) * 1000) for q in (0.5, 0.9, 0.99))
+        timeouts = metrics.timeouts.get((bv.port, id003.STATUS_REQ), 0)
+        decoder = metrics.decoders.get(bv.port)
+        crc = decoder.crc_errors if decoder is not None else ''
+    
+    escrow = watch.escrow
+    if escrow is not None:
+        pending = bv.pending
+        if pending is not None and pending.kind == 'escrow':
+            escrow = "%s, deciding %.1f s" % (escrow[1], now - pending.started)
+        else:
+            escrow = "%s, %s %.1f s" % (escrow[1], status, now - escrow[0])
+    
+    if current[1] is None or current[1] in id003.ERROR_STATUSES:
+        color = 'RED'
+    elif escrow is not None:
+        color = 'YELLOW'
+    else:
+        color = None
+    text = DASH_COLUMNS.format(watch.port, status, last or '', rate, rtt, timeouts, crc,
+                               watch.errors, escrow or '')
+    return text, color
+
+
+def draw_dashboard(watches, now):
+    height = t.get_size()[1]
+    for watch in watches:
+        watch.update(now)
+    screen.clear()
+    display_header("ID-003 dashboard: %d bill validators" % len(watches))
+    screen.write(1, 3, DASH_HEADER, bright=True)
+    for y, watch in enumerate(watches, 4):
+        text, color = dashboard_row(watch, now)
+        screen.write(1, y, text, fg=color)
+    x, y = screen.write(1, height, "Q - Quit   M - Main menu   (log in debug.log)")
+    screen.move(x, y)
+    screen.render()
+
+
+def dashboard_ports():
+    """The comports to show on the dashboard: `dashboard_ports` in the
+    config, 'auto' for every USB serial port, or just `comport`
+    """
+    
+    ports = CONFIG['main'].get('dashboard_ports', fallback='').replace(',', ' ').split()
+    if ports == ['auto']:
+        return [p.device for p in serial.tools.list_ports.comports() if p.vid is not None]
+    return ports or [CONFIG['main']['comport']]
+
+
+def dashboard(ports, interval, fps=4.0):
+    """Poll every port in `ports` from one `BillValFleet` thread and show
+    them all, one row each, redrawn `fps` times a second from this thread.
+    Nobody is asked anything: escrow is stacked or returned as
+    `dashboard_escrow` says and resets are left to the Run mode. Returns
+    True to quit. POSIX only, as the fleet is.
+    """
+    
+    settings = (get_denoms(), get_security(), get_directions(), get_optional())
+    if CONFIG['main'].get('dashboard_escrow', fallback='return').lower() == 'stack':
+        action = id003.STACK_1
+    else:
+        action = id003.RETURN
+    
+    # the dashboard has the screen to itself, the log is still in debug.log
+    console = log_listener.console if log_listener is not None else None
+    if console is not None:
+        console_level = console.level
+        console.setLevel(logging.CRITICAL + 1)
+        
+    watches = []
+    fleet = id003.BillValFleet(interval=interval)
+    ready = collections.deque()  # powered up or reconnected, for the fleet to take
+    stop = threading.Event()
+    fleet_thread = None
+    key = None
+    try:
+        for port in ports:
+            try:
+                bv = id003.BillVal(port, threading=True)
+            except SerialException as e:
+                logging.error("Unable to open %s: %s" % (port, e))
+                watches.append(DeviceWatch(port, state="can't open port"))
+                continue
+            bv.escrow_decider = lambda escrow, barcode: id003.completed(action)
+            bv.confirm = lambda prompt: id003.completed(False)
+            watches.append(DeviceWatch(port, bv))
+            
+        fleet_thread = threading.Thread(target=dashboard_fleet, args=(fleet, watches, ready, stop),
+                                        daemon=True)
+        fleet_thread.start()
+        # powering up blocks, so each gets a thread until it's up
+        for watch in watches:
+            if watch.bv is not None:
+                watch.thread = threading.Thread(target=dashboard_join, args=(watch, ready, settings),
+                                                daemon=True)
+                watch.thread.start()
+            
+        get_key = t.key_reader().read
+        frame = 1.0 / fps
+        next_frame = time.monotonic()
+        screen.invalidate()
+        while key not in (b'q', b'm'):
+            now = time.monotonic()
+            if now >= next_frame:
+                draw_dashboard(watches, now)
+                # a fixed rate however long drawing took, skipping frames
+                # rather than catching up
+                next_frame = max(next_frame + frame, now)
+            key = get_key(max(next_frame - time.monotonic(), 0.0))
+            if key is not None:
+                key = key.lower()
+    finally:
+        for watch in watches:
+            if watch.bv is not None:
+                watch.bv.bv_on = False
+        stop.set()
+        if fleet_thread is not None:
+            fleet_thread.join(interval + 1.0)
+        fleet.close()
+        for watch in watches:
+            if watch.thread is not None:
+                watch.thread.join(1.0)
+            if watch.bv is not None:
+                # the ones not in the fleet when it stopped
+                watch.events.close()
+                watch.bv.com.close()
+        if console is not None:
+            console.setLevel(console_level)
+        t.wipe()
+        
+    return key == b'q'
 
 
 def display_header(text):
-    t.set_pos(0, 0)
-    print(text.center(X_SIZE), end='')
-    print('=' * X_SIZE, end='')
+    width = t.get_size()[0]
+    screen.write(1, 1, text.center(width))
+    screen.write(1, 2, '=' * width)
 
 
 def display_menu(menu, prompt='>>>', header='', info=''):
-    if len(menu) > Y_SIZE - 5:
+    if len(menu) > t.get_size()[1] - 5:
         raise ValueError("Too many menu options")
     
-    # print the header
-    t.wipe()
+    # draw the header, menu items, prompt and info as a new page
+    screen.invalidate()
+    screen.clear()
     display_header(header)
-    
-    # print the menu items
+    y = 3
     for k, v in menu.items():
-        print("{}) {}".format(k, v))
-        
-    # print prompt and info
-    print(prompt, end=' ')
-    x, y = t.get_pos()
-    print('\n\n' + info)
-    t.set_pos(x, y)
+        screen.write(1, y, "{}) {}".format(k, v))
+        y += 1
+    x, y = screen.write(1, y, prompt + ' ')
+    screen.write(1, y + 2, info)
+    screen.move(x, y)
+    screen.render()
     
     # get user's choice
     k = None
     while k not in menu:
-        k = input('')
-        t.set_pos(x, y)
-        print(' ' * (X_SIZE - x), end='')
-        t.set_pos(x, y)
+        k = t.read_line('')
+        # input() echoed the answer and a newline, put the prompt back
+        screen.invalidate([y, y + 1])
+        screen.render()
     
     return k
     
@@ -180,8 +521,6 @@ def display_menu(menu, prompt='>>>', header='', info=''):
 def settings():
     global CONFIG
     
-    t.wipe()
-    
     settings_menu = OrderedDict()
     settings_menu['e'] = "Denomination enable/inhibit"
     settings_menu['s'] = "Denomination security"
@@ -204,334 +543,117 @@ def settings():
     elif choice == 'b':
         t.wipe()
         print("Barcode settings not available.")
-        input("Press enter to go back")
+        t.read_line("Press enter to go back")
     
     return
 
 
-def opt_settings():
+def toggle_settings(header, section, labels, legend):
+    """Let the user switch each option in CONFIG[section] on (X) or off
+    (space), moving between them with the arrow keys or Tab. `labels` maps
+    each option to the text in front of it. Enter saves and goes back, Esc
+    goes back without saving.
+    """
     global CONFIG
     
-    t.wipe()
-    display_header("Optional function settings")
-    
-    opts = dict()
-    set_opts = OrderedDict()
-    opt_txt = {
-        'power_recovery': "Power recovery:\t\t\t\t",
-        'auto_retry': "Auto-retry operaton:\t\t\t",
-        '24_char_barcode': "Accept 24-character barcodes:\t\t",
-        'near_full': "Stacker nearly full event:\t\t",
-        'entrance_event': "Entrance sensor event:\t\t\t",
-        'encryption': "Encryption:\t\t\t\t",
-    }
-    
-    for i, k in enumerate(CONFIG['bv.optional'].keys()):
-        opt_enabled = CONFIG['bv.optional'].getboolean(k)
-        opts[i] = k
-        set_opts[k] = opt_enabled
-        
-        print(opt_txt[k], end='')
-        start_x, start_y = t.get_pos()
-        if opt_enabled:
-            print('X')
-        else:
-            print('_')
-            
-    print("\n\n_ = disabled, X = enabled")
-    print("\nPress Enter to save and go back, or Esc to go back without saving")
-    t.set_pos(start_x, 3)
-    
-    max_opt = len(CONFIG['bv.optional']) - 1
-    cur_opt = 0
-    while True:
-        x, y = t.get_pos()
-        c = t.getch()
-        
-        if c == b'\xe0H' and cur_opt > 0:
-            # up
-            t.set_pos(x, y-1)
-            cur_opt -= 1
-        elif c == b'\xe0P' and cur_opt < max_opt:
-            # down
-            t.set_pos(x, y+1)
-            cur_opt += 1
-        elif c == b'\t' and cur_opt == max_opt:
-            # wrap around to first option
-            t.set_pos(x, 3)
-            cur_opt = 0
-        elif c == b'\t':
-            # next option, same as down
-            t.set_pos(x, y+1)
-            cur_opt += 1
-        elif c == b'X' or c == b'x':
-            set_opts[opts[cur_opt]] = True
-            print('X', end='')
-            if cur_opt < max_opt:
-                t.set_pos(x, y+1)
-                cur_opt += 1
-            else:
-                t.set_pos(x, y)
-        elif c == b' ':
-            set_opts[opts[cur_opt]] = False
-            print('_', end='')
-            if cur_opt < max_opt:
-                t.set_pos(x, y+1)
-                cur_opt += 1
-            else:
-                t.set_pos(x, y)
-        elif c == b'\r':
-            # save and go back
-            CONFIG['bv.optional'] = set_opts
-            return
-        elif c == b'\x1b':
-            # escape, go back without saving
-            return
-    
-    
-def direction_settings():
-    global CONFIG
-    
-    t.wipe()
-    display_header("Direction ihibit settings")
+    screen.invalidate()
+    screen.clear()
+    display_header(header)
     
-    opts = dict()
-    set_opts = OrderedDict()
-    for i, k in enumerate(CONFIG['bv.direction'].keys()):
-        dir_enabled = CONFIG['bv.direction'].getboolean(k)
-        opts[i] = k
-        set_opts[k] = dir_enabled
+    keys = list(CONFIG[section].keys())
+    set_opts = OrderedDict()    # cache settings before writing to config
+    marks = []  # where each option's X or _ is
+    for i, k in enumerate(keys):
+        set_opts[k] = CONFIG[section].getboolean(k)
+        x, y = screen.write(1, 3 + i, labels.get(k, k + ':\t\t\t'))
+        screen.write(x, y, 'X' if set_opts[k] else '_')
+        marks.append((x, y))
         
-        if k == 'fa':
-            print("Front side up, left side in:\t\t", end='')
-        elif k == 'fb':
-            print("Front side up, right side in:\t\t", end='')
-        elif k == 'bb':
-            print("Back side up, left side in:\t\t", end='')
-        elif k == 'ba':
-            print("Back side up, right side in:\t\t", end='')
-            
-        start_x, start_y = t.get_pos()
-        if dir_enabled:
-            print('X')
-        else:
-            print('_')
-            
-    print("\n\n_ = enabled, X = inhibited")
-    print("\nPress Enter to save and go back, or Esc to go back without saving")
-    t.set_pos(start_x, 3)
+    screen.write(1, 3 + len(keys) + 2, legend + "\n\n"
+                 "Press Enter to save and go back, or Esc to go back without saving")
     
-    max_opt = len(CONFIG['bv.direction']) - 1
+    max_opt = len(keys) - 1
     cur_opt = 0
     while True:
-        x, y = t.get_pos()
+        screen.move(*marks[cur_opt])
+        screen.render()
         c = t.getch()
         
         if c == b'\xe0H' and cur_opt > 0:
             # up
-            t.set_pos(x, y-1)
             cur_opt -= 1
         elif c == b'\xe0P' and cur_opt < max_opt:
             # down
-            t.set_pos(x, y+1)
             cur_opt += 1
         elif c == b'\t' and cur_opt == max_opt:
             # wrap around to first option
-            t.set_pos(x, 3)
             cur_opt = 0
         elif c == b'\t':
             # next option, same as down
-            t.set_pos(x, y+1)
             cur_opt += 1
-        elif c == b'X' or c == b'x':
-            set_opts[opts[cur_opt]] = True
-            print('X', end='')
-            if cur_opt < max_opt:
-                t.set_pos(x, y+1)
-                cur_opt += 1
-            else:
-                t.set_pos(x, y)
-        elif c == b' ':
-            set_opts[opts[cur_opt]] = False
-            print('_', end='')
+        elif c == b'X' or c == b'x' or c == b' ':
+            enabled = c != b' '
+            set_opts[keys[cur_opt]] = enabled
+            screen.write(*marks[cur_opt], 'X' if enabled else '_')
             if cur_opt < max_opt:
-                t.set_pos(x, y+1)
                 cur_opt += 1
-            else:
-                t.set_pos(x, y)
         elif c == b'\r':
             # save and go back
-            CONFIG['bv.direction'] = set_opts
+            CONFIG[section] = set_opts
             return
         elif c == b'\x1b':
             # escape, go back without saving
             return
 
+
+def denom_labels(section):
+    """Labels for the denominations in CONFIG[section], for toggle_settings()"""
     
-def security_settings():
-    global CONFIG
-    
-    t.wipe()
-    display_header("Denomination security settings")
-    
-    opts = dict()
-    set_opts = OrderedDict()
-    for i, k in enumerate(CONFIG['bv.security'].keys()):
+    labels = {}
+    for k in CONFIG[section].keys():
         if id003.DENOM_MAP[k] in id003.ESCROW_USA:
-            denom = id003.ESCROW_USA[id003.DENOM_MAP[k]]
-        else:
-            denom = None
-            
-        denom_enabled = CONFIG['bv.security'].getboolean(k)
-        opts[i] = k
-        set_opts[k] = denom_enabled
-        
-        if denom is not None:
-            line = k + ' (' + denom + '):\t\t'
-        else:
-            line = k + ':\t\t\t'
-        
-        if denom_enabled:
-            line += 'X'
+            labels[k] = k + ' (' + id003.ESCROW_USA[id003.DENOM_MAP[k]] + '):\t\t'
         else:
-            line += '_'
-            
-        print(line)
-    
-    print("\n\nX = high security, _ = low security")
-    print("\nPress Enter to save and go back, or Esc to go back without saving")
-    t.set_pos(25, 3)
-    
-    max_opt = len(CONFIG['bv.security']) - 1
-    cur_opt = 0
-    while True:
-        x, y = t.get_pos()
-        c = t.getch()
-        
-        if c == b'\xe0H' and cur_opt > 0:
-            # up
-            t.set_pos(x, y-1)
-            cur_opt -= 1
-        elif c == b'\xe0P' and cur_opt < max_opt:
-            # down
-            t.set_pos(x, y+1)
-            cur_opt += 1
-        elif c == b'\t' and cur_opt == max_opt:
-            # wrap around to first option
-            t.set_pos(x, 3)
-            cur_opt = 0
-        elif c == b'\t':
-            # next option, same as down
-            t.set_pos(x, y+1)
-            cur_opt += 1
-        elif c == b'X' or c == b'x':
-            set_opts[opts[cur_opt]] = True
-            print('X', end='')
-            if cur_opt < max_opt:
-                t.set_pos(x, y+1)
-                cur_opt += 1
-            else:
-                t.set_pos(x, y)
-        elif c == b' ':
-            set_opts[opts[cur_opt]] = False
-            print('_', end='')
-            if cur_opt < max_opt:
-                t.set_pos(x, y+1)
-                cur_opt += 1
-            else:
-                t.set_pos(x, y)
-        elif c == b'\r':
-            # save and go back
-            CONFIG['bv.security'] = set_opts
-            return
-        elif c == b'\x1b':
-            # escape, go back without saving
-            return
-            
-    
-    
-def denom_settings():
-    global CONFIG
-    
-    t.wipe()
-    display_header("Denomination enable/inhibit settings")
+            labels[k] = k + ':\t\t\t'
+    return labels
+
+
+def opt_settings():
+    opt_txt = {
+        'power_recovery': "Power recovery:\t\t\t\t",
+        'auto_retry': "Auto-retry operaton:\t\t\t",
+        '24_char_barcode': "Accept 24-character barcodes:\t\t",
+        'near_full': "Stacker nearly full event:\t\t",
+        'entrance_event': "Entrance sensor event:\t\t\t",
+        'encryption': "Encryption:\t\t\t\t",
+    }
+    toggle_settings("Optional function settings", 'bv.optional', opt_txt,
+                    "_ = disabled, X = enabled")
     
-    opts = dict()
-    set_opts = OrderedDict()
-    for i, k in enumerate(CONFIG['bv.denom_inhibit'].keys()):
-        if id003.DENOM_MAP[k] in id003.ESCROW_USA:
-            denom = id003.ESCROW_USA[id003.DENOM_MAP[k]]
-        else:
-            denom = None
-            
-        denom_enabled = CONFIG['bv.denom_inhibit'].getboolean(k)
-        opts[i] = k     # index into this config section
-        set_opts[k] = denom_enabled     # cache settings before writing to config
-        
-        if denom is not None:
-            line = k + ' (' + denom + '):\t\t'
-        else:
-            line = k + ':\t\t\t'
-        
-        if denom_enabled:
-            line += 'X'
-        else:
-            line += '_'
-            
-        print(line)
     
-    print("\n\nIf a denom is inhibited through these settings that's not inhibited by the\n"
-          "appropriate DIP switch on the BV, the BV will go into INHIBIT status.")
-    print("\nPress Enter to save and go back, or Esc to go back without saving")
-    t.set_pos(25, 3)
+def direction_settings():
+    dir_txt = {
+        'fa': "Front side up, left side in:\t\t",
+        'fb': "Front side up, right side in:\t\t",
+        'bb': "Back side up, left side in:\t\t",
+        'ba': "Back side up, right side in:\t\t",
+    }
+    toggle_settings("Direction ihibit settings", 'bv.direction', dir_txt,
+                    "_ = enabled, X = inhibited")
+
     
-    max_opt = len(CONFIG['bv.denom_inhibit']) - 1
-    cur_opt = 0
-    while True:
-        x, y = t.get_pos()
-        c = t.getch()
-        
-        if c == b'\xe0H' and cur_opt > 0:
-            # up
-            t.set_pos(x, y-1)
-            cur_opt -= 1
-        elif c == b'\xe0P' and cur_opt < max_opt:
-            # down
-            t.set_pos(x, y+1)
-            cur_opt += 1
-        elif c == b'\t' and cur_opt == max_opt:
-            # wrap around to first option
-            t.set_pos(x, 3)
-            cur_opt = 0
-        elif c == b'\t':
-            # next option, same as down
-            t.set_pos(x, y+1)
-            cur_opt += 1
-        elif c == b'X' or c == b'x':
-            set_opts[opts[cur_opt]] = True
-            print('X', end='')
-            if cur_opt < max_opt:
-                t.set_pos(x, y+1)
-                cur_opt += 1
-            else:
-                t.set_pos(x, y)
-        elif c == b' ':
-            set_opts[opts[cur_opt]] = False
-            print('_', end='')
-            if cur_opt < max_opt:
-                t.set_pos(x, y+1)
-                cur_opt += 1
-            else:
-                t.set_pos(x, y)
-        elif c == b'\r':
-            # save and go back
-            CONFIG['bv.denom_inhibit'] = set_opts
-            return
-        elif c == b'\x1b':
-            # escape, go back without saving
-            return
+def security_settings():
+    toggle_settings("Denomination security settings", 'bv.security', denom_labels('bv.security'),
+                    "X = high security, _ = low security")
     
     
+def denom_settings():
+    toggle_settings("Denomination enable/inhibit settings", 'bv.denom_inhibit',
+                    denom_labels('bv.denom_inhibit'),
+                    "If a denom is inhibited through these settings that's not inhibited by the\n"
+                    "appropriate DIP switch on the BV, the BV will go into INHIBIT status.")
+
+
 def main():
     global CONFIG
     
@@ -540,6 +662,8 @@ def main():
 
     main_menu = OrderedDict()
     main_menu['r'] = "Run"
+    if os.name == 'posix':
+        main_menu['d'] = "Dashboard"
     main_menu['s'] = "Settings"
     main_menu['c'] = "Select COM port"
     main_menu['q'] = "Quit"
@@ -549,21 +673,40 @@ def main():
     if choice == 'r':
         t.wipe()
         raw = CONFIG['main'].getboolean('debug')
+        if raw:
+            # binary capture of all traffic, written from a background thread
+            raw = capture.CaptureWriter(CONFIG['main'].get('capture_file', fallback='raw.cap'),
+                                        max_bytes=CONFIG['main'].getint('capture_max_mb', fallback=64) << 20,
+                                        compress=CONFIG['main'].get('capture_compress', fallback='') or None)
         try:
-            bv = id003.BillVal(comport, log_raw=raw, threading=True)
+            # device profiles, so a restart can skip powering up a validator
+            # that's already running with these settings
+            profiles = CONFIG['main'].get('profile_cache', fallback='') or None
+            bv = id003.BillVal(comport, log_raw=raw, threading=True, profiles=profiles)
         except SerialException:
+            if raw:
+                raw.close()
             print("Unable to open serial port")
             q = 'x'
             while q not in 'qm':
-                q = input("(Q)uit or (M)ain menu? ").lower()
+                q = t.read_line("(Q)uit or (M)ain menu? ").lower()
                 if q == 'q':
                     return True
                 elif q == 'm':
                     return
         
+        metrics_port = CONFIG['main'].getint('metrics_port', fallback=0)
+        if metrics_port:
+            # Prometheus scrape endpoint for latency and error counters
+            metrics_server = id003.start_metrics_server(metrics_port)
+        
         stdout_lock = threading.Lock()
         bv_lock = threading.Lock()
         
+        # ask on the console without holding up the poll thread
+        bv.escrow_decider = id003.console_escrow(PromptLock(stdout_lock))
+        bv.confirm = id003.console_confirm(PromptLock(stdout_lock))
+        
         poll_args = (bv, stdout_lock, bv_lock, poll_interval)
         poll_thread = threading.Thread(target=poll_loop, args=poll_args)
         
@@ -571,12 +714,27 @@ def main():
         kb_thread = threading.Thread(target=kb_loop, args=kb_args)
         
         poll_thread.start()
-        while bv.bv_status != (id003.IDLE, b''):
-            # wait for power-up before starting keyboard loop
-            continue
+        # wait for power-up before starting keyboard loop, checking now and
+        # then that the poll thread hasn't died on the way
+        while poll_thread.is_alive():
+            try:
+                status = bv.wait_ready(1.0)
+            except TimeoutError:
+                continue
+            except Exception:
+                break  # logged by the poll thread
+            if status is not None and status != id003.IDLE:
+                logging.warning("BV powered up with status %02x" % status)
+            break
         kb_thread.start()
         kb_thread.join()
         
+        if metrics_port:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        if raw:
+            raw.close()
+        
         if not bv.bv_on:
             # kb_thread quit, not main menu
             bv.com.close()
@@ -590,6 +748,18 @@ def main():
             del kb_thread
             del bv
             return
+    elif choice == 'd':
+        t.wipe()
+        metrics_port = CONFIG['main'].getint('metrics_port', fallback=0)
+        if metrics_port:
+            metrics_server = id003.start_metrics_server(metrics_port)
+        try:
+            return dashboard(dashboard_ports(), poll_interval,
+                             CONFIG['main'].getfloat('dashboard_fps', fallback=4.0))
+        finally:
+            if metrics_port:
+                metrics_server.shutdown()
+                metrics_server.server_close()
     elif choice == 's':
         settings()
         return
@@ -612,8 +782,15 @@ def main():
 	
 	
 if __name__ == '__main__':
-    while not main():
-        continue
-    with open(CONFIG_FILE, 'w') as f:
-        # save configuration on program exit
-        CONFIG.write(f)
\ No newline at end of file
+    # everything to debug.log, INFO and up to the console, written out from
+    # a background thread so it doesn't hold up polling
+    log_listener = id003.configure_logging(
+        'debug.log', repeat_interval=CONFIG['main'].getfloat('log_repeat_interval', fallback=10.0))
+    try:
+        while not main():
+            continue
+        with open(CONFIG_FILE, 'w') as f:
+            # save configuration on program exit
+            CONFIG.write(f)
+    finally:
+        log_listener.stop()
\ No newline at end of file
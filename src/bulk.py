@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+bulk - vectorized decoding of large ID-003 captures with NumPy
+
+For audits over whole captures, where decoding frame by frame in Python
+is too slow. Needs NumPy; nothing else in the package does.
+
+`decode()` finds the frames in a raw byte stream (everything that went over
+one serial line, or frames simply concatenated) and `load_capture()` those
+in a `capture.CaptureWriter` file, both as a `FrameTable` of columnar
+arrays:
+
+    table = bulk.load_capture('raw.cap.20240101-120000.gz')
+    rejects = table.select(command=id003.REJECTING, direction='<')
+    for reason, n in rejects.count_by_data():
+        print(id003.REJECT_REASONS.get(reason), n)
+
+Frames are found by looking at every SYNC byte at once: its length byte
+gives where the frame would end, and the CRC of all candidates of the same
+length is computed together, one byte column at a time. Candidates that
+start inside an accepted frame are dropped.
+"""
+
+import numpy as np
+
+import id003
+import capture
+
+
+_TABLE = np.array(id003.CRC_TABLE, dtype=np.uint16)
+_HEAD = capture.RECORD.size
+
+
+class FrameTable:
+    """Decoded frames as columns, one entry per frame.
+
+    `offset` is where each frame starts in `buf`, `command` its command or
+    status, and `data_offset` and `data_length` locate its data. Tables
+    from `load_capture()` also have `direction` (ord('>') or ord('<')),
+    `port` (an index into `ports`) and `timestamp` (wall clock seconds);
+    otherwise those are None.
+    """
+
+    def __init__(self, buf, offset, length, direction=None, port=None, timestamp=None, ports=()):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+        self.command = buf[offset + 2] if len(offset) else np.zeros(0, np.uint8)
+        self.data_offset = offset + 3
+        self.data_length = length - 5
+        self.direction = direction
+        self.port = port
+        self.timestamp = timestamp
+        self.ports = list(ports)
+
+    def __len__(self):
+        return len(self.offset)
+
+    def __repr__(self):
+        return '<FrameTable %d frames>' % len(self)
+
+    def __getitem__(self, i):
+        """The whole frame `i`, from SYNC to CRC, as bytes"""
+
+        start = self.offset[i]
+        return self.buf[start:start + self.length[i]].tobytes()
+
+    def data(self, i):
+        start = self.data_offset[i]
+        return self.buf[start:start + self.data_length[i]].tobytes()
+
+    def data_byte(self, n=0):
+        """Byte `n` of every frame's data, or -1 where the data is shorter,
+        e.g. the reason code of REJECTING frames
+        """
+
+        out = np.full(len(self), -1, dtype=np.int16)
+        has = self.data_length > n
+        out[has] = self.buf[self.data_offset[has] + n]
+        return out
+
+    def mask(self, command=None, direction=None, port=None, start=None, end=None):
+        """Boolean mask of the frames matching all the given conditions.
+        `command` can be one code or a sequence of them, `port` a port name,
+        and `start`/`end` bound the timestamp.
+        """
+
+        m = np.ones(len(self), dtype=bool)
+        if command is not None:
+            m &= np.isin(self.command, np.atleast_1d(command))
+        if direction is not None:
+            m &= self.direction == ord(direction)
+        if port is not None:
+            m &= self.port == (self.ports.index(port) if port in self.ports else -1)
+        if start is not None:
+            m &= self.timestamp >= start
+        if end is not None:
+            m &= self.timestamp < end
+        return m
+
+    def select(self, mask=None, **conditions):
+        """A new table with only the frames in `mask`, or matching
+        `conditions` (see `mask()`)
+        """
+
+        if mask is None:
+            mask = self.mask(**conditions)
+        pick = lambda a: None if a is None else a[mask]
+        return FrameTable(self.buf, self.offset[mask], self.length[mask], pick(self.direction),
+                          pick(self.port), pick(self.timestamp), self.ports)
+
+    def count_by(self, column):
+        """(value, count) pairs for each distinct value in `column`, an
+        array with one entry per frame
+        """
+
+        values, counts = np.unique(column, return_counts=True)
+        return list(zip(values.tolist(), counts.tolist()))
+
+    def count_by_command(self):
+        return self.count_by(self.command)
+
+    def count_by_data(self, n=0):
+        """Counts by data byte `n`, see `data_byte()`"""
+        return self.count_by(self.data_byte(n))
+
+
+def as_array(buf):
+    """`buf` (bytes, bytearray, memoryview, mmap, ...) as a uint8 array,
+    without copying
+    """
+
+    if isinstance(buf, np.ndarray):
+        return buf
+    return np.frombuffer(buf, dtype=np.uint8)
+
+
+def crc_residues(buf, offset, length):
+    """CRC of each frame `buf[offset:offset + length]`, CRC included, so 0
+    for a good one. All frames of the same length are done together.
+    """
+
+    crc = np.zeros(len(offset), dtype=np.uint16)
+    for n in np.unique(length):
+        idx = np.flatnonzero(length == n)
+        starts = offset[idx]
+        c = np.zeros(len(idx), dtype=np.uint16)
+        for j in range(int(n)):
+            c = (c >> 8) ^ _TABLE[(c ^ buf[starts + j]) & 0xff]
+        crc[idx] = c
+    return crc
+
+
+def find_frames(buf, start=0):
+    """Offsets and lengths of the valid frames in `buf`, a uint8 array.
+    Bytes between frames are skipped.
+    """
+
+    return _drop_overlaps(*_valid_candidates(buf, start))
+
+
+def _valid_candidates(buf, start=0, check=None):
+    """Every SYNC byte from `start` on whose length byte and CRC check out.
+    `check(offset, length)` can rule out candidates before the CRCs are
+    worked out, returning a mask of those to keep.
+    """
+
+    candidates = np.flatnonzero(buf[start:len(buf) - 4] == id003.SYNC) + start
+    length = buf[candidates + 1].astype(np.int64)
+    ok = (length >= 5) & (candidates + length <= len(buf))
+    candidates, length = candidates[ok], length[ok]
+    if check is not None:
+        ok = check(candidates, length)
+        candidates, length = candidates[ok], length[ok]
+
+    good = crc_residues(buf, candidates, length) == 0
+    return candidates[good], length[good]
+
+
+def _drop_overlaps(offset, length):
+    """A SYNC byte inside a frame's data can pass for a frame of its own if
+    the bytes after it happen to have a good CRC; drop anything that starts
+    before the previous accepted frame ends
+    """
+
+    keep = np.ones(len(offset), dtype=bool)
+    while len(offset):
+        ends = np.where(keep, offset + length, 0)
+        prev_end = np.concatenate(([0], np.maximum.accumulate(ends)[:-1]))
+        new_keep = offset >= prev_end
+        if np.array_equal(new_keep, keep):
+            break
+        keep = new_keep
+    return offset[keep], length[keep]
+
+
+def decode(buf):
+    """Decode every frame in a raw byte stream into a `FrameTable`"""
+
+    buf = as_array(buf)
+    offset, length = find_frames(buf)
+    return FrameTable(buf, offset, length)
+
+
+def load_capture(path):
+    """Decode a `capture.CaptureWriter` file (compressed or not) into a
+    `FrameTable` with directions, ports and timestamps
+    """
+
+    with capture.open_capture(path) as f:
+        data = f.read()
+    return decode_capture(data)
+
+
+def decode_capture(data):
+    """Decode the contents of a capture file, see `load_capture()`"""
+
+    buf = as_array(data)
+
+    def check(offset, length):
+        # every frame in a capture has a record header right in front of it
+        # whose length field matches; a frame found anywhere else is a
+        # lookalike in a record header, port name or file header
+        head = offset - _HEAD
+        rec_length = buf[head + 11].astype(np.int64) | (buf[head + 12].astype(np.int64) << 8)
+        kind = buf[head]
+        return (rec_length == length) & ((kind == capture.SENT) | (kind == capture.RECEIVED))
+
+    offset, length = _drop_overlaps(*_valid_candidates(buf, _HEAD, check))
+    head = offset - _HEAD
+    kind = buf[head]
+
+    number = buf[head + 1].astype(np.int64) | (buf[head + 2].astype(np.int64) << 8)
+    ts = np.zeros(len(head), dtype=np.uint64)
+    for i in range(8):
+        ts |= buf[head + 3 + i].astype(np.uint64) << np.uint64(8 * i)
+
+    # what's left between frame records are file headers and port names;
+    # there are only a few of them, so they're read the slow way
+    ports = []
+    port = np.full(len(head), -1, dtype=np.int64)
+    timestamp = np.zeros(len(head), dtype=np.float64)
+    gap_starts = np.concatenate(([0], offset + length))
+    gap_ends = np.concatenate((head, [len(buf)]))
+    gaps = np.flatnonzero(gap_ends > gap_starts)
+    section = None  # (port number -> index into ports, clock offset)
+    prev = 0
+    for g in gaps:
+        # frames from the previous gap up to this one belong to the section
+        # the previous gap left us in
+        if section is not None and g > prev:
+            _apply_section(section, number, ts, port, timestamp, prev, g)
+        section = _read_gap(buf[gap_starts[g]:gap_ends[g]].tobytes(), ports, section)
+        prev = g
+    if section is not None and len(head) > prev:
+        _apply_section(section, number, ts, port, timestamp, prev, len(head))
+
+    return FrameTable(buf, offset, length, kind, port, timestamp, ports)
+
+
+def _read_gap(data, ports, section):
+    """Read file headers and port records from the bytes between frame
+    records. Returns the section they leave us in.
+    """
+
+    pos = 0
+    while pos < len(data):
+        if data[pos] == capture.MAGIC[0]:
+            offset = capture._read_header(data[pos:pos + capture.HEADER.size])
+            section = ({}, offset)
+            pos += capture.HEADER.size
+            continue
+        kind, num, ts, length = capture.RECORD.unpack_from(data, pos)
+        pos += _HEAD
+        if kind == capture.PORT and section is not None:
+            name = data[pos:pos + length].decode('utf-8')
+            if name not in ports:
+                ports.append(name)
+            section[0][num] = ports.index(name)
+        pos += length
+    return section
+
+
+def _apply_section(section, number, ts, port, timestamp, start, end):
+    mapping, offset = section
+    lookup = np.full(max(mapping, default=0) + 1, -1, dtype=np.int64)
+    for num, index in mapping.items():
+        lookup[num] = index
+    nums = number[start:end]
+    known = nums < len(lookup)
+    port[start:end][known] = lookup[nums[known]]
+    timestamp[start:end] = ts[start:end] / 1e9 + offset
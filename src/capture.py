@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+"""
+capture - binary capture files of ID-003 traffic
+
+CaptureWriter takes frames from the poll thread and writes them to disk from
+a background thread, so logging raw traffic doesn't cost a file open, format
+and close per frame. Pass one to `id003.BillVal` as `log_raw`:
+
+    writer = CaptureWriter('raw.cap', max_bytes=64 << 20, compress='gzip')
+    bv = id003.BillVal(port, log_raw=writer)
+    ...
+    writer.close()
+
+One writer can be shared by any number of bill validators. Read a capture
+back with `read_capture()`, or
+index it and jump around in it without reading it all with
+`CaptureReader`.
+
+File format (all integers little-endian):
+
+    header   b'ID003CAP', version (u8), wall clock time_ns() (u64) and
+             perf_counter_ns() (u64), both taken when the file was opened
+    records  kind (u8), port number (u16), perf_counter_ns() (u64),
+             length (u16), followed by `length` bytes
+
+`kind` is ord('>') for a frame sent to the bill validator, ord('<') for one
+received, and ord('P') to name a port: its payload is the port name in
+UTF-8, and later records refer to it by its number. Frames are complete,
+from SYNC to CRC. Each file names its own ports, so rotated files can be
+read on their own.
+"""
+
+import os
+import mmap
+import time
+import array
+import queue
+import atexit
+import bisect
+import struct
+import logging
+import threading
+import collections
+
+
+log = logging.getLogger('capture')
+
+MAGIC = b'ID003CAP'
+VERSION = 1
+
+HEADER = struct.Struct('<8sBQQ')
+RECORD = struct.Struct('<BHQH')
+
+SENT = ord('>')
+RECEIVED = ord('<')
+PORT = ord('P')
+
+# rotated files are compressed with one of these stdlib modules
+COMPRESSORS = {
+    'gzip': '.gz',
+    'bz2': '.bz2',
+    'lzma': '.xz',
+}
+
+# sidecar index: magic, version, capture size and mtime it was built from,
+# frame count and length of the port names that follow the columns
+INDEX_MAGIC = b'ID003IDX'
+INDEX_HEADER = struct.Struct('<8sB7xQQQQ')
+
+Record = collections.namedtuple('Record', 'direction port timestamp frame')
+
+
+class CaptureError(Exception):
+    """Raised on a file that isn't a capture, or is cut short"""
+    pass
+
+
+class CaptureWriter(threading.Thread):
+    """Write frames to a capture file from a background thread.
+
+    `write()` only timestamps the frame and puts it on a queue of up to
+    `queue_size` records; if the writer falls that far behind, frames are
+    dropped and counted in `dropped` rather than holding up polling. The
+    writer thread writes whatever has queued up in one go, at least every
+    `flush_interval` seconds.
+
+    The file is rotated once it reaches `max_bytes`, or `max_age` seconds
+    after it was opened (either can be None). Rotated files are renamed
+    with the time of rotation, e.g. `raw.cap.20240101-120000`, and
+    compressed with `compress` ('gzip', 'bz2' or 'lzma') if given.
+    """
+
+    def __init__(self, path, max_bytes=None, max_age=None, compress=None, queue_size=10000,
+                 flush_interval=1.0):
+        super().__init__(daemon=True)
+        if compress is not None and compress not in COMPRESSORS:
+            raise ValueError("Unknown compression: %r" % compress)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compress = compress
+        self.flush_interval = flush_interval
+
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.rotated = []  # paths of rotated files, oldest first
+
+        self._file = None
+        self._opened = 0.0
+        self._ports = {}  # port name -> number, for the current file
+        self._closed = False
+
+        self.start()
+        atexit.register(self.close)
+
+    def __repr__(self):
+        return '<CaptureWriter %s written=%d dropped=%d>' % (self.path, self.written, self.dropped)
+
+    def write(self, direction, port, frame):
+        """Queue `frame` sent ('>') or received ('<') on `port`"""
+
+        try:
+            self.queue.put_nowait((direction, port, time.perf_counter_ns(), bytes(frame)))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Write out everything queued so far and close the file"""
+
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self.queue.put(None)
+        if threading.current_thread() is not self:
+            self.join()
+        if self.dropped:
+            log.warning("Capture to %s dropped %d frames", self.path, self.dropped)
+
+    def run(self):
+        get = self.queue.get
+        get_nowait = self.queue.get_nowait
+        batch = []
+        running = True
+        while running:
+            try:
+                batch.append(get(timeout=self.flush_interval))
+                while True:
+                    batch.append(get_nowait())
+            except queue.Empty:
+                pass
+            if None in batch:
+                batch.remove(None)
+                running = False
+            try:
+                self._write_batch(batch)
+            except OSError as e:
+                log.error("Couldn't write capture to %s: %s", self.path, e)
+            batch.clear()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write_batch(self, batch):
+        if self._file is not None and self._due():
+            self._rotate()
+        if not batch:
+            return
+        if self._file is None:
+            self._open()
+
+        out = bytearray()
+        pack = RECORD.pack
+        ports = self._ports
+        for direction, port, timestamp, frame in batch:
+            number = ports.get(port)
+            if number is None:
+                number = ports[port] = len(ports)
+                name = str(port).encode('utf-8')
+                out += pack(PORT, number, timestamp, len(name))
+                out += name
+            out += pack(ord(direction), number, timestamp, len(frame))
+            out += frame
+        self._file.write(out)
+        self._file.flush()
+        self.written += len(batch)
+
+    def _due(self):
+        if self.max_bytes is not None and self._file.tell() >= self.max_bytes:
+            return True
+        if self.max_age is not None and time.monotonic() - self._opened >= self.max_age:
+            return True
+        return False
+
+    def _open(self):
+        self._file = open(self.path, 'ab')
+        self._opened = time.monotonic()
+        self._ports = {}
+        # when appending to an earlier capture this starts a new section, with
+        # its own port numbers and clock reference
+        self._file.write(HEADER.pack(MAGIC, VERSION, time.time_ns(), time.perf_counter_ns()))
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+
+        base = '%s.%s' % (self.path, time.strftime('%Y%m%d-%H%M%S'))
+        rotated = base
+        n = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + COMPRESSORS.get(self.compress, '')):
+            rotated = '%s.%d' % (base, n)
+            n += 1
+        os.replace(self.path, rotated)
+        if self.compress is not None:
+            rotated = _compress(rotated, self.compress)
+        self.rotated.append(rotated)
+
+
+def _compress(path, method):
+    """Compress `path` with the stdlib module `method`, replacing it.
+    Returns the new path.
+    """
+
+    import shutil
+    import importlib
+    module = importlib.import_module(method)
+    compressed = path + COMPRESSORS[method]
+    with open(path, 'rb') as src, module.open(compressed, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    os.remove(path)
+    return compressed
+
+
+def open_capture(path):
+    """Open a capture file for reading, decompressing it if its name says so"""
+
+    for method, suffix in COMPRESSORS.items():
+        if path.endswith(suffix):
+            import importlib
+            return importlib.import_module(method).open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_capture(path):
+    """Yield the frames in a capture file as `Record`s of (direction,
+    port, timestamp, frame). `direction` is '>' or '<', `port` the port
+    name and `timestamp` the wall clock time in seconds.
+    """
+
+    with open_capture(path) as f:
+        yield from read_records(f)
+
+
+def read_records(f):
+    """Yield `Record`s from a binary file object, see `read_capture()`"""
+
+    read = f.read
+    unpack = RECORD.unpack
+    ports = {}
+    offset = None  # perf_counter_ns -> wall clock, in seconds
+    while True:
+        head = read(RECORD.size)
+        if not head:
+            return
+        if head[0] == MAGIC[0]:
+            # a header, at the start of the file or of an appended section
+            head += read(HEADER.size - len(head))
+            offset = _read_header(head)
+            ports = {}
+            continue
+        if offset is None:
+            raise CaptureError("Not a capture file")
+        if len(head) < RECORD.size:
+            raise CaptureError("Capture record cut short")
+        kind, number, timestamp, length = unpack(head)
+        payload = read(length)
+        if len(payload) < length:
+            raise CaptureError("Capture record cut short")
+        if kind == PORT:
+            ports[number] = payload.decode('utf-8')
+        else:
+            yield Record(chr(kind), ports.get(number), timestamp / 1e9 + offset, payload)
+
+
+def _read_header(head):
+    """Check a file header, returns the offset from perf_counter_ns
+    timestamps to the wall clock, in seconds
+    """
+
+    if len(head) < HEADER.size:
+        raise CaptureError("Capture header cut short")
+    magic, version, wall_ns, perf_ns = HEADER.unpack(head)
+    if magic != MAGIC:
+        raise CaptureError("Not a capture file")
+    if version != VERSION:
+        raise CaptureError("Unsupported capture version %d" % version)
+    return (wall_ns - perf_ns) / 1e9
+
+
+class CaptureReader:
+    """Random access to an uncompressed capture file through `mmap`.
+
+    Frames are located through a sidecar index (`path` + '.idx') of each
+    frame's offset, timestamp, port, direction and command or status. It's
+    built on first use (with `bulk` if NumPy is available) and rebuilt if
+    the capture has changed since. The index is memory-mapped too, so
+    neither file is read into memory.
+
+        with CaptureReader('raw.cap') as cap:
+            i = cap.seek(time.time() - 3600)
+            for i, record in cap.statuses(id003.ACCEPTOR_JAM, start=i):
+                print(record)
+
+    Records are `Record`s whose `frame` is a `memoryview` into the capture;
+    copy it with `bytes()` to keep it past `close()`. Timestamps are assumed
+    to be in order, as `CaptureWriter` writes them.
+    """
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + '.idx'
+        self._index_file = None
+        self._index_mmap = None
+        self._mmap = None
+
+        self._file = open(path, 'rb')
+        if os.fstat(self._file.fileno()).st_size < len(MAGIC):
+            self.close()
+            raise CaptureError("Not a capture file: %s" % path)
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = memoryview(self._mmap)
+        if self.data[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise CaptureError("Not an uncompressed capture file: %s" % path)
+
+        if not self._load_index():
+            columns = _build_index(self.data)
+            try:
+                self._write_index(*columns)
+            except OSError as e:
+                log.warning("Couldn't write index %s: %s", self.index_path, e)
+            if not self._load_index():
+                # keep the index in memory instead
+                self._use_columns(*[memoryview(c).cast('B') for c in columns[:-1]],
+                                  columns[-1])
+
+    def __repr__(self):
+        return '<CaptureReader %s frames=%d>' % (self.path, len(self))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # views into the maps have to go before the maps can be closed
+        for name in ('offsets', 'timestamps', 'port_numbers', 'commands', 'directions', 'data'):
+            view = self.__dict__.pop(name, None)
+            if view is not None:
+                view.release()
+        for m in (self._index_mmap, self._mmap):
+            if m is not None:
+                try:
+                    m.close()
+                except BufferError:
+                    # frames still held elsewhere; it's unmapped once they're gone
+                    pass
+        for f in (self._index_file, self._file):
+            if f is not None:
+                f.close()
+        self._index_mmap = self._mmap = self._index_file = self._file = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        number = self.port_numbers[i]
+        port = self.ports[number] if number < len(self.ports) else None
+        return Record(chr(self.directions[i]), port, self.timestamps[i], self.frame(i))
+
+    def frame(self, i):
+        """Frame `i` from SYNC to CRC, as a memoryview into the capture"""
+
+        start = self.offsets[i]
+        return self.data[start:start + self.data[start + 1]]
+
+    def seek(self, timestamp):
+        """Index of the first frame at or after `timestamp` (wall clock
+        seconds), or `len(self)` if there isn't one
+        """
+        return bisect.bisect_left(self.timestamps, timestamp)
+
+    def between(self, start=None, end=None):
+        """Yield (index, `Record`) for each frame from `start` up to `end`,
+        both wall clock times
+        """
+
+        first = 0 if start is None else self.seek(start)
+        last = len(self) if end is None else self.seek(end)
+        for i in range(first, last):
+            yield i, self[i]
+
+    def statuses(self, *statuses, start=0, end=None):
+        """Yield (index, `Record`) for each status received from the bill
+        validator that's one of `statuses`, between frame indices `start`
+        and `end`
+        """
+
+        commands = self.commands
+        directions = self.directions
+        end = len(self) if end is None else end
+        # bytes.find() goes through the column far faster than a loop would
+        find = commands.obj.find if hasattr(commands.obj, 'find') else bytes(commands).find
+        base = self._commands_at
+        found = {status: find(bytes([status]), base + start, base + end) for status in statuses}
+        while True:
+            live = [pos for pos in found.values() if pos >= 0]
+            if not live:
+                return
+            pos = min(live)
+            i = pos - base
+            status = commands[i]
+            found[status] = find(bytes([status]), pos + 1, base + end)
+            if directions[i] == RECEIVED:
+                yield i, self[i]
+
+    def _load_index(self):
+        """Map the sidecar index if it exists and matches the capture"""
+
+        try:
+            f = open(self.index_path, 'rb')
+        except OSError:
+            return False
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            f.close()
+            return False
+        st = os.fstat(self._file.fileno())
+        try:
+            magic, version, size, mtime, count, names_len = INDEX_HEADER.unpack_from(m)
+        except struct.error:
+            magic = None
+        if (magic != INDEX_MAGIC or version != VERSION or size != st.st_size
+                or mtime != st.st_mtime_ns or len(m) != _index_size(count) + names_len):
+            m.close()
+            f.close()
+            return False
+
+        self._index_file = f
+        self._index_mmap = m
+        view = memoryview(m)
+        columns = []
+        pos = INDEX_HEADER.size
+        for width in (8, 8, 2, 1, 1):
+            columns.append(view[pos:pos + width * count])
+            pos += width * count
+        ports = m[pos:pos + names_len].decode('utf-8').split('\n') if names_len else []
+        self._use_columns(*columns, ports)
+        self._commands_at = INDEX_HEADER.size + 18 * count
+        view.release()
+        return True
+
+    def _use_columns(self, offsets, timestamps, port_numbers, commands, directions, ports):
+        self.offsets = offsets.cast('Q')
+        self.timestamps = timestamps.cast('d')
+        self.port_numbers = port_numbers.cast('H')
+        self.commands = commands
+        self.directions = directions
+        self.ports = ports
+        self._commands_at = 0
+
+    def _write_index(self, offsets, timestamps, port_numbers, commands, directions, ports):
+        st = os.fstat(self._file.fileno())
+        names = '\n'.join(ports).encode('utf-8')
+        tmp = '%s.%d.tmp' % (self.index_path, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, VERSION, st.st_size, st.st_mtime_ns,
+                                          len(offsets), len(names)))
+                for column in (offsets, timestamps, port_numbers, commands, directions):
+                    f.write(column)
+                f.write(names)
+            os.replace(tmp, self.index_path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+
+def _index_size(count):
+    return INDEX_HEADER.size + count * (8 + 8 + 2 + 1 + 1)
+
+
+def _build_index(data):
+    """Index columns for the capture in `data`: offsets, timestamps, port
+    numbers, commands and directions, each as something with the buffer
+    protocol, and the list of port names. Frames on a port that was never
+    named get port number 0xffff.
+    """
+
+    try:
+        import bulk
+    except ImportError:
+        bulk = None
+    if bulk is not None:
+        table = bulk.decode_capture(data)
+        port = table.port.copy()
+        port[port < 0] = 0xffff
+        return (table.offset.astype('<u8'), table.timestamp.astype('<f8'), port.astype('<u2'),
+                table.command.tobytes(), table.direction.tobytes(), table.ports)
+
+    offsets = array.array('Q')
+    timestamps = array.array('d')
+    port_numbers = array.array('H')
+    commands = bytearray()
+    directions = bytearray()
+    ports = []
+
+    unpack = RECORD.unpack_from
+    size = len(data)
+    section = {}  # port number -> index into ports, for this section
+    clock = 0.0
+    pos = 0
+    while pos + RECORD.size <= size:
+        if data[pos] == MAGIC[0]:
+            if pos + HEADER.size > size:
+                break
+            clock = _read_header(data[pos:pos + HEADER.size])
+            section = {}
+            pos += HEADER.size
+            continue
+        kind, number, timestamp, length = unpack(data, pos)
+        pos += RECORD.size
+        if pos + length > size:
+            break  # still being written
+        if kind == PORT:
+            name = bytes(data[pos:pos + length]).decode('utf-8')
+            if name not in ports:
+                ports.append(name)
+            section[number] = ports.index(name)
+        elif length >= 5:
+            offsets.append(pos)
+            timestamps.append(timestamp / 1e9 + clock)
+            port_numbers.append(section.get(number, 0xffff))
+            commands.append(data[pos + 2])
+            directions.append(kind)
+        pos += length
+    return offsets, timestamps, port_numbers, commands, directions, ports
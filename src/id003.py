@@ -1,8 +1,29 @@
 #!/usr/bin/env python3
 
+import os
+import re
 import serial
+import serial.tools.list_ports
 import time
 import logging
+import logging.handlers
+import asyncio
+import inspect
+import collections
+import json
+import select
+import selectors
+import heapq
+import queue
+import itertools
+import bisect
+import threading
+import contextlib
+import http.server
+import concurrent.futures
+
+
+log = logging.getLogger('id003')
 
 
 ###
@@ -259,6 +280,19 @@ BAR_18_CHAR = 0x12
 BAR_MULTI = 0xFF  # required if OPT_24CHAR is set?
 
 
+### Settings, in the order BillVal.initialize() sends them ###
+# (set command, get command, description)
+SETTINGS = (
+    (SET_DENOM, GET_DENOM, "denom inhibit"),
+    (SET_SECURITY, GET_SECURITY, "security"),
+    (SET_DIRECTION, GET_DIRECTION, "direction inhibit"),
+    (SET_OPT_FUNC, GET_OPT_FUNC, "optional functions"),
+    (SET_INHIBIT, GET_INHIBIT, "inhibit"),
+    (SET_BAR_FUNC, GET_BAR_FUNC, "barcode functions"),
+    (SET_BAR_INHIBIT, GET_BAR_INHIBIT, "barcode inhibit"),
+)
+
+
 class CRCError(Exception):
     """Computed CRC does not match given CRC"""
     pass
@@ -284,430 +318,2906 @@ class DenomError(Exception):
     pass
 
 
+### CRC-CCITT (Kermit) ###
+
+# Precomputed once at import; reflected polynomial 0x8408
+CRC_TABLE = (
+    0x0000, 0x1189, 0x2312, 0x329B, 0x4624, 0x57AD, 0x6536, 0x74BF,
+    0x8C48, 0x9DC1, 0xAF5A, 0xBED3, 0xCA6C, 0xDBE5, 0xE97E, 0xF8F7,
+    0x1081, 0x0108, 0x3393, 0x221A, 0x56A5, 0x472C, 0x75B7, 0x643E,
+    0x9CC9, 0x8D40, 0xBFDB, 0xAE52, 0xDAED, 0xCB64, 0xF9FF, 0xE876,
+    0x2102, 0x308B, 0x0210, 0x1399, 0x6726, 0x76AF, 0x4434, 0x55BD,
+    0xAD4A, 0xBCC3, 0x8E58, 0x9FD1, 0xEB6E, 0xFAE7, 0xC87C, 0xD9F5,
+    0x3183, 0x200A, 0x1291, 0x0318, 0x77A7, 0x662E, 0x54B5, 0x453C,
+    0xBDCB, 0xAC42, 0x9ED9, 0x8F50, 0xFBEF, 0xEA66, 0xD8FD, 0xC974,
+    0x4204, 0x538D, 0x6116, 0x709F, 0x0420, 0x15A9, 0x2732, 0x36BB,
+    0xCE4C, 0xDFC5, 0xED5E, 0xFCD7, 0x8868, 0x99E1, 0xAB7A, 0xBAF3,
+    0x5285, 0x430C, 0x7197, 0x601E, 0x14A1, 0x0528, 0x37B3, 0x263A,
+    0xDECD, 0xCF44, 0xFDDF, 0xEC56, 0x98E9, 0x8960, 0xBBFB, 0xAA72,
+    0x6306, 0x728F, 0x4014, 0x519D, 0x2522, 0x34AB, 0x0630, 0x17B9,
+    0xEF4E, 0xFEC7, 0xCC5C, 0xDDD5, 0xA96A, 0xB8E3, 0x8A78, 0x9BF1,
+    0x7387, 0x620E, 0x5095, 0x411C, 0x35A3, 0x242A, 0x16B1, 0x0738,
+    0xFFCF, 0xEE46, 0xDCDD, 0xCD54, 0xB9EB, 0xA862, 0x9AF9, 0x8B70,
+    0x8408, 0x9581, 0xA71A, 0xB693, 0xC22C, 0xD3A5, 0xE13E, 0xF0B7,
+    0x0840, 0x19C9, 0x2B52, 0x3ADB, 0x4E64, 0x5FED, 0x6D76, 0x7CFF,
+    0x9489, 0x8500, 0xB79B, 0xA612, 0xD2AD, 0xC324, 0xF1BF, 0xE036,
+    0x18C1, 0x0948, 0x3BD3, 0x2A5A, 0x5EE5, 0x4F6C, 0x7DF7, 0x6C7E,
+    0xA50A, 0xB483, 0x8618, 0x9791, 0xE32E, 0xF2A7, 0xC03C, 0xD1B5,
+    0x2942, 0x38CB, 0x0A50, 0x1BD9, 0x6F66, 0x7EEF, 0x4C74, 0x5DFD,
+    0xB58B, 0xA402, 0x9699, 0x8710, 0xF3AF, 0xE226, 0xD0BD, 0xC134,
+    0x39C3, 0x284A, 0x1AD1, 0x0B58, 0x7FE7, 0x6E6E, 0x5CF5, 0x4D7C,
+    0xC60C, 0xD785, 0xE51E, 0xF497, 0x8028, 0x91A1, 0xA33A, 0xB2B3,
+    0x4A44, 0x5BCD, 0x6956, 0x78DF, 0x0C60, 0x1DE9, 0x2F72, 0x3EFB,
+    0xD68D, 0xC704, 0xF59F, 0xE416, 0x90A9, 0x8120, 0xB3BB, 0xA232,
+    0x5AC5, 0x4B4C, 0x79D7, 0x685E, 0x1CE1, 0x0D68, 0x3FF3, 0x2E7A,
+    0xE70E, 0xF687, 0xC41C, 0xD595, 0xA12A, 0xB0A3, 0x8238, 0x93B1,
+    0x6B46, 0x7ACF, 0x4854, 0x59DD, 0x2D62, 0x3CEB, 0x0E70, 0x1FF9,
+    0xF78F, 0xE606, 0xD49D, 0xC514, 0xB1AB, 0xA022, 0x92B9, 0x8330,
+    0x7BC7, 0x6A4E, 0x58D5, 0x495C, 0x3DE3, 0x2C6A, 0x1EF1, 0x0F78
+)
+
+
+def _crc16(message, crc=0x0000, table=CRC_TABLE):
+    for byte in message:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xff]
+    return crc
+
+
 def get_crc(message):
     """Get CRC value for a given bytes object using CRC-CCITT Kermit"""
+    
+    # two bytes, LSB first
+    return _crc16(message).to_bytes(2, 'little')
 
-    TABLE = [
-      0x0000, 0x1189, 0x2312, 0x329B, 0x4624, 0x57AD, 0x6536, 0x74BF,
-      0x8C48, 0x9DC1, 0xAF5A, 0xBED3, 0xCA6C, 0xDBE5, 0xE97E, 0xF8F7,
-      0x1081, 0x0108, 0x3393, 0x221A, 0x56A5, 0x472C, 0x75B7, 0x643E,
-      0x9CC9, 0x8D40, 0xBFDB, 0xAE52, 0xDAED, 0xCB64, 0xF9FF, 0xE876,
-      0x2102, 0x308B, 0x0210, 0x1399, 0x6726, 0x76AF, 0x4434, 0x55BD,
-      0xAD4A, 0xBCC3, 0x8E58, 0x9FD1, 0xEB6E, 0xFAE7, 0xC87C, 0xD9F5,
-      0x3183, 0x200A, 0x1291, 0x0318, 0x77A7, 0x662E, 0x54B5, 0x453C,
-      0xBDCB, 0xAC42, 0x9ED9, 0x8F50, 0xFBEF, 0xEA66, 0xD8FD, 0xC974,
-      0x4204, 0x538D, 0x6116, 0x709F, 0x0420, 0x15A9, 0x2732, 0x36BB,
-      0xCE4C, 0xDFC5, 0xED5E, 0xFCD7, 0x8868, 0x99E1, 0xAB7A, 0xBAF3,
-      0x5285, 0x430C, 0x7197, 0x601E, 0x14A1, 0x0528, 0x37B3, 0x263A,
-      0xDECD, 0xCF44, 0xFDDF, 0xEC56, 0x98E9, 0x8960, 0xBBFB, 0xAA72,
-      0x6306, 0x728F, 0x4014, 0x519D, 0x2522, 0x34AB, 0x0630, 0x17B9,
-      0xEF4E, 0xFEC7, 0xCC5C, 0xDDD5, 0xA96A, 0xB8E3, 0x8A78, 0x9BF1,
-      0x7387, 0x620E, 0x5095, 0x411C, 0x35A3, 0x242A, 0x16B1, 0x0738,
-      0xFFCF, 0xEE46, 0xDCDD, 0xCD54, 0xB9EB, 0xA862, 0x9AF9, 0x8B70,
-      0x8408, 0x9581, 0xA71A, 0xB693, 0xC22C, 0xD3A5, 0xE13E, 0xF0B7,
-      0x0840, 0x19C9, 0x2B52, 0x3ADB, 0x4E64, 0x5FED, 0x6D76, 0x7CFF,
-      0x9489, 0x8500, 0xB79B, 0xA612, 0xD2AD, 0xC324, 0xF1BF, 0xE036,
-      0x18C1, 0x0948, 0x3BD3, 0x2A5A, 0x5EE5, 0x4F6C, 0x7DF7, 0x6C7E,
-      0xA50A, 0xB483, 0x8618, 0x9791, 0xE32E, 0xF2A7, 0xC03C, 0xD1B5,
-      0x2942, 0x38CB, 0x0A50, 0x1BD9, 0x6F66, 0x7EEF, 0x4C74, 0x5DFD,
-      0xB58B, 0xA402, 0x9699, 0x8710, 0xF3AF, 0xE226, 0xD0BD, 0xC134,
-      0x39C3, 0x284A, 0x1AD1, 0x0B58, 0x7FE7, 0x6E6E, 0x5CF5, 0x4D7C,
-      0xC60C, 0xD785, 0xE51E, 0xF497, 0x8028, 0x91A1, 0xA33A, 0xB2B3,
-      0x4A44, 0x5BCD, 0x6956, 0x78DF, 0x0C60, 0x1DE9, 0x2F72, 0x3EFB,
-      0xD68D, 0xC704, 0xF59F, 0xE416, 0x90A9, 0x8120, 0xB3BB, 0xA232,
-      0x5AC5, 0x4B4C, 0x79D7, 0x685E, 0x1CE1, 0x0D68, 0x3FF3, 0x2E7A,
-      0xE70E, 0xF687, 0xC41C, 0xD595, 0xA12A, 0xB0A3, 0x8238, 0x93B1,
-      0x6B46, 0x7ACF, 0x4854, 0x59DD, 0x2D62, 0x3CEB, 0x0E70, 0x1FF9,
-      0xF78F, 0xE606, 0xD49D, 0xC514, 0xB1AB, 0xA022, 0x92B9, 0x8330,
-      0x7BC7, 0x6A4E, 0x58D5, 0x495C, 0x3DE3, 0x2C6A, 0x1EF1, 0x0F78
-]
-
-    crc = 0x0000
-    for byte in message:
-        crc = (crc >> 8) ^ TABLE[(crc ^ byte) & 0xff]
-        
-    # convert to bytes, big-endian
-    crc = '%04x' % crc
-    crc = [int(crc[-2:], 16), int(crc[:-2], 16)]
 
-    return bytes(crc)
+def encode_frame(command, data=b''):
+    """Build a complete frame for `command`, CRC included"""
+    
+    message = bytes([SYNC, 5 + len(data), command]) + data
+    return message + get_crc(message)
 
 
-class BillVal:
-    """Represent an ID-003 bill validator as a subclass of `serial.Serial`"""
+# commands sent without data, encoded once so polling doesn't build the same
+# few bytes over and over
+FRAMES = {command: encode_frame(command)
+          for command in (STATUS_REQ, ACK, RESET, STACK_1, STACK_2, RETURN, HOLD, WAIT)}
+
+
+def status_table(statuses):
+    """256-entry table of which status codes are in `statuses`, for checking
+    a status with one index rather than searching a tuple
+    """
     
-    def __init__(self, port, log_raw=False, threading=False):
-        self.com = serial.Serial(port, 9600, serial.EIGHTBITS, serial.PARITY_EVEN, timeout=0.05)
-        
-        self.bv_status = None
-        self.bv_version = None
+    table = [False] * 256
+    for status in statuses:
+        table[status] = True
+    return tuple(table)
+
+
+def verify_frame(frame):
+    """Check the CRC of a complete frame, including its trailing CRC bytes"""
+    
+    # running the CRC over a message and its own CRC leaves a residue of 0
+    return len(frame) >= 5 and frame[0] == SYNC and _crc16(frame) == 0
+
+
+def verify_many(frames):
+    """Check the CRCs of many frames in one call.
+    
+    `frames` is either an iterable of complete frames or a bytes-like buffer
+    holding frames back to back, as in a capture. Returns a list of booleans,
+    one per frame. A buffer ending in a truncated frame reports it as invalid.
+    """
+    
+    if isinstance(frames, (bytes, bytearray, memoryview)):
+        frames = _split_frames(bytes(frames))
         
-        self.threading = threading
+    table = CRC_TABLE
+    results = []
+    append = results.append
+    for frame in frames:
+        crc = 0x0000
+        for byte in frame:
+            crc = (crc >> 8) ^ table[(crc ^ byte) & 0xff]
+        append(len(frame) >= 5 and frame[0] == SYNC and crc == 0)
+    return results
+
+
+def _split_frames(buf):
+    """Split a buffer of back-to-back frames into a list using their length
+    bytes
+    """
+    
+    frames = []
+    append = frames.append
+    i = 0
+    end = len(buf)
+    while i < end:
+        length = buf[i + 1] if i + 1 < end else 0
+        if length < 5:
+            # no usable length byte, rest of the buffer is one bad frame
+            append(buf[i:])
+            break
+        append(buf[i:i + length])
+        i += length
+    return frames
+
+
+class CRC:
+    """Incremental CRC-CCITT (Kermit) state, for checksumming a frame as its
+    bytes arrive
+    """
+    
+    __slots__ = ('value',)
+    
+    def __init__(self, data=b''):
+        self.value = _crc16(data)
         
-        self.all_statuses = NORM_STATUSES + ERROR_STATUSES + POW_STATUSES
-            
-        self.bv_events = {
-            IDLE: self._on_idle,
-            ACEPTING: self._on_accepting,
-            ESCROW: self._on_escrow,
-            STACKING: self._on_stacking,
-            VEND_VALID: self._on_vend_valid,
-            STACKED: self._on_stacked,
-            REJECTING: self._on_rejecting,
-            RETURNING: self._on_returning,
-            HOLDING: self._on_holding,
-            INHIBIT: self._on_inhibit,
-            INITIALIZE: self._on_init,
-            STACKER_FULL: self._on_stacker_full,
-            STACKER_OPEN: self._on_stacker_open,
-            ACCEPTOR_JAM: self._on_acceptor_jam,
-            STACKER_JAM: self._on_stacker_jam,
-            PAUSE: self._on_pause,
-            CHEATED: self._on_cheated,
-            FAILURE: self._on_failure,
-            COMM_ERROR: self._on_comm_error,
-            INVALID_COMMAND: self._on_invalid_command,
-        }
+    def update(self, data):
+        """Add `data` to the running CRC. Returns self so calls can be chained"""
+        self.value = _crc16(data, self.value)
+        return self
         
-        # TODO get this from version during powerup
-        self.bv_denoms = ESCROW_USA
+    def digest(self):
+        """Current CRC as it is sent on the wire"""
+        return self.value.to_bytes(2, 'little')
         
-        self.bv_on = False
+    def is_valid(self):
+        """True if the bytes so far are a message followed by its own CRC"""
+        return self.value == 0x0000
         
-        # set up logging
-        self.raw = log_raw
+    def copy(self):
+        crc = CRC()
+        crc.value = self.value
+        return crc
         
-        if not logging.getLogger('').hasHandlers():
-            logging.basicConfig(level=logging.DEBUG,
-                                format="[%(asctime)s] %(levelname)s: %(message)s",
-                                filename='debug.log',
-                                filemode='w',
-                                )
-            console = logging.StreamHandler()
-            console.setLevel(logging.INFO)
-            formatter = logging.Formatter("%(levelname)s: %(message)s")
-            console.setFormatter(formatter)
-            logging.getLogger('').addHandler(console)
-    
-    def _raw(self, pre, msg):
-        if self.raw:
-            msg = ['0x%02x' % x for x in msg]
-            log = open('raw.log', 'a')
-            log.write('{} {}\r\n'.format(pre, msg))
-            log.close()
+    def reset(self):
+        self.value = 0x0000
+
+
+class FrameDecoder:
+    """Incremental ID-003 framer.
     
-    def _on_stacker_full(self, data):
-        logging.error("Stacker full.")
+    `feed()` it whatever bytes have arrived and iterate over it to get the
+    complete `(command, data)` frames. Partial frames stay buffered until the
+    rest arrives. Bytes that can't start a valid frame are skipped by scanning
+    for the next SYNC whose length and CRC check out, so line noise costs the
+    frame it hit rather than the whole poll loop.
     
-    def _on_stacker_open(self, data):
-        logging.warning("Stacker open.")
+    A 0x00 byte where a frame should start is reported as `(0x00, b'')`, the
+    same as `BillVal.read_response()` always has.
+    """
     
-    def _on_acceptor_jam(self, data):
-        logging.error("Acceptor jam.")
+    def __init__(self):
+        self.buf = bytearray()
+        self.frame = b''  # last complete frame, including CRC
+        self._last = None  # (command, data) decoded from self.frame
+        self.skipped = 0  # bytes thrown away while resynchronizing
+        self.crc_errors = 0  # frames dropped because of a bad CRC
+        
+    def __iter__(self):
+        return self
+        
+    def __next__(self):
+        frame = self.next_frame()
+        if frame is None:
+            raise StopIteration
+        return frame
+        
+    def feed(self, data):
+        """Add received bytes to the buffer"""
+        self.buf += data
+        
+    def clear(self):
+        """Discard any buffered bytes"""
+        del self.buf[:]
+        
+    def needed(self):
+        """Minimum number of bytes still needed to complete the next frame"""
+        
+        buf = self.buf
+        if len(buf) < 2 or buf[0] != SYNC:
+            return max(5 - len(buf), 1)
+        return max(buf[1] - len(buf), 1)
+        
+    def next_frame(self):
+        """Return the next complete `(command, data)` frame, or None if more
+        bytes are needed
+        """
+        
+        buf = self.buf
+        while buf:
+            if buf[0] != SYNC:
+                if buf[0] == 0x00:
+                    del buf[0]
+                    self.frame = b''
+                    return (0x00, b'')
+                skip = buf.find(SYNC, 1)
+                if skip < 0:
+                    skip = len(buf)
+                self.skipped += skip
+                del buf[:skip]
+                continue
+                
+            if len(buf) < 2:
+                return None
+            length = buf[1]
+            if length < 5:
+                # can't be a real frame, look for the next SYNC
+                self.skipped += 1
+                del buf[0]
+                continue
+            if len(buf) < length:
+                # either the rest hasn't arrived yet, or the length byte is
+                # garbage; only skip ahead if a valid frame is already waiting
+                skip = self._find_valid(1)
+                if skip < 0:
+                    return None
+                self.skipped += skip
+                del buf[:skip]
+                continue
+                
+            if length == len(self.frame) and buf.startswith(self.frame):
+                # same frame as last time, which is most of them while
+                # polling; no need to check its CRC or decode it again
+                del buf[:length]
+                return self._last
+                
+            frame = bytes(buf[:length])
+            if _crc16(frame):
+                # bad CRC, or a SYNC byte that wasn't the start of a frame
+                self.crc_errors += 1
+                self.skipped += 1
+                del buf[0]
+                continue
+                
+            del buf[:length]
+            self.frame = frame
+            self._last = frame[2], frame[3:-2]
+            return self._last
+        return None
+        
+    def _find_valid(self, start):
+        """Offset of the first complete frame with a good CRC at or after
+        `start`, or -1
+        """
+        
+        buf = self.buf
+        i = buf.find(SYNC, start)
+        while i >= 0:
+            if i + 1 < len(buf):
+                length = buf[i + 1]
+                if length >= 5 and i + length <= len(buf) and not _crc16(buf[i:i + length]):
+                    return i
+            i = buf.find(SYNC, i + 1)
+        return -1
+        
+    def resync(self):
+        """Give up on the partial frame at the head of the buffer and return
+        the next complete frame after it, if there is one. Used when a read
+        times out, in case a corrupted length byte is holding up the buffer.
+        """
+        
+        while self.buf:
+            self.skipped += 1
+            del self.buf[0]
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+        return None
+
+
+### Events ###
+
+def byte_table(mapping, default=None):
+    """256-entry tuple of `mapping`'s value for each byte value, `default`
+    where it has none, so decoding a payload byte is one index
+    """
     
-    def _on_stacker_jam(self, data):
-        logging.error("Stacker jam.")
+    return tuple(mapping.get(i, default) for i in range(256))
+
+
+ESCROW_TABLE = byte_table(ESCROW_USA)
+REJECT_TABLE = byte_table(REJECT_REASONS)
+FAILURE_TABLE = byte_table(FAILURE_CODES)
+
+
+class Event:
+    """A status response decoded by `EventDecoder`. `status` and `data` are
+    what the bill validator sent; subclasses add fields decoded from `data`,
+    listed in `fields`.
+    """
     
-    def _on_pause(self, data):
-        logging.warning("BV paused. If there's a second bill being inserted, remove it.")
+    __slots__ = ('status', 'data')
+    fields = ()
     
-    def _on_cheated(self, data):
-        logging.warning("BV cheated.")
+    def __init__(self, status, data=b''):
+        self.status = status
+        self.data = data
+        
+    def __eq__(self, other):
+        return (type(other) is type(self) and other.status == self.status
+                and other.data == self.data)
+        
+    def __hash__(self):
+        return hash((self.status, self.data))
+        
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join('%s=%r' % (f, getattr(self, f)) for f in self.fields))
+
+
+class Timeout(Event):
+    """No response before the read timed out"""
+    __slots__ = ()
+
+
+class Unknown(Event):
+    """A status this module doesn't know, or the 0x00 byte some bill
+    validators send
+    """
     
-    def _on_failure(self, data):
-        fault = ord(data)
-        if fault not in FAILURE_CODES:
-            logging.error("Unknown failure: %02x" % fault)
-        else:
-            logging.error(FAILURE_CODES[fault])
+    __slots__ = ()
+    fields = ('status', 'data')
+
+
+class Idle(Event):
+    __slots__ = ()
+
+
+class Accepting(Event):
+    __slots__ = ()
+
+
+class Escrow(Event):
+    """A bill or ticket in escrow. `denom` is its escrow code (DENOM_1 to
+    DENOM_8 or BARCODE_TKT), `name` what that is in the bill validator's
+    denominations ('$5', 'TITO'; None if it isn't one) and `barcode` the
+    ticket's barcode, or None for a bill.
+    """
     
-    def _on_comm_error(self, data):
-        logging.warning("Communication error.")
-        logging.debug("Details: %r" % ['0x%02x' % x for x in data])
+    __slots__ = ('denom', 'name', 'barcode')
+    fields = ('denom', 'name', 'barcode')
     
-    def _on_invalid_command(self, data):
-        logging.warning("Invalid command.")
+    def __init__(self, status, data=b'', names=ESCROW_TABLE):
+        Event.__init__(self, status, data)
+        self.denom = data[0] if data else None
+        self.name = names[data[0]] if data else None
+        self.barcode = data[1:] if self.denom == BARCODE_TKT else None
+
+
+class Stacking(Event):
+    __slots__ = ()
+
+
+class VendValid(Event):
+    __slots__ = ()
+
+
+class Stacked(Event):
+    __slots__ = ()
+
+
+class Rejecting(Event):
+    """A bill being rejected. `reason` is the REJECT_REASONS code and
+    `description` its text, None if unknown.
+    """
     
-    def _on_idle(self, data):
-        logging.info("BV idle.")
+    __slots__ = ('reason', 'description')
+    fields = ('reason', 'description')
     
-    def _on_accepting(self, data):
-        logging.info("BV accepting...")
+    def __init__(self, status, data=b''):
+        Event.__init__(self, status, data)
+        self.reason = data[0] if data else None
+        self.description = REJECT_TABLE[data[0]] if data else None
+
+
+class Returning(Event):
+    __slots__ = ()
+
+
+class Holding(Event):
+    __slots__ = ()
+
+
+class Inhibit(Event):
+    __slots__ = ()
+
+
+class Initialize(Event):
+    __slots__ = ()
+
+
+class PowerUp(Event):
+    """Powered up, possibly with a bill left in the acceptor or stacker"""
     
-    def _on_escrow(self, data):
-        escrow = data[0]
-        if escrow not in self.bv_denoms:
-            raise DenomError("Unknown denom in escrow: %x" % escrow)
-        elif escrow == BARCODE_TKT:
-            barcode = data[1:]
-            logging.info("Barcode: %s" % barcode)
-        else:
-            logging.info("Denom: %s" % self.bv_denoms[escrow])
-            
-        s_r = ''
-        while s_r not in ('1', '2', 'r'):
-            s_r = input("(1) Stack and acknowledge when bill passes stacker lever\n"
-                        "(2) Stack and acknowledge when bill is stored\n"
-                        "(R)eturn ").lower()
-            if s_r == '1':
-                logging.info("Sending Stack-1 command...")
-                self.accepting_denom = self.bv_denoms[escrow]
-                status = None
-                while status != ACK:
-                    self.send_command(STACK_1, b'')
-                    status, data = self.read_response()
-                logging.debug("Received ACK")
-                self.bv_status = None
-            elif s_r == '2':
-                logging.info("Sending Stack-2 command...")
-                self.accepting_denom = self.bv_denoms[escrow]
-                status = None
-                while status != ACK:
-                    self.send_command(STACK_2, b'')
-                    status, data = self.read_response()
-                logging.debug("Received ACK")
-                self.bv_status = None
-            elif s_r == 'r':
-                logging.info("Telling BV to return...")
-                status = None
-                while status != ACK:
-                    self.send_command(RETURN, b'')
-                    status, data = self.read_response()
-                logging.debug("Received ACK")
-                self.bv_status = None
-                    
+    __slots__ = ('bill_in_acceptor', 'bill_in_stacker')
+    fields = ('bill_in_acceptor', 'bill_in_stacker')
     
-    def _on_stacking(self, data):
-        logging.info("BV stacking...")
+    def __init__(self, status, data=b''):
+        Event.__init__(self, status, data)
+        self.bill_in_acceptor = status == POW_UP_BIA
+        self.bill_in_stacker = status == POW_UP_BIS
+
+
+class StackerFull(Event):
+    __slots__ = ()
+
+
+class StackerOpen(Event):
+    __slots__ = ()
+
+
+class AcceptorJam(Event):
+    __slots__ = ()
+
+
+class StackerJam(Event):
+    __slots__ = ()
+
+
+class Pause(Event):
+    __slots__ = ()
+
+
+class Cheated(Event):
+    __slots__ = ()
+
+
+class Failure(Event):
+    """A hardware failure. `code` is the FAILURE_CODES code and
+    `description` its text, None if unknown.
+    """
     
-    def _on_vend_valid(self, data):
-        logging.info("Vend valid for %s." % self.accepting_denom)
-        self.send_command(ACK, b'')
-        self.accepting_denom = None
+    __slots__ = ('code', 'description')
+    fields = ('code', 'description')
     
-    def _on_stacked(self, data):
-        logging.info("Stacked.")
+    def __init__(self, status, data=b''):
+        Event.__init__(self, status, data)
+        self.code = data[0] if data else None
+        self.description = FAILURE_TABLE[data[0]] if data else None
 
-    def _on_rejecting(self, data):
-        reason = ord(data)
-        if reason in REJECT_REASONS:
-            logging.warning("BV rejecting, reason: %s" % REJECT_REASONS[reason])
-        else:
-            logging.warning("BV rejecting, unknown reason: %02x" % reason)
-    
-    def _on_returning(self, data):
-        logging.info("BV Returning...")
+
+class CommError(Event):
+    __slots__ = ()
+    fields = ('data',)
+
+
+class InvalidCommand(Event):
+    __slots__ = ()
+
+
+EVENT_CLASSES = {
+    IDLE: Idle,
+    ACEPTING: Accepting,
+    ESCROW: Escrow,
+    STACKING: Stacking,
+    VEND_VALID: VendValid,
+    STACKED: Stacked,
+    REJECTING: Rejecting,
+    RETURNING: Returning,
+    HOLDING: Holding,
+    INHIBIT: Inhibit,
+    INITIALIZE: Initialize,
+    POW_UP: PowerUp,
+    POW_UP_BIA: PowerUp,
+    POW_UP_BIS: PowerUp,
+    STACKER_FULL: StackerFull,
+    STACKER_OPEN: StackerOpen,
+    ACCEPTOR_JAM: AcceptorJam,
+    STACKER_JAM: StackerJam,
+    PAUSE: Pause,
+    CHEATED: Cheated,
+    FAILURE: Failure,
+    COMM_ERROR: CommError,
+    INVALID_COMMAND: InvalidCommand,
+}
+
+
+class EventDecoder:
+    """Turn `(status, data)` responses into `Event`s with one table lookup
+    per status. Escrow codes are named after `denoms`, e.g. `ESCROW_USA`.
     
-    def _on_holding(self, data):
-        logging.info("Holding...")
+    The last response decoded is remembered, so polling an unchanged status
+    gives back the same event rather than a new one each time.
+    """
     
-    def _on_inhibit(self, data):
-        logging.warning("BV inhibited.")
-        input("Press enter to reset and initialize BV.")
-        status = None
-        while status != ACK:
-            logging.debug("Sending reset command")
-            self.send_command(RESET, b'')
-            status, data = self.read_response()
-            time.sleep(0.2)
-        logging.debug("Received ACK")
-        if self.req_status()[0] == INITIALIZE:
-            logging.info("Initializing bill validator...")
-            self.initialize()
-        self.bv_status = None
+    def __init__(self, denoms=ESCROW_USA):
+        self.denoms = denoms
+        names = ESCROW_TABLE if denoms is ESCROW_USA else byte_table(denoms)
+        table = [Unknown] * 256
+        for status, cls in EVENT_CLASSES.items():
+            table[status] = cls
+        table[ESCROW] = lambda status, data: Escrow(status, data, names)
+        self.table = tuple(table)
+        self._last = None
+        
+    def decode(self, status, data=b''):
+        last = self._last
+        if last is not None and last.status == status and last.data == data:
+            return last
+        if status is None:
+            event = Timeout(None, data)
+        else:
+            event = self.table[status](status, data)
+        self._last = event
+        return event
+
+
+### Event streams ###
+
+# what a Subscription does with a new event when its queue is full
+BLOCK = 'block'  # wait for the consumer, holding up polling
+DROP_OLDEST = 'drop_oldest'  # make room by discarding the oldest event
+COALESCE = 'coalesce'  # replace a queued event with the same status, else drop the oldest
+POLICIES = (BLOCK, DROP_OLDEST, COALESCE)
+
+_subscription_ids = itertools.count(1)
+# serializes changes to BillVal.subscriptions; readers don't take it
+_subscriptions_lock = threading.Lock()
+
+
+class Subscription:
+    """A bounded queue of the `Event`s a bill validator's poller publishes,
+    one per status change. Iterate over it, or call `get()`, from any
+    thread; `close()` ends the iteration.
     
-    def _on_init(self, data):
-        logging.warning("BV waiting for initialization")
-        input("Press enter to reinitialize the BV.")
-        self.initialize()
+    `policy` decides what happens when the consumer falls `maxsize` events
+    behind, see `POLICIES`. Only BLOCK ever makes the poller wait, and only
+    for up to `timeout` seconds (forever if None) before dropping the event;
+    don't use it with `AsyncBillVal`, whose poller shares the event loop.
+    `depth`, `dropped` and `coalesced` show how the consumer is keeping up,
+    and are exported by `Metrics` under `name`.
+    """
     
-    def send_command(self, command, data=b''):
-        """Send a generic command to the bill validator"""
-        
-        length = 5 + len(data)  # SYNC, length, command, and 16-bit CRC
-        message = bytes([SYNC, length, command]) + data
-        message += get_crc(message)
+    def __init__(self, maxsize=100, policy=DROP_OLDEST, timeout=None, name=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown overflow policy: %r" % (policy,))
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.timeout = timeout
+        self.name = name
+        self.dropped = 0  # events discarded because the queue was full
+        self.coalesced = 0  # events that replaced a queued one
+        self.closed = False
+        self.bill_val = None  # set by BillVal.subscribe()
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
         
-        # log message
-        self._raw('>', message)
+    def __repr__(self):
+        return '<Subscription %s %s depth=%d dropped=%d>' % (self.name, self.policy,
+                                                             self.depth, self.dropped)
         
-        return self.com.write(message)
+    @property
+    def depth(self):
+        """Events waiting to be consumed"""
+        return len(self._queue)
         
-    def read_response(self):
-        """Parse data from the bill validator. Returns a tuple (command, data)"""
-        
-        start = None
-        while start == None:
-            start = self.com.read(1)
-            if len(start) == 0:
-                # read timed out, return None
-                return (None, b'')
-            elif start == b'\x00':
-                return (0x00, b'')
-            elif ord(start) != SYNC and start:
-                raise SyncError("Wrong start byte, got %s" % start)
-            
-        total_length = self.com.read()
-        data_length = ord(total_length) - 5
-        
-        command = self.com.read()
-        
-        if data_length:
-            data = self.com.read(data_length)
-        else:
-            data = b''
-            
-        crc = self.com.read(2)
+    def put(self, event):
+        """Queue `event` according to the overflow policy. Returns False if
+        it was dropped.
+        """
         
-        # log message
-        full_msg = start + total_length + command + data
-        self._raw('<', full_msg)
+        events = self._queue
+        with self._cond:
+            if self.closed:
+                return False
+            if len(events) >= self.maxsize:
+                if self.policy == BLOCK:
+                    if not self._cond.wait_for(lambda: len(events) < self.maxsize or self.closed,
+                                               self.timeout) or self.closed:
+                        self.dropped += 1
+                        return False
+                elif self.policy == COALESCE and self._coalesce(event):
+                    return True
+                else:
+                    events.popleft()
+                    self.dropped += 1
+            events.append(event)
+            self._cond.notify_all()
+        return True
         
-        # check our data
-        if get_crc(full_msg) != crc:
-            raise CRCError("CRC mismatch")
-            
-        return ord(command), data
+    def _coalesce(self, event):
+        events = self._queue
+        for i in range(len(events) - 1, -1, -1):
+            if events[i].status == event.status:
+                del events[i]
+                events.append(event)
+                self.coalesced += 1
+                self._cond.notify_all()
+                return True
+        return False
         
-    def power_on(self, *args, **kwargs):
-        """Handle startup routines"""
+    def get(self, timeout=None):
+        """The next event, waiting up to `timeout` seconds (forever if None)
+        for one. Raises `queue.Empty` if none came, or the subscription was
+        closed with nothing left in it.
+        """
         
-        self.bv_on = True
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._queue or self.closed, timeout) \
+                    or not self._queue:
+                raise queue.Empty
+            event = self._queue.popleft()
+            self._cond.notify_all()
+        return event
         
-        status = None
-        while status is None or status == 0x00:
-            status, data = self.req_status()
-            if not self.bv_on:
-                # in case polling thread needs to be terminated before power up
-                self.init_status = None
-                return
+    def __iter__(self):
+        return self
         
-        self.init_status = status
+    def __next__(self):
+        try:
+            return self.get()
+        except queue.Empty:
+            raise StopIteration
             
-        if status not in POW_STATUSES:
-            logging.warning("Acceptor already powered up, status: %02x" % status)
-            return self.init_status
-        elif status == POW_UP:
-            logging.info("Powering up...")
-            logging.info("Getting version...")
-            self.send_command(GET_VERSION)
-            status, self.bv_version = self.read_response()
-            logging.info("BV software version: %s" % self.bv_version.decode())
-            
-            while status != ACK:
-                logging.debug("Sending reset command")
-                self.send_command(RESET)
-                status, data = self.read_response()
-                
-            if self.req_status()[0] == INITIALIZE:
-                self.initialize(*args, **kwargs)
-        else:
-            # Acceptor should either reject or stack bill
-            while status != ACK:
-                self.send_command(RESET)
-                status, data = self.read_response()
-                
-            if self.req_status()[0] == INITIALIZE:
-                self.initialize(*args, **kwargs)
-                    
-        # typically call BillVal.poll() after this
+    def __enter__(self):
+        return self
         
-        return self.init_status
+    def __exit__(self, *exc):
+        self.close()
+        
+    def close(self):
+        """Stop receiving events. Ones already queued can still be read."""
+        
+        if self.bill_val is not None:
+            self.bill_val.unsubscribe(self)
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+### Logging ###
+
+LOG_FORMAT = "[%(asctime)s] %(levelname)s: %(message)s"
+CONSOLE_FORMAT = "%(levelname)s: %(message)s"
+
+
+class RepeatFilter(logging.Filter):
+    """Let the same message through at most once every `interval` seconds.
     
-    def initialize(self, denom=[0x82, 0], sec=[0, 0], dir=[0], opt_func=[0, 0], 
-                   inhibit=[0], bar_func=[0x01, 0x12], bar_inhibit=[0]):
-        """Initialize BV settings"""
-        
-        logging.debug("Setting denom inhibit: %r" % denom)
-        denom = bytes(denom)
-        self.send_command(SET_DENOM, denom)
-        status, data = self.read_response()
-        if (status, data) != (SET_DENOM, denom):
-            logging.warning("Acceptor did not echo denom settings")
-        
-        logging.debug("Setting security: %r" % sec)
-        sec = bytes(sec)
-        self.send_command(SET_SECURITY, sec)
-        status, data = self.read_response()
-        if (status, data) != (SET_SECURITY, sec):
-            logging.warning("Acceptor did not echo security settings")
-            
-        logging.debug("Setting direction inhibit: %r" % dir)
-        dir = bytes(dir)
-        self.send_command(SET_DIRECTION, dir)
-        status, data = self.read_response()
-        if (status, data) != (SET_DIRECTION, dir):
-            logging.warning("Acceptor did not echo direction settings")
-        
-        logging.debug("Setting optional functions: %r" % opt_func)
-        opt_func = bytes(opt_func)
-        self.send_command(SET_OPT_FUNC, opt_func)
-        status, data = self.read_response()
-        if (status, data) != (SET_OPT_FUNC, opt_func):
-            logging.warning("Acceptor did not echo option function settings")
-            
-        logging.debug("Setting inhibit: %r" % inhibit)
-        inhibit = bytes(inhibit)
-        self.send_command(SET_INHIBIT, inhibit)
-        status, data = self.read_response()
-        if (status, data) != (SET_INHIBIT, inhibit):
-            logging.warning("Acceptor did not echo inhibit settings")
-        
-        logging.debug("Setting barcode functions: %r" % bar_func)
-        bar_func = bytes(bar_func)
-        self.send_command(SET_BAR_FUNC, bar_func)
-        status, data = self.read_response()
-        if (status, data) != (SET_BAR_FUNC, bar_func):
-            logging.warning("Acceptor did not echo barcode settings")
-
-        logging.debug("Setting barcode inhibit: %r" % bar_inhibit)
-        bar_inhibit = bytes(bar_inhibit)
-        self.send_command(SET_BAR_INHIBIT, bar_inhibit)
-        status, data = self.read_response()
-        if (status, data) != (SET_BAR_INHIBIT, bar_inhibit):
-            logging.warning("Acceptor did not echo barcode inhibit settings")
-            
-        while self.req_status()[0] == INITIALIZE:
-            # wait for initialization to finish
-            time.sleep(0.2)
+    Messages are the same if they have the same logger, level, format string
+    and arguments, so a flapping STACKER_OPEN or a storm of COMM_ERRORs is
+    logged once per interval rather than on every poll. Repeats in between
+    are counted, and the count goes out with the next one let through;
+    `summary()` hands back the counts not reported yet.
     
-    def req_status(self):
-        """Send status request to bill validator"""
+    Only records at `level` and up are held back. Below that are the
+    accepting/escrow/stack/vend records of each transaction, which are
+    logged however often they repeat.
+    """
+    
+    def __init__(self, interval=10.0, max_keys=1024, level=logging.WARNING):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.level = level
+        self.max_keys = max_keys
+        self.suppressed = 0  # in all
+        self._seen = {}  # key -> [when last let through, repeats since]
+        self._lock = threading.Lock()
         
-        if not self.bv_on:
-            # in case polling thread needs to be terminated before power up
-            return None, b''
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        key = (record.name, record.levelno, record.msg, record.args)
+        try:
+            hash(key)
+        except TypeError:
+            return True  # can't tell repeats apart with unhashable arguments
+        now = record.created
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen is not None and now - seen[0] < self.interval:
+                seen[1] += 1
+                self.suppressed += 1
+                return False
+            if seen is None and len(self._seen) >= self.max_keys:
+                self._prune(now)
+            self._seen[key] = [now, 0]
+        if seen is not None and seen[1]:
+            record.args = (record.getMessage(), seen[1], now - seen[0])
+            record.msg = "%s (repeated %d times in the last %.0f s)"
+        return True
         
-        if self.com.in_waiting:
-            # discard any unused data
-            logging.warning("Found unused data in buffer, %r" % self.com.read(self.com.in_waiting))
+    def _prune(self, now):
+        # forget messages not seen for a while, unless they have repeats to report
+        self._seen = {key: seen for key, seen in self._seen.items()
+                      if seen[1] or now - seen[0] < self.interval}
+        if len(self._seen) >= self.max_keys:
+            self._seen.clear()
             
-        self.send_command(STATUS_REQ)
+    def summary(self):
+        """[(logger name, level, message, repeats)] for the messages repeated
+        since they were last let through. Their counts start over.
+        """
         
-        stat, data = self.read_response()
-        if stat not in self.all_statuses + (0x00, None):
-            logging.warning("Unknown status code received: %02x, data: %r" % stat, data)
+        result = []
+        with self._lock:
+            for (name, level, msg, args), seen in self._seen.items():
+                if seen[1]:
+                    try:
+                        message = msg % args if args else str(msg)
+                    except (TypeError, ValueError):
+                        message = str(msg)
+                    result.append((name, level, message, seen[1]))
+                    seen[1] = 0
+        return result
         
-        return stat, data
         
-    def poll(self, interval=0.2):
-        """Send a status request to the bill validator every `interval` seconds
-        and fire event handlers. `interval` defaults to 200 ms, per ID-003 spec.
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """Queue records as they are, for the listener's thread to format. The
+    stock `QueueHandler` formats them on the way in so they can be pickled;
+    these never leave the process.
+    """
+    
+    def prepare(self, record):
+        return record
         
-        Event handlers are only fired upon status changes. Event handlers can
-        set `self.bv_status` to None to force event handler to fire on the next
-        status request.
-        """
         
-        while True:
-            poll_start = time.time()
-            status, data = self.req_status()
-            if (status, data) != self.bv_status:
-                if status in self.bv_events:
-                    self.bv_events[status](data)
-            self.bv_status = (status, data)
-            wait = interval - (time.time() - poll_start)
-            if wait > 0.0:
-                time.sleep(wait)
+class LogListener(logging.handlers.QueueListener):
+    """Writes out the records `configure_logging()` queues, on its own
+    thread. `stop()` reports any repeats still being counted, writes out
+    what's queued and detaches from the logger.
+    """
+    
+    def __init__(self, logger, queue_handler, handlers, repeats=None):
+        logging.handlers.QueueListener.__init__(self, queue_handler.queue, *handlers,
+                                                respect_handler_level=True)
+        self.logger = logger
+        self.queue_handler = queue_handler
+        self.repeats = repeats
+        self.console = None  # the StreamHandler, to quieten it while drawing full-screen
+        
+    def stop(self):
+        if self._thread is None:
+            return
+        if self.repeats is not None:
+            for name, level, message, n in self.repeats.summary():
+                logging.getLogger(name).log(level, "%s (repeated %d more times)", message, n)
+        self.logger.removeHandler(self.queue_handler)
+        logging.handlers.QueueListener.stop(self)
+        for handler in self.handlers:
+            handler.close()
             
+            
+def configure_logging(filename='debug.log', level=logging.DEBUG, console=logging.INFO,
+                      repeat_interval=10.0, logger=''):
+    """Log to `filename` at `level` and up, and to the console at `console`
+    and up (None for no console), from a background thread. A logging call
+    only queues the record; formatting and I/O happen on the listener's
+    thread, so a slow disk or terminal doesn't hold up polling. The same
+    warning or error is let through once every `repeat_interval` seconds
+    (None to log every one), see `RepeatFilter`.
+    
+    Sets up `logger`, the root logger by default. Nothing in this module
+    configures logging otherwise; it logs to the 'id003' logger. Returns
+    the `LogListener`, to stop() on the way out.
+    """
+    
+    handlers = []
+    console_handler = None
+    if filename:
+        handler = logging.FileHandler(filename, 'w')
+        handler.setLevel(level)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handlers.append(handler)
+    if console is not None:
+        handler = console_handler = logging.StreamHandler()
+        handler.setLevel(console)
+        handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+        handlers.append(handler)
+        
+    queue_handler = _LazyQueueHandler(queue.SimpleQueue())
+    repeats = None
+    if repeat_interval:
+        # dropped on the calling thread, before they're even queued
+        repeats = RepeatFilter(repeat_interval)
+        queue_handler.addFilter(repeats)
+    target = logging.getLogger(logger)
+    target.setLevel(min(level, console) if console is not None else level)
+    target.addHandler(queue_handler)
+    
+    listener = LogListener(target, queue_handler, handlers, repeats)
+    listener.console = console_handler
+    listener.start()
+    return listener
+
+
+### Metrics ###
+
+# histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+DECISION_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 30.0)
+JITTER_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+RECOVERY_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class Histogram:
+    """Fixed-bucket histogram. `counts[i]` is the number of observations no
+    greater than `buckets[i]` and above the bucket before it; the last count
+    is everything above the last bucket.
+    """
+    
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
         
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        
+    def quantile(self, q):
+        """Estimate the `q` quantile (0-1) as the upper bound of the bucket
+        it falls in. Returns None with no observations, or inf if it's past
+        the last bucket.
+        """
+        
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """Per-port, per-command counters and latency histograms.
+    
+    Recording is a dict lookup and a couple of additions, so it's meant to
+    stay enabled in production. `BillVal` records into the module-level
+    `METRICS` registry unless given another one (or None to disable).
+    """
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.latency = {}  # (port, command) -> Histogram
+        self.timeouts = collections.Counter()  # (port, command) -> count
+        self.retries = collections.Counter()  # (port, command) -> resends
+        self.failures = collections.Counter()  # (port, command) -> gave up after all retries
+        self.counters = collections.Counter()  # (name, port) -> count
+        self.decoders = {}  # port -> FrameDecoder, for its error counts
+        self.decisions = {}  # port -> Histogram of escrow decision times
+        self.jitter = {}  # port -> Histogram of how late polls started
+        self.subscriptions = {}  # port -> list of Subscriptions, for their queues
+        self.recoveries = {}  # port -> Histogram of how long reconnecting took
+        
+    def add_port(self, port, decoder):
+        """Report `decoder`'s CRC errors and skipped bytes under `port`"""
+        self.decoders[port] = decoder
+        
+    def add_subscription(self, port, subscription):
+        """Report `subscription`'s queue depth and drops under `port`"""
+        self.subscriptions.setdefault(port, []).append(subscription)
+        
+    def remove_subscription(self, port, subscription):
+        subs = self.subscriptions.get(port, [])
+        if subscription in subs:
+            subs.remove(subscription)
+            
+    def histogram(self, port, command):
+        """The latency histogram for `command` on `port`. Callers on the hot
+        path should hold on to it rather than look it up every time.
+        """
+        
+        hist = self.latency.get((port, command))
+        if hist is None:
+            hist = self.latency[port, command] = Histogram(self.buckets)
+        return hist
+        
+    def observe(self, port, command, seconds):
+        """Record a command/response round-trip"""
+        self.histogram(port, command).observe(seconds)
+        
+    def decision(self, port, seconds, late=False):
+        """Record how long the host took to decide on a bill in escrow"""
+        
+        hist = self.decisions.get(port)
+        if hist is None:
+            hist = self.decisions[port] = Histogram(DECISION_BUCKETS)
+        hist.observe(seconds)
+        if late:
+            self.count('late_escrow_decisions', port)
+        
+    def poll_jitter(self, port):
+        """The histogram of how late each poll on `port` started, for a
+        `PollScheduler` to record into
+        """
+        
+        hist = self.jitter.get(port)
+        if hist is None:
+            hist = self.jitter[port] = Histogram(JITTER_BUCKETS)
+        return hist
+        
+    def reconnected(self, port, seconds):
+        """Record how long it took to get a lost serial port back and polling
+        again, or None if it couldn't be
+        """
+        
+        if seconds is None:
+            self.count('reconnect_failures', port)
+            return
+        hist = self.recoveries.get(port)
+        if hist is None:
+            hist = self.recoveries[port] = Histogram(RECOVERY_BUCKETS)
+        hist.observe(seconds)
+        
+    def timeout(self, port, command):
+        """Record a command that got no response"""
+        self.timeouts[port, command] += 1
+        
+    def retried(self, port, command, retries, failed=False):
+        """Record how many times a command had to be resent, and whether it
+        failed even so
+        """
+        
+        if retries:
+            self.retries[port, command] += retries
+        if failed:
+            self.failures[port, command] += 1
+        
+    def count(self, name, port, n=1):
+        """Increment a free-form counter, exported as id003_<name>_total"""
+        self.counters[name, port] += n
+        
+    def render(self):
+        """Metrics in the Prometheus text exposition format"""
+        
+        lines = []
+        add = lines.append
+        
+        add("# HELP id003_command_latency_seconds Time from sending a command to its response")
+        add("# TYPE id003_command_latency_seconds histogram")
+        for (port, command), hist in sorted(list(self.latency.items())):
+            labels = 'port="%s",command="0x%02x"' % (_escape_label(port), command)
+            _render_histogram(add, 'id003_command_latency_seconds', labels, hist)
+            
+        add("# HELP id003_escrow_decision_seconds Time taken to decide on a bill in escrow")
+        add("# TYPE id003_escrow_decision_seconds histogram")
+        for port, hist in sorted(list(self.decisions.items())):
+            labels = 'port="%s"' % _escape_label(port)
+            _render_histogram(add, 'id003_escrow_decision_seconds', labels, hist)
+            
+        add("# HELP id003_poll_jitter_seconds How late each status request was sent, against its schedule")
+        add("# TYPE id003_poll_jitter_seconds histogram")
+        for port, hist in sorted(list(self.jitter.items())):
+            labels = 'port="%s"' % _escape_label(port)
+            _render_histogram(add, 'id003_poll_jitter_seconds', labels, hist)
+            
+        add("# HELP id003_reconnect_seconds Time from losing the serial port to polling it again")
+        add("# TYPE id003_reconnect_seconds histogram")
+        for port, hist in sorted(list(self.recoveries.items())):
+            labels = 'port="%s"' % _escape_label(port)
+            _render_histogram(add, 'id003_reconnect_seconds', labels, hist)
+            
+        add("# HELP id003_response_timeouts_total Commands that got no response before the read timed out")
+        add("# TYPE id003_response_timeouts_total counter")
+        for (port, command), n in sorted(list(self.timeouts.items())):
+            add('id003_response_timeouts_total{port="%s",command="0x%02x"} %d'
+                % (_escape_label(port), command, n))
+            
+        add("# HELP id003_command_retries_total Commands resent for want of the expected response")
+        add("# TYPE id003_command_retries_total counter")
+        for (port, command), n in sorted(list(self.retries.items())):
+            add('id003_command_retries_total{port="%s",command="0x%02x"} %d'
+                % (_escape_label(port), command, n))
+        add("# HELP id003_command_failures_total Commands given up on after all retries")
+        add("# TYPE id003_command_failures_total counter")
+        for (port, command), n in sorted(list(self.failures.items())):
+            add('id003_command_failures_total{port="%s",command="0x%02x"} %d'
+                % (_escape_label(port), command, n))
+            
+        decoders = sorted(list(self.decoders.items()))
+        add("# HELP id003_crc_errors_total Received frames dropped because of a bad CRC")
+        add("# TYPE id003_crc_errors_total counter")
+        for port, decoder in decoders:
+            add('id003_crc_errors_total{port="%s"} %d' % (_escape_label(port), decoder.crc_errors))
+        add("# HELP id003_skipped_bytes_total Received bytes skipped while resynchronizing")
+        add("# TYPE id003_skipped_bytes_total counter")
+        for port, decoder in decoders:
+            add('id003_skipped_bytes_total{port="%s"} %d' % (_escape_label(port), decoder.skipped))
+            
+        subs = [(port, sub) for port, port_subs in sorted(list(self.subscriptions.items()))
+                for sub in list(port_subs)]
+        for name, kind, help, attr in (
+                ('event_queue_depth', 'gauge', "Events waiting in a subscription's queue", 'depth'),
+                ('events_dropped_total', 'counter', "Events dropped because a subscription's queue was full",
+                 'dropped'),
+                ('events_coalesced_total', 'counter', "Events that replaced a queued one with the same status",
+                 'coalesced')):
+            add("# HELP id003_%s %s" % (name, help))
+            add("# TYPE id003_%s %s" % (name, kind))
+            for port, sub in subs:
+                add('id003_%s{port="%s",subscription="%s"} %d'
+                    % (name, _escape_label(port), _escape_label(sub.name), getattr(sub, attr)))
+                
+        names = sorted(set(name for name, port in list(self.counters)))
+        for name in names:
+            add("# TYPE id003_%s_total counter" % name)
+            for (n, port), value in sorted(list(self.counters.items())):
+                if n == name:
+                    add('id003_%s_total{port="%s"} %s' % (name, _escape_label(port), value))
+                    
+        return '\n'.join(lines) + '\n'
+        
+    def write(self, path):
+        """Write `render()` to `path` atomically, e.g. for node_exporter's
+        textfile collector
+        """
+        
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+
+def _render_histogram(add, name, labels, hist):
+    cumulative = 0
+    for bound, n in zip(hist.buckets, hist.counts):
+        cumulative += n
+        add('%s_bucket{%s,le="%g"} %d' % (name, labels, bound, cumulative))
+    add('%s_bucket{%s,le="+Inf"} %d' % (name, labels, hist.count))
+    add('%s_sum{%s} %.6f' % (name, labels, hist.sum))
+    add('%s_count{%s} %d' % (name, labels, hist.count))
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+METRICS = Metrics()
+
+
+def start_metrics_server(port=9003, addr='', metrics=METRICS):
+    """Serve `metrics` over HTTP for Prometheus to scrape, from a daemon
+    thread. Returns the server; call its `shutdown()` to stop it.
+    """
+    
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            
+        def log_message(self, format, *args):
+            pass
+            
+    server = http.server.ThreadingHTTPServer((addr, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_metrics_file(path, interval=15.0, metrics=METRICS):
+    """Rewrite `path` with `metrics` every `interval` seconds from a daemon
+    thread. Returns a `threading.Event`; set it to stop.
+    """
+    
+    stop = threading.Event()
+    
+    def run():
+        while not stop.is_set():
+            try:
+                metrics.write(path)
+            except OSError as e:
+                log.warning("Couldn't write metrics to %s: %s", path, e)
+            stop.wait(interval)
+            
+    threading.Thread(target=run, daemon=True).start()
+    return stop
+
+
+### Decisions ###
+
+# seconds the host has to decide before the acceptor gives up on a bill in
+# escrow and returns it; depends on the model and its settings
+ESCROW_TIMEOUT = 10.0
+
+
+class Decision:
+    """A decision the host owes the bill validator, e.g. whether to stack or
+    return the bill in escrow. Polling carries on while it's pending.
+    
+    `future` resolves to the decision; `statuses` are the ones the bill
+    validator reports while it's still waiting for it.
+    """
+    
+    __slots__ = ('kind', 'future', 'statuses', 'info', 'started', 'elapsed', 'result', 'late')
+    
+    def __init__(self, kind, future, statuses, info=None):
+        self.kind = kind
+        self.future = future
+        self.statuses = statuses
+        self.info = info
+        self.started = time.monotonic()
+        self.elapsed = None  # seconds taken, once decided
+        self.result = None
+        self.late = False  # took longer than the escrow timeout
+        
+    def __repr__(self):
+        return '<Decision %s result=%r elapsed=%r>' % (self.kind, self.result, self.elapsed)
+
+
+def completed(result):
+    """Wrap a decision that's already been made in a finished Future"""
+    
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+
+def run_in_thread(func, *args):
+    """Run `func(*args)` on a daemon thread. Returns a Future for its result."""
+    
+    future = concurrent.futures.Future()
+    
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+            
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def console_escrow(lock=None):
+    """Escrow decider that asks on the console, from its own thread so the
+    poll loop isn't held up. `lock` is held while asking, e.g. to keep other
+    threads off the screen and keyboard.
+    """
+    
+    def ask():
+        with lock or contextlib.nullcontext():
+            s_r = ''
+            while s_r not in ('1', '2', 'r'):
+                s_r = input("(1) Stack and acknowledge when bill passes stacker lever\n"
+                            "(2) Stack and acknowledge when bill is stored\n"
+                            "(R)eturn ").lower()
+        return {'1': STACK_1, '2': STACK_2, 'r': RETURN}[s_r]
+        
+    def decide(escrow, barcode):
+        return run_in_thread(ask)
+        
+    return decide
+
+
+def console_confirm(lock=None):
+    """Confirmation callback that waits for enter on the console, from its own
+    thread. See `console_escrow()`.
+    """
+    
+    def ask(prompt):
+        with lock or contextlib.nullcontext():
+            input(prompt)
+        return True
+        
+    def confirm(prompt):
+        return run_in_thread(ask, prompt)
+        
+    return confirm
+
+
+### Transactions ###
+
+class RetryPolicy:
+    """How `BillVal.transact()` retries a command that got no proper
+    response: up to `attempts` sends, each waiting `timeout` seconds for
+    the response (None for the serial port's own timeout), with a pause
+    of `backoff` seconds before the first retry, growing by `factor` each
+    time up to `max_backoff`.
+    """
+    
+    __slots__ = ('attempts', 'timeout', 'backoff', 'factor', 'max_backoff')
+    
+    def __init__(self, attempts=5, timeout=None, backoff=0.05, factor=2.0, max_backoff=1.0):
+        if attempts < 1:
+            raise ValueError("attempts must be at least 1")
+        self.attempts = attempts
+        self.timeout = timeout
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        
+    def __repr__(self):
+        return '<RetryPolicy attempts=%d timeout=%r backoff=%r>' % (self.attempts, self.timeout,
+                                                                    self.backoff)
+        
+    def delay(self, retry):
+        """Seconds to wait before retry number `retry` (1 for the first)"""
+        return min(self.backoff * self.factor ** (retry - 1), self.max_backoff)
+
+
+DEFAULT_RETRY = RetryPolicy()
+
+# a reset can take the acceptor a moment to get to, so give it longer
+RETRY_POLICIES = {
+    RESET: RetryPolicy(attempts=10, timeout=0.2, backoff=0.2, max_backoff=2.0),
+}
+
+
+class CommandTimeout(AckError):
+    """A command got no expected response within its retry budget"""
+    
+    def __init__(self, command, attempts, response):
+        self.command = command
+        self.attempts = attempts
+        self.response = response  # the last (status, data) received instead
+        AckError.__init__(self, "No response to command %02x after %d attempt(s), last got %r"
+                          % (command, attempts, response))
+
+
+### Device profiles ###
+
+# escrow code tables by the country code in the software version, e.g.
+# b'i(USA)100-SS ID003-05V271-36 15NOV11 0F08'
+DENOMS_BY_COUNTRY = {
+    'USA': ESCROW_USA,
+}
+
+_COUNTRY = re.compile(r'\((\w+)\)')
+
+
+def denoms_for_version(version, default=ESCROW_USA):
+    """The escrow code table for a bill validator's software version, or
+    `default` if the version doesn't name a country we have one for
+    """
+    
+    if isinstance(version, bytes):
+        version = version.decode('ascii', 'replace')
+    match = _COUNTRY.search(version or '')
+    if match is None or match.group(1) not in DENOMS_BY_COUNTRY:
+        log.warning("No denominations known for BV version %r, assuming USA", version)
+        return default
+    return DENOMS_BY_COUNTRY[match.group(1)]
+
+
+class DeviceProfile:
+    """What `BillVal.power_on()` learned about the bill validator on `port`:
+    its software and boot versions, escrow code table and the settings last
+    applied (SET_* command -> value)
+    """
+    
+    __slots__ = ('port', 'version', 'boot_version', 'denoms', 'settings', 'saved')
+    
+    def __init__(self, port, version=None, boot_version=None, denoms=None, settings=None, saved=None):
+        self.port = port
+        self.version = version
+        self.boot_version = boot_version
+        self.denoms = denoms
+        self.settings = settings or {}
+        self.saved = saved  # wall clock time it was written
+        
+    def __repr__(self):
+        return '<DeviceProfile %s version=%r>' % (self.port, self.version)
+        
+    def to_json(self):
+        text = lambda b: None if b is None else b.decode('latin-1')
+        return {
+            'version': text(self.version),
+            'boot_version': text(self.boot_version),
+            'denoms': None if self.denoms is None else {str(k): v for k, v in self.denoms.items()},
+            'settings': {str(k): v.hex() for k, v in self.settings.items()},
+            'saved': self.saved,
+        }
+        
+    @classmethod
+    def from_json(cls, port, obj):
+        raw = lambda s: None if s is None else s.encode('latin-1')
+        denoms = obj.get('denoms')
+        return cls(port, raw(obj.get('version')), raw(obj.get('boot_version')),
+                   None if denoms is None else {int(k): v for k, v in denoms.items()},
+                   {int(k): bytes.fromhex(v) for k, v in obj.get('settings', {}).items()},
+                   obj.get('saved'))
+
+
+class ProfileCache:
+    """`DeviceProfile`s on disk, in one JSON file keyed by port, so a
+    restarted process can skip powering up validators that are already
+    running with the right settings. See `BillVal.power_on()`.
+    """
+    
+    def __init__(self, path='id003_profiles.json'):
+        self.path = path
+        self._lock = threading.Lock()
+        
+    def __repr__(self):
+        return '<ProfileCache %s>' % self.path
+        
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring unreadable profile cache %s: %s", self.path, e)
+            return {}
+            
+    def _write(self, profiles):
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(profiles, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+        
+    def load(self, port):
+        """The profile cached for `port`, or None"""
+        
+        with self._lock:
+            obj = self._read().get(port)
+        if obj is None:
+            return None
+        try:
+            return DeviceProfile.from_json(port, obj)
+        except (AttributeError, TypeError, ValueError) as e:
+            log.warning("Ignoring bad cached profile for %s: %s", port, e)
+            return None
+            
+    def save(self, profile):
+        profile.saved = time.time()
+        with self._lock:
+            profiles = self._read()
+            profiles[profile.port] = profile.to_json()
+            try:
+                self._write(profiles)
+            except OSError as e:
+                log.warning("Could not write profile cache %s: %s", self.path, e)
+                
+    def forget(self, port):
+        """Drop `port`'s profile, so its next power-up is a full one"""
+        
+        with self._lock:
+            profiles = self._read()
+            if profiles.pop(port, None) is not None:
+                self._write(profiles)
+
+
+### Reconnecting ###
+
+# what reading or writing a serial port raises once the device is gone
+# (SerialException is an OSError too, but say what's meant)
+PORT_ERRORS = (serial.SerialException, OSError)
+
+# how long to keep trying to get a lost port back: backing off to a try
+# every 5 seconds, for about 5 minutes in all
+RECONNECT_RETRY = RetryPolicy(attempts=65, backoff=0.25, factor=2.0, max_backoff=5.0)
+
+
+def usb_identity(port):
+    """(vid, pid, serial_number, location) of the USB adapter behind serial
+    port `port`, as `serial.tools.list_ports` reports it, or None if it isn't
+    one
+    """
+    
+    for info in serial.tools.list_ports.comports():
+        if info.device == port and info.vid is not None:
+            return (info.vid, info.pid, info.serial_number, info.location)
+    return None
+
+
+def find_port(identity):
+    """The device path USB adapter `identity` (see `usb_identity()`) is at
+    now, or None if it isn't plugged in. Matched on its serial number if it
+    has one, otherwise on where it's plugged in.
+    """
+    
+    vid, pid, serial_number, location = identity
+    for info in serial.tools.list_ports.comports():
+        if info.vid != vid or info.pid != pid:
+            continue
+        if serial_number is not None:
+            if info.serial_number == serial_number:
+                return info.device
+        elif info.location == location:
+            return info.device
+    return None
+
+
+### Poll scheduling ###
+
+# poll intervals, in seconds: the 200 ms the spec asks for, how fast to go
+# while a bill is on its way through, and the furthest an adaptive scheduler
+# backs off while nothing is happening (never past the spec's interval)
+POLL_INTERVAL = 0.2
+POLL_FAST = 0.1
+POLL_SLOW = 0.2
+
+# statuses polled at the fast interval; a bill is moving or waiting on us
+POLL_FAST_STATES = (ACEPTING, ESCROW, HOLDING, STACKING, VEND_VALID, STACKED, RETURNING)
+# statuses the interval backs off from
+POLL_IDLE_STATES = (IDLE, INHIBIT)
+
+
+class PollScheduler:
+    """Decide when to send the next status request.
+    
+    Targets are kept on the monotonic clock and each one is scheduled from
+    the last target rather than from when the poll finished, so the rate
+    doesn't drift with round-trip times and isn't thrown off by wall clock
+    changes. If polling falls more than an interval behind it starts again
+    from now instead of firing a burst of catch-up polls.
+    
+    By default every poll is `interval` apart. Adapting to the status is
+    opt-in: with `fast` (e.g. `POLL_FAST`), polls are that far apart while a
+    bill is being accepted, stacked or held in escrow, so escrow is seen
+    sooner. With `slow`, the interval grows by `backoff` on every IDLE or
+    INHIBIT poll up to `slow`, which is capped at `POLL_SLOW` (the spec's
+    200 ms) or `interval` if that's longer, so an idle validator is never
+    polled less often than the spec asks. Backing off therefore only does
+    anything with an `interval` below 200 ms.
+    
+    `jitter` is a `Histogram` of how late each poll started against its
+    target; pass one from `Metrics.poll_jitter()` to export it.
+    """
+    
+    def __init__(self, interval=POLL_INTERVAL, fast=None, slow=None, backoff=1.5, jitter=None):
+        self.interval = interval
+        self.fast = min(fast, interval) if fast is not None else interval
+        self.slow = min(max(slow, interval), max(POLL_SLOW, interval)) if slow is not None else interval
+        self.backoff = backoff
+        self.jitter = jitter if jitter is not None else Histogram(JITTER_BUCKETS)
+        
+        self.current = interval  # interval to the next poll
+        self.target = None  # when the next poll is due, on time.monotonic()
+        self.polls = 0
+        self.late_max = 0.0
+        self.interval_sum = 0.0  # of the intervals asked for, for the mean
+        
+    def __repr__(self):
+        return '<PollScheduler current=%.3f polls=%d>' % (self.current, self.polls)
+        
+    def start(self):
+        """Mark the start of a poll. Returns how late it is, in seconds."""
+        
+        now = time.monotonic()
+        if self.target is None:
+            self.target = now
+        late = now - self.target
+        if late < 0.0:
+            late = 0.0
+        self.jitter.observe(late)
+        self.polls += 1
+        if late > self.late_max:
+            self.late_max = late
+        return late
+        
+    def next_interval(self, status):
+        """The interval to use after a poll that returned `status`"""
+        
+        if status in POLL_FAST_STATES:
+            return self.fast
+        elif status in POLL_IDLE_STATES:
+            if self.current < self.interval:
+                return self.interval
+            return min(self.current * self.backoff, self.slow)
+        return self.interval
+        
+    def schedule(self, status):
+        """Set the next target after a poll that returned `status`. Returns
+        the seconds left until it's due.
+        """
+        
+        self.current = self.next_interval(status)
+        self.interval_sum += self.current
+        now = time.monotonic()
+        if self.target is None:
+            self.target = now
+        self.target += self.current
+        if self.target < now:
+            self.target = now + self.current
+        return self.target - now
+        
+    def wait(self, status):
+        """`schedule()` and sleep until the next poll is due"""
+        
+        wait = self.schedule(status)
+        if wait > 0.0:
+            time.sleep(wait)
+        
+    def stats(self):
+        """Achieved-versus-target timing so far, in seconds"""
+        
+        hist = self.jitter
+        return {
+            'polls': self.polls,
+            'interval_mean': self.interval_sum / self.polls if self.polls else None,
+            'late_mean': hist.sum / hist.count if hist.count else None,
+            'late_p99': hist.quantile(0.99),
+            'late_max': self.late_max,
+        }
+
+
+class BillVal:
+    """Represent an ID-003 bill validator as a subclass of `serial.Serial`"""
+    
+    def __init__(self, port, log_raw=False, threading=False, metrics=METRICS, profiles=None):
+        self.com = self._open(port)
+        self.port = port
+        
+        # to find the port again if it's lost, see reconnect()
+        self.usb_id = usb_identity(port) if port is not None else None
+        self.reconnect_policy = RECONNECT_RETRY  # None to let port errors through
+        self.last_recovery = None  # seconds the last reconnect() took
+        
+        self.bv_status = None
+        self.bv_version = None
+        self.bv_boot_version = None
+        # ProfileCache (or its path) for warm restarts, see power_on()
+        self.profiles = ProfileCache(profiles) if isinstance(profiles, str) else profiles
+        self.settings = {}  # SET_* command -> value last sent or confirmed
+        self.init_timings = None
+        
+        self.threading = threading
+        
+        self.all_statuses = NORM_STATUSES + ERROR_STATUSES + POW_STATUSES
+        self._known = status_table(self.all_statuses + (0x00,))
+        
+        self._decoder = FrameDecoder()
+        
+        # on POSIX the port's file descriptor is read directly into one
+        # reusable buffer, see _read_fd()
+        self._rx = bytearray(256)
+        self._rx_buffers = [self._rx]
+        self._rx_views = [None] * (len(self._rx) + 1)  # n -> view of the first n bytes
+        self._rx_fd = None
+        self._rx_poller = None
+        
+        # latency and error counts, see `Metrics`
+        self.metrics = metrics
+        self._sent = None  # last command sent, awaiting a response
+        self._sent_at = 0.0
+        self._histograms = {}  # command -> Histogram
+        if metrics is not None:
+            metrics.add_port(port, self._decoder)
+            
+        self.bv_events = {
+            IDLE: self._on_idle,
+            ACEPTING: self._on_accepting,
+            ESCROW: self._on_escrow,
+            STACKING: self._on_stacking,
+            VEND_VALID: self._on_vend_valid,
+            STACKED: self._on_stacked,
+            REJECTING: self._on_rejecting,
+            RETURNING: self._on_returning,
+            HOLDING: self._on_holding,
+            INHIBIT: self._on_inhibit,
+            INITIALIZE: self._on_init,
+            STACKER_FULL: self._on_stacker_full,
+            STACKER_OPEN: self._on_stacker_open,
+            ACCEPTOR_JAM: self._on_acceptor_jam,
+            STACKER_JAM: self._on_stacker_jam,
+            PAUSE: self._on_pause,
+            CHEATED: self._on_cheated,
+            FAILURE: self._on_failure,
+            COMM_ERROR: self._on_comm_error,
+            INVALID_COMMAND: self._on_invalid_command,
+        }
+        
+        # until power_on() gets the version, see denoms_for_version()
+        self.bv_denoms = ESCROW_USA
+        self.event_decoder = None  # EventDecoder for bv_denoms, see decode_event()
+        self.subscriptions = []  # fed by the poller, see subscribe()
+        
+        # Called with (escrow, barcode) when a bill is in escrow, returns
+        # STACK_1, STACK_2 or RETURN, or a Future that resolves to one.
+        self.escrow_decider = console_escrow()
+        # Called with a prompt before resetting or initializing the BV,
+        # returns whether to go ahead, or a Future that resolves to that.
+        self.confirm = console_confirm()
+        self.escrow_timeout = ESCROW_TIMEOUT
+        # command -> RetryPolicy for transact(), DEFAULT_RETRY for the rest
+        self.retry_policies = dict(RETRY_POLICIES)
+        self.pending = None  # Decision still waiting on the host
+        self.last_decision = None
+        self.scheduler = None  # PollScheduler used by poll()
+        
+        self.bv_on = False
+        # resolves to the status power_on() leaves the bill validator in
+        self.ready = concurrent.futures.Future()
+        self._init_args = ((), {})  # power_on()'s, to initialize again after reconnecting
+        
+        # raw traffic; for everything else see configure_logging()
+        self.raw = log_raw
+    
+    def _open(self, port, timeout=0.05):
+        return serial.Serial(port, 9600, serial.EIGHTBITS, serial.PARITY_EVEN, timeout=timeout)
+        
+    def _raw(self, pre, msg):
+        """Log a complete frame sent ('>') or received ('<'), to a
+        `capture.CaptureWriter` if `log_raw` was one, or to raw.log if it
+        was True
+        """
+        
+        if not self.raw:
+            return
+        if self.raw is not True:
+            self.raw.write(pre, self.port, msg)
+            return
+        if pre == '<':
+            # raw.log has always had received frames without their CRC
+            msg = msg[:-2]
+        msg = ['0x%02x' % x for x in msg]
+        log = open('raw.log', 'a')
+        log.write('{} {}\r\n'.format(pre, msg))
+        log.close()
+    
+    def _on_stacker_full(self, data):
+        log.error("Stacker full.")
+    
+    def _on_stacker_open(self, data):
+        log.warning("Stacker open.")
+    
+    def _on_acceptor_jam(self, data):
+        log.error("Acceptor jam.")
+    
+    def _on_stacker_jam(self, data):
+        log.error("Stacker jam.")
+    
+    def _on_pause(self, data):
+        log.warning("BV paused. If there's a second bill being inserted, remove it.")
+    
+    def _on_cheated(self, data):
+        log.warning("BV cheated.")
+    
+    def _on_failure(self, data):
+        event = self.decode_event(FAILURE, data)
+        if event.description is None:
+            log.error("Unknown failure: %s", event.data.hex())
+        else:
+            log.error(event.description)
+    
+    def _on_comm_error(self, data):
+        log.warning("Communication error.")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Details: %s", data.hex(' '))
+    
+    def _on_invalid_command(self, data):
+        log.warning("Invalid command.")
+    
+    def _on_idle(self, data):
+        log.info("BV idle.")
+    
+    def _on_accepting(self, data):
+        log.info("BV accepting...")
+    
+    def _on_escrow(self, data):
+        event = self.decode_event(ESCROW, data)
+        if event.name is None:
+            raise DenomError("Unknown denom in escrow: %s" % event.data[:1].hex())
+        elif event.barcode is not None:
+            log.info("Barcode: %s", event.barcode)
+        else:
+            log.info("Denom: %s", event.name)
+            
+        self._decide('escrow', self.escrow_decider(event.denom, event.barcode), (ESCROW, HOLDING),
+                     event.denom)
+        return self.check_decision(ESCROW)
+    
+    def _on_stacking(self, data):
+        log.info("BV stacking...")
+    
+    def _on_vend_valid(self, data):
+        log.info("Vend valid for %s.", self.accepting_denom)
+        self.accepting_denom = None
+        return self.send_command(ACK, b'')
+    
+    def _on_stacked(self, data):
+        log.info("Stacked.")
+
+    def _on_rejecting(self, data):
+        event = self.decode_event(REJECTING, data)
+        if event.description is not None:
+            log.warning("BV rejecting, reason: %s", event.description)
+        else:
+            log.warning("BV rejecting, unknown reason: %s", event.data.hex())
+    
+    def _on_returning(self, data):
+        log.info("BV Returning...")
+    
+    def _on_holding(self, data):
+        log.info("Holding...")
+    
+    def _on_inhibit(self, data):
+        log.warning("BV inhibited.")
+        self._decide('inhibit', self.confirm("Press enter to reset and initialize BV."), (INHIBIT,))
+        return self.check_decision(INHIBIT)
+    
+    def _on_init(self, data):
+        log.warning("BV waiting for initialization")
+        self._decide('init', self.confirm("Press enter to reinitialize the BV."), (INITIALIZE,))
+        return self.check_decision(INITIALIZE)
+        
+    def subscribe(self, maxsize=100, policy=DROP_OLDEST, timeout=None, name=None):
+        """A new `Subscription` to this bill validator's status changes, as
+        `Event`s. Whichever poller is running (`poll()`, `AsyncBillVal.poll()`
+        or a `BillValFleet`) publishes to it; unlike `bv_events` handlers,
+        consumers read from their own thread at their own pace. Close it
+        when done.
+        """
+        
+        if name is None:
+            name = 'subscription-%d' % next(_subscription_ids)
+        sub = Subscription(maxsize, policy, timeout, name)
+        sub.bill_val = self
+        # replaced rather than appended to, so the poller can go through
+        # the list without a lock; writers still take turns
+        with _subscriptions_lock:
+            self.subscriptions = self.subscriptions + [sub]
+        if self.metrics is not None:
+            self.metrics.add_subscription(self.port, sub)
+        return sub
+        
+    def unsubscribe(self, subscription):
+        with _subscriptions_lock:
+            self.subscriptions = [sub for sub in self.subscriptions if sub is not subscription]
+        if self.metrics is not None:
+            self.metrics.remove_subscription(self.port, subscription)
+            
+    def events(self, maxsize=100, policy=DROP_OLDEST, timeout=None):
+        """Iterate over status change events as they happen, e.g.
+        
+            for event in bv.events():
+                if isinstance(event, id003.Escrow): ...
+                
+        See `subscribe()`, which this is short for.
+        """
+        
+        return self.subscribe(maxsize, policy, timeout)
+        
+    def _publish(self, status, data):
+        subscriptions = self.subscriptions
+        if subscriptions:
+            event = self.decode_event(status, data)
+            for sub in subscriptions:
+                sub.put(event)
+                
+    def decode_event(self, status, data=b''):
+        """The `Event` for a status response, with escrow codes named after
+        `self.bv_denoms`
+        """
+        
+        decoder = self.event_decoder
+        if decoder is None or decoder.denoms is not self.bv_denoms:
+            decoder = self.event_decoder = EventDecoder(self.bv_denoms)
+        return decoder.decode(status, data)
+        
+    def _decide(self, kind, result, statuses, info=None):
+        """Start waiting on a decision. `result` is the decision itself or a
+        future for it.
+        """
+        
+        if inspect.iscoroutine(result):
+            result = asyncio.ensure_future(result)
+        elif not hasattr(result, 'done'):
+            result = completed(result)
+        if self.pending is not None:
+            self.pending.future.cancel()
+        self.pending = Decision(kind, result, statuses, info)
+        
+    def _take_decision(self, status):
+        """Check on the pending decision given the latest status. Returns it
+        once it's ready to be acted on, otherwise None.
+        """
+        
+        pending = self.pending
+        if pending is None:
+            return None
+        elapsed = time.monotonic() - pending.started
+        
+        if status not in pending.statuses and status not in (None, 0x00):
+            # the BV has moved on without us, e.g. returned the bill
+            self.pending = None
+            pending.future.cancel()
+            self._decided(pending, elapsed)
+            log.warning("BV stopped waiting for %s decision after %.2f s", pending.kind, elapsed)
+            return None
+            
+        if not pending.future.done():
+            if pending.kind == 'escrow' and not pending.late and elapsed > self.escrow_timeout:
+                pending.late = True
+                log.warning("Escrow decision still pending after %.1f s", elapsed)
+            return None
+            
+        self.pending = None
+        self._decided(pending, elapsed)
+        return pending
+        
+    def _decided(self, pending, elapsed):
+        pending.elapsed = elapsed
+        if pending.future.cancelled():
+            pending.result = None
+        elif pending.future.exception() is not None:
+            log.error("%s decision failed: %r", pending.kind, pending.future.exception())
+            pending.result = None
+        else:
+            pending.result = pending.future.result()
+            
+        if pending.kind == 'escrow':
+            pending.late = elapsed > self.escrow_timeout
+            if pending.late:
+                log.warning("Escrow decision took %.2f s, past the %.1f s timeout",
+                            elapsed, self.escrow_timeout)
+            if self.metrics is not None:
+                self.metrics.decision(self.port, elapsed, pending.late)
+        self.last_decision = pending
+        
+    def _run(self, steps):
+        """Run protocol `steps`, a generator that yields each I/O call it
+        needs as (method, args). The call's result is sent back in, or the
+        exception it raised thrown in. Returns what the generator returns.
+        
+        The protocol logic is written once as such steps (the `_*_steps()`
+        methods) and shared with `AsyncBillVal`, whose `_run()` awaits the
+        calls instead.
+        """
+        
+        step = steps.send
+        result = None
+        while True:
+            try:
+                method, args = step(result)
+            except StopIteration as e:
+                return e.value
+            try:
+                result = method(*args)
+                step = steps.send
+            except BaseException as e:
+                result = e
+                step = steps.throw
+                
+    def _sleep(self, seconds):
+        if seconds > 0.0:
+            time.sleep(seconds)
+            
+    def check_decision(self, status):
+        """Act on the pending decision, if there is one and it's been made.
+        Call after every status request; `poll()` does.
+        """
+        
+        return self._run(self._check_decision_steps(status))
+        
+    def _check_decision_steps(self, status):
+        pending = self._take_decision(status)
+        if pending is not None:
+            try:
+                yield from self._act_steps(pending)
+            except CommandTimeout as e:
+                # keep polling; the BV returns an unstacked bill by itself,
+                # and asks again if it's still inhibited
+                log.error("Could not act on %s decision: %s", pending.kind, e)
+                self.bv_status = None
+            
+    def _act_steps(self, pending):
+        result = pending.result
+        if pending.kind == 'escrow':
+            if result in (STACK_1, STACK_2):
+                log.info("Sending Stack-%d command...", result - STACK_1 + 1)
+                self.accepting_denom = self.bv_denoms[pending.info]
+            else:
+                log.info("Telling BV to return...")
+                result = RETURN
+            yield from self._transact_steps(result)
+        elif not result:
+            return
+        elif pending.kind == 'inhibit':
+            yield from self._reset_steps()
+        elif pending.kind == 'init':
+            yield from self._initialize_steps()
+        self.bv_status = None
+        
+    def _reset_steps(self):
+        log.debug("Sending reset command")
+        yield from self._transact_steps(RESET)
+        if (yield self.req_status, ())[0] == INITIALIZE:
+            log.info("Initializing bill validator...")
+            yield from self._initialize_steps()
+    
+    def transact(self, command, data=b'', expect=(ACK,), policy=None):
+        """Send `command` and wait for a response with a status in `expect`,
+        resending it as `policy` allows (by default the command's entry in
+        `self.retry_policies`, or `DEFAULT_RETRY`). Returns the (status, data)
+        response.
+        
+        Raises `CommandTimeout` when the attempts run out. Resends and
+        failures are counted per command in the metrics.
+        """
+        
+        return self._run(self._transact_steps(command, data, expect, policy))
+        
+    def _transact_steps(self, command, data=b'', expect=(ACK,), policy=None):
+        if policy is None:
+            policy = self.retry_policies.get(command, DEFAULT_RETRY)
+        response = (None, b'')
+        for attempt in range(policy.attempts):
+            if attempt:
+                log.debug("Resending command %02x, got %r", command, response)
+                yield self._sleep, (policy.delay(attempt),)
+            yield self.send_command, (command, data)
+            response = yield self._wait_response, (policy.timeout,)
+            if response[0] in expect:
+                self._retried(command, attempt)
+                return response
+        self._retried(command, policy.attempts - 1, True)
+        raise CommandTimeout(command, policy.attempts, response)
+        
+    def _wait_response(self, timeout):
+        """`read_response()`, waiting up to `timeout` seconds instead of the
+        serial port's timeout
+        """
+        
+        response = self.read_response()
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+            while response[0] is None and time.monotonic() < deadline:
+                response = self.read_response()
+        return response
+        
+    def _retried(self, command, retries, failed=False):
+        if failed:
+            log.warning("Giving up on command %02x after %d retries", command, retries)
+        elif retries:
+            log.debug("Command %02x needed %d retries", command, retries)
+        if self.metrics is not None:
+            self.metrics.retried(self.port, command, retries, failed)
+            
+    def send_command(self, command, data=b''):
+        """Send a generic command to the bill validator"""
+        
+        if data or command not in FRAMES:
+            message = encode_frame(command, data)
+        else:
+            message = FRAMES[command]
+        
+        # log message
+        self._raw('>', message)
+        
+        self._sent = command
+        self._sent_at = time.perf_counter()
+        fd = getattr(self.com, 'fd', None)
+        if fd is None:
+            return self.com.write(message)
+        return self._write_fd(fd, message)
+        
+    def _write_fd(self, fd, message):
+        """Write straight to the port's file descriptor. pyserial's write()
+        copies the message and waits on select() even when it all went out
+        at once, which it nearly always does for a frame this short.
+        """
+        
+        try:
+            n = os.write(fd, message)
+        except BlockingIOError:
+            n = 0
+        except OSError as e:
+            raise serial.SerialException('write failed: %s' % e)
+        if n < len(message):
+            self.com.write(message[n:])
+        return len(message)
+        
+    def _poller(self, fd):
+        """A `select.poll` object watching `fd` for input, kept from one read
+        to the next
+        """
+        
+        if fd != self._rx_fd:
+            self._rx_poller = select.poll()
+            self._rx_poller.register(fd, select.POLLIN)
+            self._rx_fd = fd
+        return self._rx_poller
+        
+    def _read_fd(self, fd, want):
+        """Read from the port's file descriptor into the decoder until at
+        least `want` bytes came in or the port's timeout runs out. Returns
+        the number of bytes read.
+        
+        Does the job of `self.com.read()` without its per-call allocations:
+        bytes are read into `self._rx` and fed to the decoder through a view
+        kept for each read size.
+        """
+        
+        poller = self._poller(fd)
+        timeout = self.com.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        got = 0
+        while got < want:
+            if deadline is None:
+                ready = poller.poll()
+            else:
+                remaining = deadline - time.monotonic()
+                ready = poller.poll(remaining * 1000) if remaining > 0 else None
+            if not ready:
+                break
+            try:
+                n = os.readv(fd, self._rx_buffers)
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                raise serial.SerialException('read failed: %s' % e)
+            if not n:
+                # same as pyserial: readable but nothing there means the
+                # device is gone
+                raise serial.SerialException(
+                    'device reports readiness to read but returned no data '
+                    '(device disconnected or multiple access on port?)')
+            view = self._rx_views[n]
+            if view is None:
+                view = self._rx_views[n] = memoryview(self._rx)[:n]
+            self._decoder.feed(view)
+            got += n
+        return got
+        
+    def read_response(self):
+        """Parse data from the bill validator. Returns a tuple (command, data),
+        or (None, b'') if no complete frame arrived before the read timed out.
+        
+        Stray bytes are skipped rather than raising `SyncError`; see
+        `FrameDecoder`.
+        """
+        
+        decoder = self._decoder
+        fd = getattr(self.com, 'fd', None)
+        frame = decoder.next_frame()
+        while frame is None:
+            # one read for everything that's waiting, or at least enough to
+            # finish the frame (blocks until then or the port times out)
+            want = decoder.needed()
+            if fd is not None:
+                got = self._read_fd(fd, want)
+            else:
+                want = max(want, self.com.in_waiting)
+                data = self.com.read(want)
+                decoder.feed(data)
+                got = len(data)
+            frame = decoder.next_frame()
+            if frame is None and got < want:
+                # read timed out, drop whatever partial frame is in the way
+                frame = decoder.resync()
+                if frame is None:
+                    self._record(None)
+                    return (None, b'')
+        
+        # log message
+        if decoder.frame:
+            self._raw('<', decoder.frame)
+            
+        self._record(frame[0])
+        return frame
+        
+    def _record(self, status):
+        """Record the round-trip of the last command sent, now that `status`
+        came back (None if it timed out)
+        """
+        
+        command = self._sent
+        if command is None or self.metrics is None:
+            return
+        self._sent = None
+        if status is None:
+            self.metrics.timeout(self.port, command)
+            return
+        hist = self._histograms.get(command)
+        if hist is None:
+            hist = self._histograms[command] = self.metrics.histogram(self.port, command)
+        hist.observe(time.perf_counter() - self._sent_at)
+        
+    def power_on(self, *args, **kwargs):
+        """Handle startup routines. Returns the power-up status. Arguments
+        are passed on to `initialize()`.
+        
+        With a `ProfileCache` in `self.profiles`, a bill validator found
+        already IDLE (or INHIBIT) with the settings about to be applied, as
+        cached for this port, is taken as is: no GET_VERSION, reset or
+        initialize. Otherwise it's powered up from scratch, and the cache
+        updated.
+        
+        Once done, `self.ready` resolves to the status the bill validator is
+        left in, for other threads to wait on; see `wait_ready()`.
+        """
+        
+        return self._run(self._power_on_steps(args, kwargs))
+        
+    def _power_on_steps(self, args, kwargs):
+        self._init_args = (args, kwargs)
+        ready = self._new_ready()
+        try:
+            init_status = yield from self._power_up_steps(*args, **kwargs)
+            status = None
+            if self.bv_on:
+                status = (yield self.req_status, ())[0]
+            ready.set_result(status)
+        except BaseException as e:
+            ready.set_exception(e)
+            raise
+        return init_status
+        
+    def _new_ready(self):
+        if self.ready.done():
+            # powering up again, e.g. after reconnecting
+            self.ready = concurrent.futures.Future()
+        return self.ready
+        
+    def wait_ready(self, timeout=None):
+        """Block until `power_on()` is done, without using CPU. Returns the
+        status the bill validator was left in: normally IDLE, an error
+        status if it powered up into one, or None if power-up was called
+        off by clearing `bv_on`. Raises `TimeoutError` if `timeout` seconds
+        pass first, and whatever power_on() raised if it failed.
+        """
+        
+        try:
+            return self.ready.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError("Bill validator not ready after %s seconds" % timeout)
+            
+    def _power_up_steps(self, *args, **kwargs):
+        self.bv_on = True
+        
+        status = None
+        while status is None or status == 0x00:
+            status, data = yield self.req_status, ()
+            if not self.bv_on:
+                # in case polling thread needs to be terminated before power up
+                self.init_status = None
+                return
+        
+        self.init_status = status
+            
+        if status not in POW_STATUSES:
+            if self.profiles is None:
+                log.warning("Acceptor already powered up, status: %02x", status)
+                return self.init_status
+            if (yield from self._warm_start_steps(status, *args, **kwargs)):
+                return self.init_status
+            log.info("No matching cached profile, powering up from scratch")
+            
+        if status != POW_UP_BIA and status != POW_UP_BIS:
+            log.info("Powering up...")
+            log.info("Getting version...")
+            try:
+                self._got_version(*(yield from self._transact_steps(GET_VERSION, expect=(GET_VERSION,))))
+            except CommandTimeout:
+                log.warning("Could not get BV software version")
+            if self.profiles is not None:
+                try:
+                    response = yield from self._transact_steps(GET_BOOT_VERSION, expect=(GET_BOOT_VERSION,))
+                    self.bv_boot_version = response[1]
+                except CommandTimeout:
+                    log.warning("Could not get BV boot version")
+        # else the acceptor should either reject or stack the bill
+        
+        log.debug("Sending reset command")
+        yield from self._transact_steps(RESET)
+            
+        if (yield self.req_status, ())[0] == INITIALIZE:
+            yield from self._initialize_steps(*args, **kwargs)
+        else:
+            self._save_profile()
+                    
+        # typically call BillVal.poll() after this
+        
+        return self.init_status
+        
+    def _got_version(self, status, version):
+        self.bv_version = version
+        self.bv_denoms = denoms_for_version(version)
+        log.info("BV software version: %s", version.decode('ascii', 'replace'))
+        
+    def _warm_start_steps(self, status, *args, **kwargs):
+        """Take up the cached profile for this port, if the bill validator is
+        idle and already has the settings `initialize(*args, **kwargs)` would
+        apply. Returns whether it did.
+        """
+        
+        profile = self._cached_profile(status, *args, **kwargs)
+        if profile is None:
+            return False
+        return self._take_profile(profile, (yield from self._read_settings_steps()))
+        
+    def _cached_profile(self, status, *args, **kwargs):
+        """The cached profile for this port, if the bill validator is idle and
+        the profile has the settings `initialize(*args, **kwargs)` would apply
+        """
+        
+        if status != IDLE and status != INHIBIT:
+            return None
+        profile = self.profiles.load(self.port)
+        if profile is None or profile.settings != self._requested_settings(*args, **kwargs):
+            return None
+        return profile
+        
+    def _take_profile(self, profile, actual):
+        """Take up `profile` if the settings read back from the bill validator
+        (`actual`, as from `read_settings()`) are the cached ones. The cache
+        only says what was last sent; the validator may have been reset or
+        reconfigured since.
+        """
+        
+        if any(actual.get(set_cmd) != value for set_cmd, value in profile.settings.items()):
+            log.info("BV settings differ from the cached profile")
+            return False
+        self.bv_version = profile.version
+        self.bv_boot_version = profile.boot_version
+        self.bv_denoms = profile.denoms if profile.denoms is not None else denoms_for_version(profile.version)
+        self.settings = dict(profile.settings)
+        log.info("BV already running with cached settings, skipping power-up (version %s)",
+                 (profile.version or b'unknown').decode('ascii', 'replace'))
+        return True
+        
+    def _requested_settings(self, *args, **kwargs):
+        """SET_* command -> value for the settings `initialize(*args, **kwargs)`
+        would send
+        """
+        
+        bound = inspect.signature(BillVal.initialize).bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        values = list(bound.arguments.values())[1:1 + len(SETTINGS)]
+        return {set_cmd: value for set_cmd, get_cmd, desc, value in self._settings(*values)}
+        
+    def _save_profile(self, failed=()):
+        """Cache the device profile, or drop the cached one if any settings
+        (`failed`) weren't taken
+        """
+        
+        if self.profiles is None:
+            return
+        if failed:
+            log.warning("Not caching the profile, settings not taken: %s", ', '.join(failed))
+            self.profiles.forget(self.port)
+            return
+        self.profiles.save(DeviceProfile(self.port, self.bv_version, self.bv_boot_version,
+                                         self.bv_denoms, self.settings))
+    
+    def initialize(self, denom=[0x82, 0], sec=[0, 0], dir=[0], opt_func=[0, 0], 
+                   inhibit=[0], bar_func=[0x01, 0x12], bar_inhibit=[0], only_changed=False):
+        """Initialize BV settings.
+        
+        With `only_changed`, each setting is read back first and only sent if
+        it differs. Returns a list of (description, action, seconds) tuples
+        timing each setting, where action is 'sent', 'unchanged' or 'failed'
+        (not echoed back), followed by ('initializing', 'wait', seconds) for
+        the wait for INITIALIZE to clear. The list is also kept in
+        `self.init_timings`. Only settings the bill validator took are kept in
+        `self.settings` and the profile cache.
+        """
+        
+        return self._run(self._initialize_steps(denom, sec, dir, opt_func, inhibit, bar_func,
+                                                bar_inhibit, only_changed))
+        
+    def _initialize_steps(self, denom=[0x82, 0], sec=[0, 0], dir=[0], opt_func=[0, 0],
+                          inhibit=[0], bar_func=[0x01, 0x12], bar_inhibit=[0], only_changed=False):
+        clock = time.perf_counter
+        timings = []
+        failed = []
+        settings = self._settings(denom, sec, dir, opt_func, inhibit, bar_func, bar_inhibit)
+        for set_cmd, get_cmd, desc, value in settings:
+            start = clock()
+            if only_changed and (yield from self._read_setting_steps(get_cmd)) == value:
+                log.debug("%s unchanged: %r", desc, list(value))
+                action = 'unchanged'
+            else:
+                log.debug("Setting %s: %r", desc, list(value))
+                yield self.send_command, (set_cmd, value)
+                status, data = yield self.read_response, ()
+                if (status, data) != (set_cmd, value):
+                    log.warning("Acceptor did not echo %s settings", desc)
+                    action = 'failed'
+                else:
+                    action = 'sent'
+            if action == 'failed':
+                self.settings.pop(set_cmd, None)
+                failed.append(desc)
+            else:
+                self.settings[set_cmd] = value
+            timings.append((desc, action, clock() - start))
+            
+        start = clock()
+        while (yield self.req_status, ())[0] == INITIALIZE:
+            # wait for initialization to finish
+            yield self._sleep, (0.2,)
+        timings.append(('initializing', 'wait', clock() - start))
+        
+        self._log_timings(timings)
+        self._save_profile(failed)
+        return timings
+        
+    def _log_timings(self, timings):
+        self.init_timings = timings
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Initialization took %.3f s: %s", sum(t[2] for t in timings),
+                      ', '.join('%s %s %.3f s' % t for t in timings))
+            
+    def _settings(self, *values):
+        """Pair `initialize()` arguments up with their commands. Returns a list
+        of (set command, get command, description, value) tuples in `SETTINGS`
+        order.
+        """
+        return [(set_cmd, get_cmd, desc, bytes(value))
+                for (set_cmd, get_cmd, desc), value in zip(SETTINGS, values)]
+                
+    def read_setting(self, get_cmd):
+        """Read one setting back from the bill validator with one of the GET_*
+        commands. Returns its value, or None if the BV didn't answer properly.
+        """
+        
+        return self._run(self._read_setting_steps(get_cmd))
+        
+    def _read_setting_steps(self, get_cmd):
+        yield self.send_command, (get_cmd,)
+        status, data = yield self.read_response, ()
+        return data if status == get_cmd else None
+        
+    def read_settings(self):
+        """Read all settings back from the bill validator. Returns a dict of
+        SET_* command -> value (None if it couldn't be read).
+        """
+        return self._run(self._read_settings_steps())
+        
+    def _read_settings_steps(self):
+        settings = {}
+        for set_cmd, get_cmd, desc in SETTINGS:
+            settings[set_cmd] = yield from self._read_setting_steps(get_cmd)
+        return settings
+    
+    def req_status(self):
+        """Send status request to bill validator"""
+        
+        if not self.bv_on:
+            # in case polling thread needs to be terminated before power up
+            return None, b''
+        
+        fd = getattr(self.com, 'fd', None)
+        if fd is not None:
+            # only whether there's anything, without in_waiting's ioctl
+            waiting = self._poller(fd).poll(0)
+        else:
+            waiting = self.com.in_waiting
+        if waiting:
+            # discard any unused data
+            log.warning("Found unused data in buffer, %r", self.com.read(self.com.in_waiting))
+        self._decoder.clear()
+            
+        self.send_command(STATUS_REQ)
+        
+        # the decoder hands back the same tuple for a repeated frame, so
+        # return it as is rather than unpacking and repacking it
+        response = self.read_response()
+        stat = response[0]
+        if stat is not None and not self._known[stat]:
+            log.warning("Unknown status code received: %02x, data: %r", *response)
+        
+        return response
+        
+    def poll(self, interval=POLL_INTERVAL, scheduler=None):
+        """Send a status request to the bill validator every `interval` seconds
+        and fire event handlers. `interval` defaults to 200 ms, per ID-003 spec.
+        
+        Pass a `scheduler` to adapt the interval to the bill validator's
+        status, see `PollScheduler`. It's kept in `self.scheduler` for its
+        timing stats.
+        
+        Event handlers are only fired upon status changes. Event handlers can
+        set `self.bv_status` to None to force event handler to fire on the next
+        status request.
+        
+        Polling stops once `bv_on` is cleared. If the serial port is lost, it
+        carries on once `reconnect()` gets it back.
+        """
+        
+        scheduler = self.scheduler = scheduler or self.make_scheduler(interval)
+        return self._run(self._poll_steps(scheduler))
+        
+    def _poll_steps(self, scheduler):
+        req_status = (self.req_status, ())
+        while self.bv_on:
+            scheduler.start()
+            try:
+                response = yield req_status
+                status = response[0]
+                if response != self.bv_status:
+                    # a BLOCK subscription holds up the poller here, and with
+                    # AsyncBillVal the whole event loop
+                    self._publish(status, response[1])
+                    if status in self.bv_events:
+                        yield self.bv_events[status], (response[1],)
+                self.bv_status = response
+                if self.pending is not None:
+                    yield from self._check_decision_steps(status)
+            except PORT_ERRORS as e:
+                if not (yield from self._reconnect_steps(e)):
+                    raise
+                continue
+            yield self._sleep, (scheduler.schedule(status),)
+            
+    def reconnect(self, error=None):
+        """Get the serial port back after losing it, e.g. to the USB adapter
+        dropping off the bus, and pick up where polling left off. Returns
+        whether it did; False if `self.reconnect_policy` is None, its
+        attempts ran out, or `bv_on` was cleared meanwhile.
+        
+        An adapter with a USB identity (`self.usb_id`) is looked for by
+        that, since it may come back under another name; any other port is
+        reopened at the same path. A bill validator still running keeps its
+        settings and last status, so no handlers fire for a status it was
+        already in. One that lost power as well is powered up again, and one
+        asking to be initialized is, with the arguments last passed to
+        `power_on()`.
+        
+        The time taken is kept in `self.last_recovery` and exported as the
+        id003_reconnect_seconds histogram.
+        """
+        
+        return self._run(self._reconnect_steps(error))
+        
+    def _reconnect_steps(self, error):
+        policy = self.reconnect_policy
+        if policy is None or not self.bv_on:
+            return False
+        log.warning("Lost serial port %s (%s), reconnecting", self.port, error)
+        start = time.monotonic()
+        self._close_port()
+        for attempt in range(policy.attempts):
+            if attempt:
+                yield self._sleep, (policy.delay(attempt),)
+            if not self.bv_on:
+                return False
+            if not self._reopen():
+                continue
+            try:
+                yield from self._restore_steps()
+            except PORT_ERRORS as e:
+                log.debug("Lost %s again: %s", self.port, e)
+                self._close_port()
+                continue
+            self._recovered(start)
+            return True
+        self._recovered(start, False)
+        return False
+        
+    def _close_port(self):
+        try:
+            self.com.close()
+        except Exception:
+            pass
+        self._rx_fd = self._rx_poller = None
+        
+    def _reopen(self):
+        """Try once to open the lost port again. Returns whether it did."""
+        
+        path = self.com.port
+        if self.usb_id is not None:
+            path = find_port(self.usb_id)
+            if path is None:
+                return False
+        try:
+            com = self._open(path, self.com.timeout)
+        except Exception as e:
+            # not back yet, whatever pyserial makes of that
+            log.debug("Could not reopen %s: %s", path, e)
+            return False
+        if path != self.com.port:
+            log.info("Serial port %s is back as %s", self.port, path)
+        self.com = com
+        self._decoder.clear()
+        return True
+        
+    def _restore_steps(self):
+        """Check on the bill validator after reconnecting, powering it up or
+        initializing it again if it needs that
+        """
+        
+        status = (yield self.req_status, ())[0]
+        args, kwargs = self._init_args
+        if status in POW_STATUSES:
+            log.info("BV lost power as well, powering up again")
+            yield from self._power_on_steps(args, kwargs)
+            self.bv_status = None
+        elif status == INITIALIZE:
+            log.info("BV needs initializing again")
+            yield from self._initialize_steps(*args, **kwargs)
+            self.bv_status = None
+        elif status is not None:
+            log.info("BV still running, status %02x, resuming polling", status)
+            
+    def _recovered(self, start, ok=True):
+        seconds = time.monotonic() - start
+        if ok:
+            self.last_recovery = seconds
+            log.info("Reconnected to %s after %.2f s", self.port, seconds)
+        else:
+            log.error("Gave up reconnecting to %s after %.2f s", self.port, seconds)
+        if self.scheduler is not None:
+            self.scheduler.target = None  # don't count the outage as poll jitter
+        if self.metrics is not None:
+            self.metrics.reconnected(self.port, seconds if ok else None)
+            
+    def make_scheduler(self, interval=POLL_INTERVAL, fast=None, slow=None):
+        """A `PollScheduler` around `interval` (and `fast`/`slow`, to adapt)
+        that records its jitter into this bill validator's metrics
+        """
+        
+        jitter = self.metrics.poll_jitter(self.port) if self.metrics is not None else None
+        return PollScheduler(interval, fast, slow, jitter=jitter)
+            
+        
+
+
+class AsyncBillVal(BillVal):
+    """asyncio version of `BillVal`.
+    
+    Rather than blocking in `read()`, the serial port's file descriptor is
+    registered with the event loop through `loop.add_reader()`, so any number
+    of validators can share one loop without a thread each. This needs a
+    selector-based event loop on a POSIX system.
+    
+    `send_command`, `read_response`, `req_status`, `transact`,
+    `read_setting`, `read_settings`, `power_on`, `initialize`,
+    `check_decision`, `reconnect` and `poll` are coroutines. Event handlers
+    may be plain functions or coroutines; `poll()` awaits whatever they
+    return. Escrow deciders may return coroutines or asyncio futures.
+    
+    Only the I/O differs from `BillVal`: the protocol itself is the same
+    steps, run by an `_run()` that awaits them.
+    """
+    
+    def __init__(self, port, log_raw=False, timeout=0.05, profiles=None):
+        super().__init__(port, log_raw, profiles=profiles)
+        
+        # only read once the event loop says there's data, so reads don't block
+        self.timeout = timeout
+        
+        self.loop = None
+        self._frames = collections.deque()
+        self._waiter = None
+        self._lost = None  # the error the port was lost to, until reconnect()
+        
+    def _attach(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            self.loop.add_reader(self.com.fileno(), self._on_readable)
+            
+    def _on_readable(self):
+        decoder = self._decoder
+        try:
+            data = self.com.read(self.com.in_waiting or 1)
+        except PORT_ERRORS as e:
+            # the port's gone: stop watching it, and have whoever's waiting
+            # on a response find out
+            self.loop.remove_reader(self.com.fileno())
+            self._lost = e
+            if self._waiter is not None and not self._waiter.done():
+                self._waiter.set_exception(e)
+            return
+        decoder.feed(data)
+        for frame in decoder:
+            if decoder.frame:
+                self._raw('<', decoder.frame)
+            self._frames.append(frame)
+        if self._frames and self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+            
+    def close(self):
+        """Unregister from the event loop and close the serial port"""
+        
+        if self.loop is not None:
+            self.loop.remove_reader(self.com.fileno())
+            self.loop = None
+        self.com.close()
+        
+    def _close_port(self):
+        if self.loop is not None:
+            try:
+                self.loop.remove_reader(self.com.fileno())
+            except Exception:
+                pass
+            self.loop = None  # _attach() watches the new port
+        self._lost = None
+        BillVal._close_port(self)
+        
+    async def send_command(self, command, data=b''):
+        """Send a generic command to the bill validator"""
+        
+        self._attach()
+        return BillVal.send_command(self, command, data)
+        
+    async def read_response(self, timeout=None):
+        """Wait for the next frame from the bill validator. Returns a tuple
+        (command, data), or (None, b'') after `timeout` seconds (defaults to
+        `self.timeout`).
+        """
+        
+        self._attach()
+        if self._lost is not None:
+            raise self._lost
+        if not self._frames:
+            self._waiter = self.loop.create_future()
+            try:
+                await asyncio.wait_for(self._waiter, self.timeout if timeout is None else timeout)
+            except asyncio.TimeoutError:
+                # drop whatever partial frame is in the way, as BillVal does
+                frame = self._decoder.resync()
+                if frame is None:
+                    self._record(None)
+                    return (None, b'')
+                self._frames.append(frame)
+            finally:
+                self._waiter = None
+        frame = self._frames.popleft()
+        self._record(frame[0])
+        return frame
+        
+    async def req_status(self):
+        """Send status request to bill validator"""
+        
+        if not self.bv_on:
+            return None, b''
+            
+        if self._frames or self._decoder.buf:
+            # discard any unused data
+            log.warning("Found unused data in buffer, %r", list(self._frames) or bytes(self._decoder.buf))
+            self._frames.clear()
+            self._decoder.clear()
+            
+        await self.send_command(STATUS_REQ)
+        
+        stat, data = await self.read_response()
+        if stat is not None and not self._known[stat]:
+            log.warning("Unknown status code received: %02x, data: %r", stat, data)
+            
+        return stat, data
+        
+    async def _wait_response(self, timeout):
+        return await self.read_response(timeout)
+        
+    async def _sleep(self, seconds):
+        await asyncio.sleep(seconds)
+        
+    async def _run(self, steps):
+        """Carry out protocol `steps`, awaiting each I/O step. See
+        `BillVal._run()`.
+        """
+        
+        step = steps.send
+        result = None
+        while True:
+            try:
+                method, args = step(result)
+            except StopIteration as e:
+                return e.value
+            try:
+                result = method(*args)
+                if inspect.isawaitable(result):
+                    # a coroutine method, or an event handler that is one
+                    result = await result
+                step = steps.send
+            except BaseException as e:
+                result = e
+                step = steps.throw
+                
+    def poll_task(self, interval=POLL_INTERVAL, scheduler=None):
+        """Start `poll()` as a task on the running event loop"""
+        return asyncio.ensure_future(self.poll(interval, scheduler))
+
+
+class BillValFleet:
+    """Poll many bill validators from a single thread.
+    
+    Status requests are written as each device comes due and the responses
+    are collected through one `selectors` selector, so the round-trips of all
+    devices overlap instead of queueing behind each other. Each device keeps
+    its own poll interval, and its `bv_events` handlers fire on status changes
+    just as in `BillVal.poll()`, on the thread calling `run()`.
+    
+    Each device has its own `PollScheduler` (kept in its `scheduler`). Pass
+    `fast` and/or `slow` to adapt its interval to its status around
+    `interval`; by default it's fixed.
+    
+    Devices should be powered up (`BillVal.power_on()`) before they're added.
+    A device is dropped from the fleet once its `bv_on` is cleared. One whose
+    port fails (an unplugged USB adapter) is dropped and put on `lost`, and
+    the rest carry on; reconnect it (`BillVal.reconnect()`) and add it back.
+    
+    POSIX only. The poll path reads and writes the port's file descriptor
+    directly, because pyserial's own read/write use `select()`, which stops
+    working past FD_SETSIZE (1024) descriptors. Handlers that send commands
+    themselves still go through pyserial.
+    """
+    
+    def __init__(self, bill_vals=(), interval=POLL_INTERVAL, timeout=0.1, fast=None, slow=None):
+        self.interval = interval
+        self.fast = fast
+        self.slow = slow
+        self.timeout = timeout  # how long to wait for a status response
+        self.running = False
+        
+        self.selector = selectors.DefaultSelector()
+        self.devices = []
+        self.lost = []  # BillVals dropped because their port failed
+        self._schedule = []  # heap of (when, seq, slot, gen)
+        self._seq = itertools.count()
+        
+        self._request = FRAMES[STATUS_REQ]
+        
+        for bv in bill_vals:
+            self.add(bv)
+            
+    def add(self, bv):
+        """Add a `BillVal` to the fleet, with its first poll staggered within
+        the poll interval. Returns its slot.
+        """
+        
+        slot = _FleetSlot(bv, bv.com.fileno())
+        jitter = bv.metrics.poll_jitter(bv.port) if bv.metrics is not None else None
+        scheduler = bv.scheduler = PollScheduler(self.interval, self.fast, self.slow,
+                                                 jitter=jitter)
+        # spread devices over the interval so their requests don't bunch up
+        offset = (len(self.devices) * 0.618034 % 1.0) * self.interval
+        slot.next_poll = scheduler.target = time.monotonic() + offset
+        self.devices.append(slot)
+        self.selector.register(slot.fd, selectors.EVENT_READ, slot)
+        self._push(slot.next_poll, slot)
+        return slot
+        
+    def remove(self, bv):
+        """Stop polling a `BillVal`. Its serial port is left open."""
+        
+        for slot in self.devices:
+            if slot.bv is bv:
+                self._drop(slot)
+                return
+        raise ValueError("Bill validator is not in this fleet")
+        
+    def _drop(self, slot):
+        self.devices.remove(slot)
+        self.selector.unregister(slot.fd)
+        slot.gen += 1  # invalidates anything left on the schedule
+        
+    def _lose(self, slot, error):
+        log.error("Lost serial port %s, dropping it from the fleet: %s", slot.bv.com.port, error)
+        self._drop(slot)
+        self.lost.append(slot.bv)
+        
+    def _push(self, when, slot):
+        slot.gen += 1
+        heapq.heappush(self._schedule, (when, next(self._seq), slot, slot.gen))
+        
+    def run(self):
+        """Poll until `stop()` is called or no devices are left"""
+        
+        self.running = True
+        while self.running and self.devices:
+            self.step()
+            
+    def stop(self):
+        self.running = False
+        
+    def close(self):
+        """Stop polling and close all serial ports"""
+        
+        self.stop()
+        for slot in list(self.devices):
+            self._drop(slot)
+            slot.bv.com.close()
+        self.selector.close()
+        
+    def step(self):
+        """Send any requests that are due, time out overdue responses, and
+        wait until the next scheduled event for responses to arrive
+        """
+        
+        schedule = self._schedule
+        now = time.monotonic()
+        while schedule and schedule[0][0] <= now:
+            when, _, slot, gen = heapq.heappop(schedule)
+            if gen != slot.gen:
+                continue
+            if slot.sent is None:
+                self._send(slot, now)
+            else:
+                self._finish(slot, None, b'')
+            now = time.monotonic()
+            
+        wait = schedule[0][0] - now if schedule else self.interval
+        for key, _ in self.selector.select(max(wait, 0.0)):
+            self._on_readable(key.data)
+            
+    def _send(self, slot, now):
+        bv = slot.bv
+        if not bv.bv_on:
+            self._drop(slot)
+            return
+        if bv._decoder.buf:
+            # discard any unused data
+            log.warning("Found unused data in buffer, %r", bytes(bv._decoder.buf))
+            bv._decoder.clear()
+        bv.scheduler.start()
+        bv._raw('>', self._request)
+        try:
+            os.write(slot.fd, self._request)
+        except BlockingIOError:
+            pass  # output buffer full, this poll times out
+        except PORT_ERRORS as e:
+            self._lose(slot, e)
+            return
+        bv._sent = STATUS_REQ
+        bv._sent_at = time.perf_counter()
+        slot.sent = now
+        self._push(now + self.timeout, slot)
+        
+    def _on_readable(self, slot):
+        bv = slot.bv
+        decoder = bv._decoder
+        try:
+            data = os.read(slot.fd, 4096)
+        except BlockingIOError:
+            return
+        except PORT_ERRORS as e:
+            self._lose(slot, e)
+            return
+        if not data:
+            # readable with nothing to read: hung up
+            self._lose(slot, "end of file")
+            return
+        decoder.feed(data)
+        if slot.sent is None:
+            # not waiting for anything, leave it for _send() to discard
+            return
+        frame = decoder.next_frame()
+        if frame is not None:
+            if decoder.frame:
+                bv._raw('<', decoder.frame)
+            self._finish(slot, *frame)
+            
+    def _finish(self, slot, status, data):
+        bv = slot.bv
+        slot.sent = None
+        bv._record(status)
+        
+        if status is not None and not bv._known[status]:
+            log.warning("Unknown status code received: %02x, data: %r", status, data)
+        if (status, data) != bv.bv_status:
+            bv._publish(status, data)
+            if status in bv.bv_events:
+                try:
+                    bv.bv_events[status](data)
+                except Exception:
+                    # one misbehaving device shouldn't stop the rest of the fleet
+                    log.exception("Event handler for status %02x failed on %s",
+                                  status, bv.com.port)
+        bv.bv_status = (status, data)
+        if bv.pending is not None:
+            try:
+                bv.check_decision(status)
+            except Exception:
+                log.exception("Acting on decision failed on %s", bv.com.port)
+        
+        bv.scheduler.schedule(status)
+        slot.next_poll = bv.scheduler.target
+        if slot in self.devices:
+            self._push(slot.next_poll, slot)
+
+
+class _FleetSlot:
+    """Scheduling state for one device in a `BillValFleet`"""
+    
+    __slots__ = ('bv', 'fd', 'next_poll', 'sent', 'gen')
+    
+    def __init__(self, bv, fd):
+        self.bv = bv
+        self.fd = fd
+        self.next_poll = 0.0
+        self.sent = None  # when the outstanding status request was sent
+        self.gen = 0
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+replay - replay captured ID-003 traffic through event handlers
+
+Reads `raw.log` text logs written by `BillVal._raw()`, or binary captures
+from `capture.CaptureWriter`, one line or record at a time, and rebuilds the
+(status, data) sequence `BillVal.poll()` saw. That sequence can drive a
+bill validator's `bv_events` handlers, or any dict of handlers, as fast as
+possible or at a chosen time scale:
+
+    bv = replay_bill_val()
+    Replay('raw.log').run(bv)
+
+    Replay('raw.cap', port='/dev/ttyUSB0', speed=1.0).run({id003.ESCROW: on_escrow})
+
+raw.log has no timestamps, so its status requests are taken to have gone
+out every `interval` seconds. A status request that got no response (or
+only the 0x00 byte some validators send, which raw.log doesn't record) is
+replayed as (None, b''), as `poll()` saw it.
+"""
+
+import re
+import time
+import logging
+import collections
+
+import id003
+import capture
+
+
+log = logging.getLogger('replay')
+
+# commands the bill validator answers with ACK
+_OPERATIONS = (id003.RESET, id003.STACK_1, id003.STACK_2, id003.RETURN,
+               id003.HOLD, id003.WAIT)
+_SET_COMMANDS = tuple(set_cmd for set_cmd, get_cmd, desc in id003.SETTINGS)
+
+_HEX_BYTE = re.compile(r'0x([0-9a-fA-F]{2})')
+
+Poll = collections.namedtuple('Poll', 'port timestamp status data')
+
+
+def _list_bytes(body):
+    """The bytes in "['0xfc', '0x05', ...]" as written by str() of a list,
+    in one `bytes.fromhex()`. Raises ValueError if it isn't written that way.
+
+    >>> _list_bytes("['0xfc', '0x05', '0x11']")
+    b'\\xfc\\x05\\x11'
+    """
+
+    return bytes.fromhex(body[4:-2].replace("', '0x", ''))
+
+
+def parse_raw_line(line):
+    """Parse one raw.log line into (direction, frame), or None if it isn't
+    one. Received frames are logged without their CRC; it's put back, so
+    frames always come back complete.
+
+    >>> parse_raw_line("> ['0xfc', '0x05', '0x11', '0x27', '0x56']")[1].hex()
+    'fc05112756'
+    """
+
+    line = line.strip()
+    if len(line) < 4 or line[0] not in '<>':
+        return None
+    direction = line[0]
+    body = line[2:]
+    try:
+        frame = _list_bytes(body)
+    except ValueError:
+        frame = bytes(int(x, 16) for x in _HEX_BYTE.findall(body))
+    if len(frame) < 3:
+        return None
+    if direction == '<' and len(frame) == frame[1] - 2:
+        frame += id003.get_crc(frame)
+    return direction, frame
+
+
+def read_raw_log(path):
+    """Yield the frames in a raw.log as `capture.Record`s, without port or
+    timestamp
+    """
+
+    bad = 0
+    with open(path, newline=None, errors='replace') as f:
+        for line in f:
+            parsed = parse_raw_line(line)
+            if parsed is None:
+                if line.strip():
+                    bad += 1
+                continue
+            yield capture.Record(parsed[0], None, None, parsed[1])
+    if bad:
+        log.warning("Skipped %d unreadable lines in %s", bad, path)
+
+
+def read_frames(path):
+    """Yield the frames in a raw.log or binary capture, telling them apart
+    by their contents
+    """
+
+    with capture.open_capture(path) as f:
+        binary = f.read(len(capture.MAGIC)) == capture.MAGIC
+    if binary:
+        return capture.read_capture(path)
+    return read_raw_log(path)
+
+
+def polls(records, port=None, interval=id003.POLL_INTERVAL):
+    """Turn captured frames into the `Poll`s of (port, timestamp, status,
+    data) that `BillVal.poll()` saw, for all ports or just `port`.
+
+    Responses to anything but a status request (ACKs, settings, ...) were
+    read by the handlers that sent those commands, not by `poll()`, and are
+    left out. Records without a timestamp are given one `interval` after
+    the last status request.
+    """
+
+    waiting = {}  # port -> timestamp of the status request awaiting a response
+    clock = 0.0
+    for direction, rec_port, timestamp, frame in records:
+        if port is not None and rec_port != port:
+            continue
+        if len(frame) < 5:
+            continue
+        command = frame[2]
+        if direction == '>':
+            if rec_port in waiting:
+                # the last request got nothing back
+                yield Poll(rec_port, waiting.pop(rec_port), None, b'')
+            if command == id003.STATUS_REQ:
+                if timestamp is None:
+                    clock += interval
+                    timestamp = clock
+                waiting[rec_port] = timestamp
+        elif rec_port in waiting:
+            yield Poll(rec_port, waiting.pop(rec_port), command, frame[3:-2])
+
+
+class ReplayPort:
+    """Enough of `serial.Serial` for a `BillVal` being replayed to.
+
+    Commands its handlers send are kept in `sent` as (command, data) and
+    answered as a bill validator would: status requests with the status
+    being replayed, operations with ACK, and settings by echoing them.
+    """
+
+    def __init__(self):
+        self.port = 'replay'
+        self.timeout = 0.05
+        self.status = (None, b'')
+        self.sent = []
+        self.rx = bytearray()
+        self._decoder = id003.FrameDecoder()
+
+    @property
+    def in_waiting(self):
+        return len(self.rx)
+
+    def write(self, data):
+        decoder = self._decoder
+        decoder.feed(data)
+        for command, body in decoder:
+            self.sent.append((command, body))
+            response = self._answer(command, body)
+            if response is not None:
+                self.rx += response
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        return data
+
+    def close(self):
+        pass
+
+    def _answer(self, command, data):
+        if command == id003.STATUS_REQ:
+            status, data = self.status
+            return id003.encode_frame(status, data) if status else None
+        elif command == id003.ACK:
+            return None
+        elif command in _OPERATIONS:
+            return id003.encode_frame(id003.ACK)
+        elif command in _SET_COMMANDS:
+            return id003.encode_frame(command, data)
+        return id003.encode_frame(id003.INVALID_COMMAND)
+
+
+def replay_bill_val(escrow=id003.STACK_1, confirm=False, cls=id003.BillVal):
+    """A `cls` instance with no serial port to replay to. Bills in escrow
+    are answered with `escrow`, and reset/initialize prompts with `confirm`;
+    replace `escrow_decider` and `confirm` for anything else.
+    """
+
+    bv = cls(None, metrics=None)
+    bv.com = ReplayPort()
+    bv.bv_on = True
+    bv.escrow_decider = lambda esc, barcode: id003.completed(escrow)
+    bv.confirm = lambda prompt: id003.completed(confirm)
+    return bv
+
+
+class Replay:
+    """Replay a raw.log or binary capture.
+
+    `source` is a file name or an iterable of `capture.Record`s. Only
+    `port` is replayed if given; raw.log doesn't record ports, so leave it
+    out for those. `speed` is the time scale, e.g. 1.0 for real time or 10.0
+    for ten times as fast; None replays as fast as possible.
+    """
+
+    def __init__(self, source, port=None, speed=None, interval=id003.POLL_INTERVAL):
+        self.source = source
+        self.port = port
+        self.speed = speed
+        self.interval = interval
+        self.count = 0  # polls replayed by the last run()
+
+    def __iter__(self):
+        records = read_frames(self.source) if isinstance(self.source, str) else self.source
+        return polls(records, self.port, self.interval)
+
+    def run(self, target):
+        """Replay into `target`, either a `BillVal` (see `replay_bill_val()`)
+        or a dict of status -> handler(data). Handlers fire on status changes,
+        and a BillVal's pending decisions are checked after every poll, just
+        as in `BillVal.poll()`. Returns the number of polls replayed.
+        """
+
+        bv = None
+        if isinstance(target, id003.BillVal):
+            bv = target
+            handlers = bv.bv_events
+        else:
+            handlers = target
+
+        last = None
+        start = first = None
+        speed = self.speed
+        self.count = 0
+        for poll in self:
+            if speed:
+                if first is None:
+                    start, first = time.monotonic(), poll.timestamp
+                wait = start + (poll.timestamp - first) / speed - time.monotonic()
+                if wait > 0.0:
+                    time.sleep(wait)
+            self.count += 1
+
+            status, data = poll.status, poll.data
+            if bv is not None:
+                if isinstance(bv.com, ReplayPort):
+                    bv.com.status = (status, data)
+                last = bv.bv_status
+            if (status, data) != last:
+                if bv is not None:
+                    bv._publish(status, data)
+                if status in handlers:
+                    handlers[status](data)
+            last = (status, data)
+            if bv is not None:
+                bv.bv_status = last
+                if bv.pending is not None:
+                    bv.check_decision(status)
+        return self.count
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Print the status changes in a raw.log or capture")
+    parser.add_argument('path')
+    parser.add_argument('-p', '--port', help="only this port (binary captures)")
+    args = parser.parse_args()
+
+    last = {}
+    start = None
+    for poll in Replay(args.path, args.port):
+        status = (poll.status, poll.data)
+        if last.get(poll.port) == status:
+            continue
+        last[poll.port] = status
+        if start is None:
+            start = poll.timestamp
+        print("%10.3f %s %s %s" % (poll.timestamp - start, poll.port or '',
+                                   '--' if poll.status is None else '%02x' % poll.status,
+                                   poll.data.hex()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+sim003 - virtual ID-003 bill acceptor on a pseudo-terminal
+
+VirtualAcceptor plays the device side of the protocol on the master end of
+an `os.openpty()` pair; open its `port` (the slave end) with an unmodified
+`id003.BillVal` as if it were a UBA on a JCM UAC adapter. POSIX only.
+
+    acceptor = VirtualAcceptor([('insert', id003.DENOM_3),
+                                ('reject', id003.INSERTION_ERR)])
+    acceptor.start()
+    bv = id003.BillVal(acceptor.port)
+
+Scenario steps run one after another, each starting once the acceptor is
+back to idle. Durations are counted in status requests (polls):
+
+    ('insert', denom)            accept a bill and hold it in escrow until
+    ('insert', BARCODE_TKT, code)  the controller stacks or returns it
+    ('reject', reason)           accept, then reject with a REJECT_REASONS code
+    ('error', status, polls)     report an error status (STACKER_OPEN, ...)
+    ('failure', code)            report FAILURE with a FAILURE_CODES code
+                                 until the controller resets the acceptor
+    ('idle', polls)              stay idle
+    ('power_up', status)         power cycle into POW_UP/POW_UP_BIA/POW_UP_BIS
+
+Many acceptors can be served from one thread with an AcceptorServer.
+"""
+
+import os
+import tty
+import time
+import heapq
+import random
+import logging
+import itertools
+import selectors
+import threading
+import collections
+
+import id003
+from id003 import encode_frame
+
+
+log = logging.getLogger('sim003')
+
+VERSION = b'i(USA)100-SS ID003-05V271-36 15NOV11 0F08'
+BOOT_VERSION = b'U(USA)BT-100 V1.02 05JUL06'
+
+# what a freshly reset acceptor reports for each setting
+DEFAULT_SETTINGS = {
+    id003.GET_DENOM: bytes([id003.DENOM_USA_DEFAULT, 0]),
+    id003.GET_SECURITY: bytes([id003.SECURITY_USA_DEFAULT, 0]),
+    id003.GET_DIRECTION: bytes([id003.DIR_DEFAULT]),
+    id003.GET_OPT_FUNC: bytes([id003.OPT_DEFAULT, 0]),
+    id003.GET_INHIBIT: bytes([0]),
+    id003.GET_BAR_FUNC: bytes([0x01, id003.BAR_18_CHAR]),
+    id003.GET_BAR_INHIBIT: bytes([0]),
+}
+
+# set command -> get command
+_SET_TO_GET = {set_cmd: get_cmd for set_cmd, get_cmd, desc in id003.SETTINGS}
+
+_OPERATIONS = (id003.RESET, id003.STACK_1, id003.STACK_2, id003.RETURN,
+               id003.HOLD, id003.WAIT)
+
+
+class VirtualAcceptor:
+    """Device side of an ID-003 bill acceptor.
+
+    `scenario` is a list of steps, see the module docstring. `delay` is the
+    time in seconds before each response is written, or a function returning
+    it. `escrow_timeout` is how long a bill stays in escrow without a stack or
+    return command before it's returned. `noise` is the probability of a
+    stray byte being sent ahead of a response.
+
+    Timing and state changes are driven by the controller's status requests,
+    so a scenario plays out the same way regardless of the poll rate.
+    """
+
+    def __init__(self, scenario=(), power_up=id003.POW_UP, delay=0.0,
+                 version=VERSION, boot_version=BOOT_VERSION, escrow_timeout=10.0,
+                 init_polls=2, accept_polls=2, stack_polls=2, return_polls=2,
+                 reject_polls=2, noise=0.0, seed=None):
+        self._open_pty()
+
+        self.scenario = collections.deque(scenario)
+        self.delay = delay
+        self.version = version
+        self.boot_version = boot_version
+        self.escrow_timeout = escrow_timeout
+        self.init_polls = init_polls
+        self.accept_polls = accept_polls
+        self.stack_polls = stack_polls
+        self.return_polls = return_polls
+        self.reject_polls = reject_polls
+        self.noise = noise
+        self.random = random.Random(seed)
+
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.decoder = id003.FrameDecoder()
+
+        self.status = power_up
+        self.data = b''
+        self.remaining = None  # polls left in the current status, None = until told otherwise
+        self._next = collections.deque()  # (status, data, polls) still to come
+        self._escrow_start = None
+
+        # for assertions in load tests
+        self.commands = collections.Counter()
+        self.stacked = []
+        self.returned = []
+        self.escrow_timeouts = 0
+
+        self.server = None
+
+    def __repr__(self):
+        return '<VirtualAcceptor %s status=%02x>' % (self.port, self.status)
+
+    def start(self):
+        """Serve this acceptor from its own background thread"""
+
+        self.server = AcceptorServer([self])
+        self.server.start()
+        return self
+
+    def close(self):
+        if self.server is not None and self.server.acceptors == [self]:
+            self.server.stop()
+        self._close_pty()
+
+    def _open_pty(self):
+        self.master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+    def _close_pty(self):
+        for fd in (self.master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def unplug(self):
+        """Pull the USB adapter: the port goes away, and the controller's
+        reads and writes on it fail. The acceptor keeps its state, as a real
+        one on its own power supply would.
+        """
+
+        if self.server is not None:
+            self.server.remove(self)
+        self._close_pty()
+
+    def plug(self, power_up=None):
+        """Plug the adapter back in after `unplug()`. `port` is whatever
+        pseudo-terminal comes up, which may or may not be the same one. With
+        `power_up`, the acceptor comes back in that status with its default
+        settings, as if it had lost power too.
+        """
+
+        self._open_pty()
+        self.decoder.clear()
+        if power_up is not None:
+            self.settings = dict(DEFAULT_SETTINGS)
+            self._next.clear()
+            self.status, self.data, self.remaining = power_up, b'', None
+        if self.server is not None:
+            self.server.add(self)
+        return self.port
+
+    def get_delay(self):
+        return self.delay() if callable(self.delay) else self.delay
+
+    ## Protocol ##
+
+    def receive(self, data):
+        """Handle bytes from the controller, returns a list of frames to send
+        back
+        """
+
+        self.decoder.feed(data)
+        responses = []
+        for command, data in self.decoder:
+            self.commands[command] += 1
+            response = self.handle(command, data)
+            if response is not None:
+                if self.noise and self.random.random() < self.noise:
+                    response = bytes([self.random.randrange(256)]) + response
+                responses.append(response)
+        return responses
+
+    def handle(self, command, data):
+        """Respond to one command from the controller. Returns the response
+        frame, or None if the command gets no response
+        """
+
+        if command == id003.STATUS_REQ:
+            return self._status_request()
+        elif command == id003.ACK:
+            # controller acknowledging VEND_VALID
+            if self.status == id003.VEND_VALID:
+                self._go([(id003.STACKED, b'', 1)])
+            return None
+        elif command in _OPERATIONS:
+            return self._operation(command)
+        elif command in _SET_TO_GET:
+            self.settings[_SET_TO_GET[command]] = bytes(data)
+            return encode_frame(command, data)
+        elif command in self.settings:
+            return encode_frame(command, self.settings[command])
+        elif command == id003.GET_VERSION:
+            return encode_frame(command, self.version)
+        elif command == id003.GET_BOOT_VERSION:
+            return encode_frame(command, self.boot_version)
+        return encode_frame(id003.INVALID_COMMAND)
+
+    def _operation(self, command):
+        status = self.status
+        if command == id003.RESET:
+            self._next.clear()
+            self._go([(id003.INITIALIZE, b'', self.init_polls)])
+        elif status not in (id003.ESCROW, id003.HOLDING):
+            return encode_frame(id003.INVALID_COMMAND)
+        elif command in (id003.STACK_1, id003.STACK_2):
+            self.stacked.append(self.data)
+            self._go([(id003.STACKING, b'', self.stack_polls),
+                      (id003.VEND_VALID, b'', None)])
+        elif command == id003.RETURN:
+            self.returned.append(self.data)
+            self._go([(id003.RETURNING, b'', self.return_polls)])
+        elif command == id003.HOLD:
+            self._escrow_start = time.monotonic()
+            self.status = id003.HOLDING
+        elif command == id003.WAIT:
+            self._escrow_start = time.monotonic()
+        return encode_frame(id003.ACK)
+
+    def _status_request(self):
+        if (self.status in (id003.ESCROW, id003.HOLDING) and self.escrow_timeout is not None
+                and time.monotonic() - self._escrow_start > self.escrow_timeout):
+            # nobody decided in time, give the bill back
+            self.escrow_timeouts += 1
+            self.returned.append(self.data)
+            self._go([(id003.RETURNING, b'', self.return_polls)])
+
+        response = encode_frame(self.status, self.data)
+
+        if self.remaining is not None:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self._advance()
+        elif self.status in (id003.IDLE, id003.INHIBIT) and self.scenario:
+            self._start(self.scenario.popleft())
+        return response
+
+    def _go(self, states):
+        self._next.clear()
+        self._next.extend(states)
+        self._advance()
+
+    def _advance(self):
+        if self._next:
+            self.status, self.data, self.remaining = self._next.popleft()
+        else:
+            # done, back to idle (or inhibited, if the controller said so)
+            self.status = id003.INHIBIT if any(self.settings[id003.GET_INHIBIT]) else id003.IDLE
+            self.data = b''
+            self.remaining = None
+        if self.status == id003.ESCROW:
+            self._escrow_start = time.monotonic()
+
+    def _start(self, step):
+        kind = step[0]
+        accepting = (id003.ACEPTING, b'', self.accept_polls)
+        if kind == 'insert':
+            data = bytes([step[1]]) + (step[2] if len(step) > 2 else b'')
+            self._go([accepting, (id003.ESCROW, data, None)])
+        elif kind == 'reject':
+            self._go([accepting, (id003.REJECTING, bytes([step[1]]), self.reject_polls)])
+        elif kind == 'error':
+            self._go([(step[1], b'', step[2])])
+        elif kind == 'failure':
+            self._go([(id003.FAILURE, bytes([step[1]]), None)])
+        elif kind == 'idle':
+            self._go([(id003.IDLE, b'', step[1])])
+        elif kind == 'power_up':
+            self._go([(step[1] if len(step) > 1 else id003.POW_UP, b'', None)])
+        else:
+            raise ValueError("Unknown scenario step: %r" % (step,))
+
+
+class AcceptorServer(threading.Thread):
+    """Serve any number of VirtualAcceptors from one thread.
+
+    Add acceptors before calling `start()`.
+    """
+
+    def __init__(self, acceptors=()):
+        super().__init__(daemon=True)
+        self.acceptors = []
+        self.selector = selectors.DefaultSelector()
+        self._pending = []  # heap of (when, seq, fd, frame) for delayed responses
+        self._seq = itertools.count()
+        self._running = False
+
+        for acceptor in acceptors:
+            self.add(acceptor)
+
+    def add(self, acceptor):
+        acceptor.server = self
+        self.acceptors.append(acceptor)
+        self.selector.register(acceptor.master, selectors.EVENT_READ, acceptor)
+        return acceptor
+
+    def remove(self, acceptor):
+        self.selector.unregister(acceptor.master)
+        self.acceptors.remove(acceptor)
+
+    def stop(self):
+        self._running = False
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        self._running = True
+        pending = self._pending
+        while self._running:
+            now = time.monotonic()
+            while pending and pending[0][0] <= now:
+                when, _, fd, frame = heapq.heappop(pending)
+                self._write(fd, frame)
+
+            timeout = 0.1
+            if pending:
+                timeout = min(timeout, pending[0][0] - now)
+            for key, _ in self.selector.select(max(timeout, 0.0)):
+                acceptor = key.data
+                try:
+                    data = os.read(acceptor.master, 4096)
+                except OSError:
+                    # controller closed the port
+                    continue
+                for frame in acceptor.receive(data):
+                    delay = acceptor.get_delay()
+                    if delay > 0:
+                        heapq.heappush(pending, (time.monotonic() + delay, next(self._seq),
+                                                 acceptor.master, frame))
+                    else:
+                        self._write(acceptor.master, frame)
+        self.selector.close()
+
+    def _write(self, fd, frame):
+        try:
+            os.write(fd, frame)
+        except OSError as e:
+            log.debug("Virtual acceptor write failed: %s", e)
@@ -19,13 +19,21 @@ get_pos()
 set_pos()
 
 get_key()
+KeyReader
+read_line()
 
 wipe()
+
+Screen
 """
 
 import os
 import sys
+import atexit
 import struct
+import signal
+import selectors
+import threading
 import colorama as c
 import time
 
@@ -70,9 +78,48 @@ _color_idx = {
 
 ## Get terminal size ##
 
+# get_size() is cached, and on POSIX dropped when the terminal is resized
+# (SIGWINCH); elsewhere it's looked up again after _SIZE_TTL seconds
+_size = None
+_size_time = 0.0
+_size_on_winch = False
+_prev_winch = None
+_SIZE_TTL = 1.0
+
+
+def _on_winch(signum, frame):
+    global _size
+    _size = None
+    if callable(_prev_winch):
+        _prev_winch(signum, frame)
+
+
+def _watch_size():
+    """Invalidate the size cache on SIGWINCH, where there is one. Signal
+    handlers can only be set from the main thread; elsewhere the cache
+    expires instead.
+    """
+    global _size_on_winch, _prev_winch
+    if not hasattr(signal, 'SIGWINCH'):
+        return
+    try:
+        _prev_winch = signal.signal(signal.SIGWINCH, _on_winch)
+        _size_on_winch = True
+    except ValueError:
+        pass
+
 
 def get_size():
     """Returns terminal size as (cols, rows)"""
+    global _size, _size_time
+    if _size is not None and (_size_on_winch or time.monotonic() - _size_time < _SIZE_TTL):
+        return _size
+    _size = _get_size()
+    _size_time = time.monotonic()
+    return _size
+
+
+def _get_size():
     xy=None
     if os.name == "nt":
         xy = _getTerminalSize_windows()
@@ -143,7 +190,7 @@ def _getTerminalSize_linux():
             pass
     if not cr:
         try:
-            cr = (env['LINES'], env['COLUMNS'])
+            cr = (os.environ['LINES'], os.environ['COLUMNS'])
         except:
             return None
     return int(cr[1]), int(cr[0])
@@ -188,6 +235,8 @@ def _getCurPos_windows():
 
 
 def _getCurPos_linux():
+    import tty
+    import termios
     fd = sys.stdin.fileno()
     old_settings = termios.tcgetattr(fd)
     x = None
@@ -220,7 +269,9 @@ def wipe():
     if os.name == "nt":
         os.system("cls")
     elif os.name == "posix":
-        os.system("clear")
+        # same as clear(1) does, without starting it
+        sys.stdout.write("\x1b[H\x1b[2J")
+        sys.stdout.flush()
     else:
         print("\x1b[1,1H")
         x, y = get_size()
@@ -247,16 +298,7 @@ class _GetchUnix:
         import termios
 
     def __call__(self):
-        import tty
-        import termios
-        fd = sys.stdin.fileno()
-        old_settings = termios.tcgetattr(fd)
-        try:
-            tty.setraw(sys.stdin.fileno())
-            ch = sys.stdin.read(1)
-        finally:
-            termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
-        return ch
+        return key_reader().read()
 
 
 class _GetchWindows:
@@ -271,6 +313,243 @@ class _GetchWindows:
         return c
 
 
+# ANSI escape sequences, less the ESC [ or ESC O, and what msvcrt.getch()
+# returns for the same keys
+_ANSI_KEYS = {
+    b'A': b'\xe0H',     # up
+    b'B': b'\xe0P',     # down
+    b'C': b'\xe0M',     # right
+    b'D': b'\xe0K',     # left
+    b'H': b'\xe0G',     # home
+    b'F': b'\xe0O',     # end
+    b'1~': b'\xe0G',
+    b'7~': b'\xe0G',
+    b'4~': b'\xe0O',
+    b'8~': b'\xe0O',
+    b'2~': b'\xe0R',    # insert
+    b'3~': b'\xe0S',    # delete
+    b'5~': b'\xe0I',    # page up
+    b'6~': b'\xe0Q',    # page down
+    b'Z': b'\x00\x0f',  # shift-tab
+}
+
+_PLAIN_KEYS = {
+    b'\n': b'\r',       # enter
+    b'\x7f': b'\x08',   # backspace
+}
+
+# how long the rest of an escape sequence gets to arrive before a lone ESC
+# is taken to be the Esc key
+ESC_TIMEOUT = 0.05
+
+
+class KeyReader:
+    """Reads key presses from a terminal, POSIX only.
+    
+    The terminal is put in cbreak mode (no line editing or echo, but Ctrl-C
+    still works) on the first read() and left that way until stop(), rather
+    than switched for every key. Keys are read straight from the file
+    descriptor through a selector, and come back as bytes the way
+    msvcrt.getch() gives them on Windows: arrows and the like as b'\\xe0'
+    and a scan code, Enter as b'\\r', anything else as typed (in UTF-8).
+    
+    wake() makes a read() blocked on another thread return None straight
+    away, through a self-pipe; interrupt() also puts the terminal back in
+    line mode, e.g. for input() on another thread, and keeps it there (reads
+    return None) until resume().
+    """
+    
+    def __init__(self, fd=None):
+        self.fd = sys.stdin.fileno() if fd is None else fd
+        self._saved = None  # terminal settings to restore, False if not a terminal
+        self.suspended = False  # by interrupt(), until resume()
+        self._mode_lock = threading.Lock()  # for the terminal mode and suspended
+        self._buf = bytearray()  # bytes read but not made into keys yet
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.fd, selectors.EVENT_READ)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        
+    def __enter__(self):
+        self.start()
+        return self
+        
+    def __exit__(self, *exc):
+        self.stop()
+        
+    def start(self):
+        """Put the terminal in cbreak mode, if it isn't already and reading
+        isn't suspended. Returns whether it's in cbreak mode (or not a
+        terminal).
+        """
+        with self._mode_lock:
+            if self.suspended:
+                return False
+            self._start()
+            return True
+            
+    def _start(self):
+        import tty
+        import termios
+        if self._saved is None:
+            try:
+                self._saved = termios.tcgetattr(self.fd)
+            except termios.error:
+                self._saved = False  # not a terminal, nothing to set
+            else:
+                # TCSANOW, as the default would throw away keys already typed
+                tty.setcbreak(self.fd, termios.TCSANOW)
+                
+    def stop(self):
+        """Put the terminal back the way start() found it"""
+        with self._mode_lock:
+            self._stop()
+            
+    def _stop(self):
+        import termios
+        if self._saved:
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self._saved)
+        self._saved = None
+        
+    def wake(self):
+        """Make a read() waiting on another thread return None now"""
+        try:
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            pass  # plenty of wake-ups queued already
+            
+    def interrupt(self):
+        """stop() and wake(), to hand the terminal over to input(). Reading
+        stays suspended until resume(), so a read() between keys on another
+        thread can't put the terminal back in cbreak mode under input().
+        """
+        with self._mode_lock:
+            self.suspended = True
+            self._stop()
+        self.wake()
+        
+    def resume(self):
+        """Let read() have the terminal again after interrupt()"""
+        with self._mode_lock:
+            self.suspended = False
+        
+    def close(self):
+        self.stop()
+        self._selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        
+    def read(self, timeout=None):
+        """Wait up to `timeout` seconds (None for as long as it takes) for a
+        key press and return it, or None if there was none or wake() was
+        called, or reading is suspended (see interrupt())
+        """
+        if not self.start():
+            return None
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            key = self._decode()
+            if key is not None:
+                return key
+            if self._buf:
+                # part of an escape sequence or character, the rest comes
+                # right behind it if it's coming at all
+                if not self._fill(ESC_TIMEOUT):
+                    return self._decode(True)
+                continue
+            wait = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+            if not self._fill(wait):
+                return None
+                
+    def _fill(self, timeout):
+        """Read whatever's waiting. Returns False on timeout or wake-up."""
+        ready = False
+        for key, events in self._selector.select(timeout):
+            if key.fd == self._wake_r:
+                try:
+                    os.read(self._wake_r, 4096)
+                except BlockingIOError:
+                    pass
+                return False
+            ready = True
+        if not ready:
+            return False
+        data = os.read(self.fd, 1024)
+        if not data:
+            raise EOFError
+        self._buf += data
+        return True
+        
+    def _decode(self, partial=False):
+        """Take the next key off the buffer. Returns None if it isn't all
+        there yet, unless `partial`, when what there is of it is taken.
+        """
+        buf = self._buf
+        if not buf:
+            return None
+        first = buf[0]
+        if first == 0x1b:
+            n = _escape_length(buf)
+        elif first >= 0xc0:
+            # UTF-8 lead byte
+            n = 2 if first < 0xe0 else 3 if first < 0xf0 else 4
+        else:
+            n = 1
+        if not n or n > len(buf):
+            if not partial:
+                return None
+            n = len(buf)
+        key = bytes(buf[:n])
+        del buf[:n]
+        if len(key) > 2 and key[0] == 0x1b:
+            final = key[-1:]
+            if final == b'~':
+                # e.g. ESC [ 3 ; 5 ~ is ctrl-delete, take it as delete
+                final = key[2:-1].split(b';')[0] + final
+            return _ANSI_KEYS.get(final, key)
+        return _PLAIN_KEYS.get(key, key)
+
+
+def _escape_length(buf):
+    """Length of the escape sequence at the start of `buf`, 1 if it's a
+    lone ESC, or 0 if there's more of it to come
+    """
+    if len(buf) < 2:
+        return 0
+    if buf[1] not in b'[O':
+        return 1
+    for i in range(2, len(buf)):
+        b = buf[i]
+        if 0x40 <= b <= 0x7e:
+            return i + 1  # final byte
+        if not 0x20 <= b <= 0x3f:
+            return i  # not a sequence after all, cut it off here
+    return 0
+
+
+_key_reader = None
+
+
+def key_reader():
+    """The KeyReader for standard input, shared by getch() and get_key() on
+    POSIX. The terminal is put back the way it was on exit.
+    """
+    global _key_reader
+    if _key_reader is None:
+        _key_reader = KeyReader()
+        atexit.register(_key_reader.stop)
+    return _key_reader
+
+
+def read_line(prompt=''):
+    """input(), with the terminal back in line mode if keys were being read"""
+    if _key_reader is not None:
+        _key_reader.stop()
+    return input(prompt)
+
+
 getch = _Getch()
 
 def get_key(timeout=0.0):
@@ -298,10 +577,7 @@ def get_key(timeout=0.0):
                 time.sleep(0.05)
     
     elif os.name == 'posix':
-        from select import select
-        rlist, wlist, xlist = select([sys.stdin], [], [], timeout)
-        if sys.stdin in rlist:
-            char = sys.stdin.read()
+        char = key_reader().read(timeout)
     
     return char
 
@@ -377,8 +653,185 @@ def set_dim():
     print(c.Style.NORMAL, end='')
 
 
+## Screen buffer ##
+
+# unchanged cells between two changed ones are rewritten rather than skipped
+# over if there are fewer of them than this, which is about what moving the
+# cursor past them costs
+_GAP = 6
+
+_DEFAULT_STYLE = (7, 0, False)  # fg, bg, bright
+_styles = {}  # style -> escape sequence
+
+
+def _sgr(style):
+    seq = _styles.get(style)
+    if seq is None:
+        fg, bg, bright = style
+        seq = _styles[style] = (c.Style.RESET_ALL + _fg_colors[fg] + _bg_colors[bg]
+                                + (c.Style.BRIGHT if bright else ''))
+    return seq
+
+
+class Screen:
+    """Double-buffered screen.
+    
+    Draw the next frame with `write()` (and `clear()` first if it's a new
+    page), then `render()` writes the cells that changed since the last
+    frame, and nothing else, in one write. The cursor position is tracked
+    here rather than asked of the terminal. Positions are (x, y) from (1, 1),
+    as for set_pos().
+    
+    Anything else written to the terminal in between leaves the screen out
+    of date; call `invalidate()` (or `invalidate(rows)`) to have those parts
+    redrawn.
+    """
+    
+    def __init__(self, out=None):
+        self.out = out or sys.stdout
+        self.size = None
+        self.front = []  # rows of (char, style) cells, as on the terminal
+        self.back = []  # as they'll be after the next render()
+        self.cursor = (1, 1)  # where render() leaves the cursor
+        self.style = _DEFAULT_STYLE
+        self._pos = None  # where the terminal's cursor is, None if not known
+        self._style = None  # the terminal's current style, None if not known
+        self._wipe = True
+        self._resize(get_size())
+        
+    def _resize(self, size):
+        width, height = size
+        blank = (' ', _DEFAULT_STYLE)
+        back = [[blank] * width for _ in range(height)]
+        # keep what's been drawn, as far as it fits
+        for row, old in zip(back, self.back):
+            n = min(width, len(old))
+            row[:n] = old[:n]
+        self.back = back
+        self.size = size
+        self.invalidate()
+        
+    def invalidate(self, rows=None):
+        """Redraw `rows` (y positions; all of them by default) in full on
+        the next render, e.g. after something else wrote to the terminal
+        """
+        
+        width = self.size[0]
+        if rows is None:
+            self.front = [[None] * width for _ in self.back]
+            self._wipe = True
+        else:
+            for y in rows:
+                if 1 <= y <= len(self.front):
+                    self.front[y - 1] = [None] * width
+        self._pos = None
+        self._style = None
+        
+    def clear(self):
+        """Blank the next frame"""
+        
+        blank = (' ', _DEFAULT_STYLE)
+        for row in self.back:
+            row[:] = [blank] * len(row)
+            
+    def write(self, x, y, text, fg=None, bg=None, bright=False):
+        """Put `text` in the next frame starting at (x, y), in the given
+        colors (indexes or names, as for set_fg()). Newlines start a new row
+        back at x, tabs go to the next multiple of 8 columns, and whatever
+        doesn't fit is cut off. Returns the position just after the text,
+        e.g. to put the cursor there.
+        """
+        
+        style = self._make_style(fg, bg, bright)
+        width, height = self.size
+        lines = text.split('\n')
+        for i, line in enumerate(lines):
+            if i:
+                y += 1
+            if '\t' in line:
+                line = (' ' * (x - 1) + line).expandtabs()[x - 1:]
+            if 1 <= y <= height:
+                row = self.back[y - 1]
+                start = max(x, 1)
+                end = min(x + len(line), width + 1)
+                for col in range(start, end):
+                    row[col - 1] = (line[col - x], style)
+        return x + len(line), y
+        
+    def _make_style(self, fg, bg, bright):
+        if isinstance(fg, str):
+            fg = _color_idx[fg]
+        if isinstance(bg, str):
+            bg = _color_idx[bg]
+        if fg is None and bg is None and not bright:
+            return self.style
+        return (self.style[0] if fg is None else fg,
+                self.style[1] if bg is None else bg,
+                bright)
+        
+    def move(self, x, y):
+        """Leave the cursor at (x, y) after the next render"""
+        self.cursor = (x, y)
+        
+    def render(self):
+        """Bring the terminal up to date with the next frame, in one write.
+        A resized terminal is redrawn in full.
+        """
+        
+        size = get_size()
+        if size != self.size:
+            self._resize(size)
+        width = size[0]
+        
+        out = []
+        if self._wipe:
+            # start from a blank terminal, then only what isn't blank is drawn
+            out.append(_sgr(_DEFAULT_STYLE) + "\x1b[2J")
+            self._style = _DEFAULT_STYLE
+            self._wipe = False
+            blank = (' ', _DEFAULT_STYLE)
+            self.front = [[blank] * width for _ in self.back]
+        for y, (old, new) in enumerate(zip(self.front, self.back), 1):
+            if old == new:
+                continue
+            x = 0
+            while x < width:
+                if old[x] == new[x]:
+                    x += 1
+                    continue
+                # a run of changed cells, taking in short unchanged gaps
+                start = x
+                end = x = x + 1
+                while x < width and x - end < _GAP:
+                    if old[x] != new[x]:
+                        end = x + 1
+                    x += 1
+                x = end
+                self._move(out, start + 1, y)
+                for ch, style in new[start:end]:
+                    if style != self._style:
+                        out.append(_sgr(style))
+                        self._style = style
+                    out.append(ch)
+                # past the last column the cursor position is up to the terminal
+                self._pos = (end + 1, y) if end < width else None
+            old[:] = new
+        self._move(out, *self.cursor)
+        
+        if out:
+            self.out.write(''.join(out))
+            self.out.flush()
+            
+    def _move(self, out, x, y):
+        if self._pos != (x, y):
+            out.append("\x1b[{};{}H".format(y, x))
+            self._pos = (x, y)
+
+
 ## Continuation of init routines ##
 
+_watch_size()
+
 # reset terminal to defaults
 
 print(c.Fore.WHITE, c.Back.BLACK, end='')
\ No newline at end of file
@@ -10,6 +10,7 @@ import logging
 
 def main():
     port = 'COM11'  # JCM UAC device (USB serial adapter)
+    id003.configure_logging()
     
     bv = BillVal(port)
     print("Please connect bill validator.")
@@ -0,0 +1,24 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import pytest
+
+import id003
+import sim003
+
+
+@pytest.fixture
+def acceptor():
+    """A VirtualAcceptor served from its own thread, already IDLE"""
+    acceptor = sim003.VirtualAcceptor(power_up=id003.IDLE).start()
+    yield acceptor
+    acceptor.close()
+
+
+@pytest.fixture
+def profiles(tmp_path):
+    return id003.ProfileCache(str(tmp_path / 'profiles.json'))
@@ -0,0 +1,189 @@
+import asyncio
+
+import pytest
+
+import id003
+import sim003
+from loopback import Exhausted, memory_bill_val
+
+
+def poll_until_exhausted(bv, polls):
+    bv.com.limit = bv.com.acceptor.commands[id003.STATUS_REQ] + polls
+    with pytest.raises(Exhausted):
+        bv.poll(interval=0.0)
+
+
+@pytest.mark.parametrize('decision, stacked, returned', [
+    (id003.STACK_1, [b'\x63'], []),
+    (id003.RETURN, [], [b'\x63']),
+])
+def test_escrow_decision(decision, stacked, returned):
+    acceptor = sim003.VirtualAcceptor([('insert', id003.DENOM_3)], power_up=id003.IDLE)
+    bv = memory_bill_val(acceptor)
+    offered = []
+
+    def decide(denom, barcode):
+        offered.append(denom)
+        return id003.completed(decision)
+
+    bv.escrow_decider = decide
+    poll_until_exhausted(bv, 50)
+    acceptor.close()
+
+    assert offered == [id003.DENOM_3]
+    assert acceptor.stacked == stacked
+    assert acceptor.returned == returned
+    assert bv.pending is None
+
+
+def test_initialize_only_changed():
+    acceptor = sim003.VirtualAcceptor(power_up=id003.IDLE)
+    bv = memory_bill_val(acceptor)
+    args = ([0x04, 0], [0, 0], [1], [0, 0])
+
+    timings = bv.initialize(*args, only_changed=True)
+    assert timings[0][1] == 'sent'
+    assert acceptor.settings[id003.GET_DENOM] == b'\x04\x00'
+
+    sent = acceptor.commands[id003.SET_DENOM]
+    timings = bv.initialize(*args, only_changed=True)
+    assert {t[1] for t in timings[:-1]} == {'unchanged'}
+    assert timings[-1][:2] == ('initializing', 'wait')
+    assert acceptor.commands[id003.SET_DENOM] == sent
+    acceptor.close()
+
+
+def test_initialize_not_echoed():
+    acceptor = sim003.VirtualAcceptor(power_up=id003.IDLE)
+    handle = acceptor.handle
+
+    def no_direction(command, data):
+        if command == id003.SET_DIRECTION:
+            return id003.encode_frame(id003.INVALID_COMMAND)
+        return handle(command, data)
+
+    acceptor.handle = no_direction
+    bv = memory_bill_val(acceptor)
+    timings = bv.initialize()
+    actions = {t[0]: t[1] for t in timings}
+    assert actions['direction inhibit'] == 'failed'
+    assert id003.SET_DIRECTION not in bv.settings
+    assert id003.SET_DENOM in bv.settings
+    acceptor.close()
+
+
+def restarted(bv):
+    """A new BillVal on `bv`'s port, as if the controller was restarted.
+    The pty can't be opened a second time once closed.
+    """
+    new = id003.BillVal(None, profiles=bv.profiles)
+    new.com = bv.com
+    new.port = bv.port
+    new.bv_on = True
+    return new
+
+
+def test_warm_start(profiles):
+    args = ([0x04, 0], [0, 0], [1], [0, 0])
+    acceptor = sim003.VirtualAcceptor(power_up=id003.POW_UP)
+
+    bv = memory_bill_val(acceptor)
+    bv.profiles = profiles
+    bv.power_on(*args)
+    assert bv.init_timings is not None
+    assert profiles.load(bv.port) is not None
+    resets = acceptor.commands[id003.RESET]
+
+    # a restarted controller finds it IDLE with the same settings
+    bv = restarted(bv)
+    assert bv.power_on(*args) == id003.IDLE
+    assert bv.init_timings is None
+    assert acceptor.commands[id003.RESET] == resets
+    assert bv.bv_version == profiles.load(bv.port).version
+
+    # reconfigured behind its back, so it's powered up again
+    acceptor.settings[id003.GET_DENOM] = b'\x00\x00'
+    bv = restarted(bv)
+    bv.power_on(*args)
+    assert bv.init_timings is not None
+    assert acceptor.commands[id003.RESET] == resets + 1
+    acceptor.close()
+
+
+def replug(acceptor, bv, monkeypatch, power_up=None):
+    """Pull the acceptor's adapter and plug it back in, where `bv` can find
+    it by USB identity
+    """
+    acceptor.unplug()
+    with pytest.raises(id003.PORT_ERRORS):
+        bv.req_status()
+    acceptor.plug(power_up)
+    monkeypatch.setattr(id003, 'find_port', lambda identity: acceptor.port)
+    bv.usb_id = ('test', acceptor)
+
+
+@pytest.fixture
+def reconnecting(acceptor):
+    bv = id003.BillVal(acceptor.port, metrics=None)
+    bv.reconnect_policy = id003.RetryPolicy(attempts=5, backoff=0.05)
+    bv.power_on()
+    yield bv
+    bv.com.close()
+
+
+def test_reconnect(acceptor, reconnecting, monkeypatch):
+    bv = reconnecting
+    settings = dict(acceptor.settings)
+    replug(acceptor, bv, monkeypatch)
+    resets = acceptor.commands[id003.RESET]
+
+    assert bv.reconnect(OSError('unplugged'))
+    assert bv.com.port == acceptor.port
+    assert bv.last_recovery is not None
+    assert bv.req_status()[0] == id003.IDLE
+    assert acceptor.commands[id003.RESET] == resets
+    assert acceptor.settings == settings
+
+
+def test_reconnect_after_power_loss(acceptor, reconnecting, monkeypatch):
+    bv = reconnecting
+    replug(acceptor, bv, monkeypatch, power_up=id003.POW_UP)
+    resets = acceptor.commands[id003.RESET]
+
+    assert bv.reconnect(OSError('unplugged'))
+    assert acceptor.commands[id003.RESET] == resets + 1
+    assert bv.req_status()[0] == id003.IDLE
+
+
+def test_reconnect_disabled(acceptor, reconnecting):
+    reconnecting.reconnect_policy = None
+    assert not reconnecting.reconnect(OSError('unplugged'))
+
+
+def test_async_escrow(acceptor, profiles):
+    decisions = [id003.RETURN, id003.STACK_1]
+    stacked = []
+
+    async def decide(denom, barcode):
+        await asyncio.sleep(0.01)
+        return decisions.pop(0)
+
+    async def on_stacked(data):
+        stacked.append(data)
+        bv.bv_on = False
+
+    async def main():
+        await bv.power_on()
+        acceptor.scenario.extend([('insert', id003.DENOM_3), ('insert', id003.DENOM_3)])
+        bv.escrow_decider = decide
+        bv.bv_events[id003.STACKED] = on_stacked
+        await asyncio.wait_for(bv.poll(0.01), 10)
+
+    bv = id003.AsyncBillVal(acceptor.port, profiles=profiles)
+    asyncio.run(main())
+    bv.close()
+
+    assert acceptor.returned == [b'\x63']
+    assert acceptor.stacked == [b'\x63']
+    assert len(stacked) == 1
+    assert profiles.load(acceptor.port) is not None
@@ -0,0 +1,91 @@
+import pytest
+
+import capture
+import id003
+import replay
+import sim003
+from loopback import Exhausted, memory_bill_val
+
+
+@pytest.fixture
+def recorded(tmp_path):
+    """Path of a capture of a bill going through escrow into the stacker,
+    and the acceptor it was recorded from
+    """
+    path = str(tmp_path / 'raw.cap')
+    acceptor = sim003.VirtualAcceptor([('insert', id003.DENOM_3)], power_up=id003.IDLE)
+    bv = memory_bill_val(acceptor, limit=40)
+    bv.raw = capture.CaptureWriter(path)
+    bv.escrow_decider = lambda denom, barcode: id003.completed(id003.STACK_1)
+    with pytest.raises(Exhausted):
+        bv.poll(interval=0.0)
+    bv.raw.close()
+    acceptor.close()
+    return path, acceptor
+
+
+def received(acceptor):
+    return sum(acceptor.commands.values())
+
+
+def test_read_capture(recorded):
+    path, acceptor = recorded
+    records = list(capture.read_capture(path))
+    sent = [r for r in records if r.direction == '>']
+    assert len(records) > len(sent) >= received(acceptor)
+    assert {r.port for r in records} == {acceptor.port}
+    assert [r.frame for r in sent[:2]] == [id003.encode_frame(id003.STATUS_REQ)] * 2
+    assert all(a.timestamp <= b.timestamp for a, b in zip(records, records[1:]))
+    assert (id003.STACK_1, b'') in [(r.frame[2], r.frame[3:-2]) for r in sent]
+
+
+def test_capture_reader(recorded):
+    path, acceptor = recorded
+    records = list(capture.read_capture(path))
+    with capture.CaptureReader(path) as reader:
+        assert len(reader) == len(records)
+        assert [bytes(reader.frame(i)) for i in range(len(reader))] == [r.frame for r in records]
+        escrow = list(reader.statuses(id003.ESCROW))
+        assert escrow
+        assert all(rec.frame[3:-2] == b'\x63' for i, rec in escrow)
+        assert reader.seek(records[-1].timestamp) <= len(records) - 1
+
+
+def test_bulk(recorded):
+    pytest.importorskip('numpy')
+    import bulk
+
+    path, acceptor = recorded
+    records = list(capture.read_capture(path))
+    table = bulk.load_capture(path)
+    assert len(table) == len(records)
+    assert table.ports == [acceptor.port]
+    counts = dict(table.count_by_command())
+    assert counts[id003.STATUS_REQ] == sum(r.frame[2] == id003.STATUS_REQ for r in records)
+    escrow = table.select(command=id003.ESCROW, direction='<')
+    assert dict(escrow.count_by_data()) == {id003.DENOM_3: len(escrow)}
+
+
+def test_replay(recorded):
+    path, acceptor = recorded
+    bv = replay.replay_bill_val(escrow=id003.STACK_1)
+    seen = []
+    on_escrow = bv.bv_events[id003.ESCROW]
+
+    def escrow(data):
+        seen.append(data)
+        on_escrow(data)
+
+    bv.bv_events[id003.ESCROW] = escrow
+    polls = replay.Replay(path).run(bv)
+    assert polls == acceptor.commands[id003.STATUS_REQ]
+    assert seen == [b'\x63']
+    assert (id003.STACK_1, b'') in bv.com.sent
+    assert bv.pending is None
+
+
+def test_replay_handlers(recorded):
+    path, acceptor = recorded
+    seen = []
+    replay.Replay(path).run({id003.STACKED: seen.append, id003.VEND_VALID: seen.append})
+    assert len(seen) == 2
@@ -0,0 +1,62 @@
+import id003
+from id003 import encode_frame
+
+
+def test_decoder_splits_frames():
+    dec = id003.FrameDecoder()
+    dec.feed(encode_frame(id003.IDLE) + encode_frame(id003.ESCROW, b'\x63'))
+    assert list(dec) == [(id003.IDLE, b''), (id003.ESCROW, b'\x63')]
+    assert dec.skipped == 0
+
+
+def test_decoder_waits_for_partial_frame():
+    frame = encode_frame(id003.ESCROW, b'\x63')
+    dec = id003.FrameDecoder()
+    dec.feed(frame[:3])
+    assert dec.next_frame() is None
+    dec.feed(frame[3:])
+    assert dec.next_frame() == (id003.ESCROW, b'\x63')
+
+
+def test_decoder_skips_noise():
+    dec = id003.FrameDecoder()
+    dec.feed(b'\x55\xaa' + encode_frame(id003.IDLE))
+    assert list(dec) == [(id003.IDLE, b'')]
+    assert dec.skipped == 2
+
+
+def test_decoder_drops_bad_crc():
+    bad = bytearray(encode_frame(id003.ESCROW, b'\x63'))
+    bad[-1] ^= 0xff
+    dec = id003.FrameDecoder()
+    dec.feed(bytes(bad) + encode_frame(id003.IDLE))
+    assert list(dec) == [(id003.IDLE, b'')]
+    assert dec.crc_errors == 1
+    assert dec.skipped == len(bad)
+
+
+def test_decoder_skips_bad_length():
+    # a corrupted length byte claims more than will ever arrive
+    frame = encode_frame(id003.IDLE)
+    dec = id003.FrameDecoder()
+    dec.feed(b'\xfc\x40\x1a' + frame[:4])
+    assert dec.next_frame() is None
+    dec.feed(frame[4:])
+    assert dec.next_frame() == (id003.IDLE, b'')
+    assert dec.skipped == 3
+
+
+def test_decoder_resync():
+    dec = id003.FrameDecoder()
+    dec.feed(b'\xfc\x40\x1a')
+    assert dec.next_frame() is None
+    assert dec.resync() is None
+    assert not dec.buf
+    dec.feed(encode_frame(id003.IDLE))
+    assert dec.next_frame() == (id003.IDLE, b'')
+
+
+def test_decoder_reports_null_byte():
+    dec = id003.FrameDecoder()
+    dec.feed(b'\x00' + encode_frame(id003.IDLE))
+    assert list(dec) == [(0x00, b''), (id003.IDLE, b'')]